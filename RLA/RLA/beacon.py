@@ -0,0 +1,184 @@
+import functools
+import json
+import os
+import tempfile
+
+import requests
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_BEACON = {
+    'SOURCE': 'RLA.beacon.RemoteBeaconSource',
+    'OPTIONS': {},
+    'CACHE_DIR': None,
+}
+
+
+class BeaconError(Exception):
+    pass
+
+
+def pulse_time(timestamp):
+    """
+    Converts a datetime to the pulse time used by the beacon
+    @param timestamp    :   {datetime}
+                            Datetime specified for the pulse
+    @return             :   {int}
+                            Milliseconds since epoch (1587495000000)
+    """
+    return int(timestamp.timestamp() * 1000)
+
+
+class BeaconSource:
+    """
+    Source of random beacon pulses
+    """
+
+    def get_pulse(self, time):
+        """
+        Obtains the pulse emitted at the specified time
+        @param time :   {int}
+                        Pulse time, in milliseconds since epoch
+        @return     :   {dict}
+                        Pulse, as published by the beacon
+        """
+        raise NotImplementedError
+
+
+class RemoteBeaconSource(BeaconSource):
+    """
+    Random UChile beacon, queried over HTTP with a pooled session
+    """
+
+    def __init__(self, url='https://random.uchile.cl/beacon/2.0/pulse/time/', timeout=10, retries=3,
+                 backoff_factor=0.5):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=('GET',)
+        )
+        adapter = HTTPAdapter(max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_pulse(self, time):
+        try:
+            response = self.session.get(self.url + str(time), timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()['pulse']
+
+        except (requests.RequestException, ValueError, KeyError) as e:
+            raise BeaconError(f'Could not obtain the pulse at {time}: {e}') from e
+
+
+class FileBeaconSource(BeaconSource):
+    """
+    Pulses read from local files, either a directory with one <time>.json
+    file per pulse (the layout of the pulse cache) or a single json file
+    mapping pulse times to pulses
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_pulse(self, time):
+        try:
+            if os.path.isdir(self.path):
+                with open(os.path.join(self.path, f'{time}.json')) as f:
+                    return json.load(f)
+
+            with open(self.path) as f:
+                return json.load(f)[str(time)]
+
+        except (OSError, ValueError, KeyError) as e:
+            raise BeaconError(f'Pulse at {time} not found in {self.path}') from e
+
+
+class BeaconClient:
+    """
+    Obtains pulses from a source, keeping a copy of each one in a local
+    cache, since a pulse never changes once emitted
+    """
+
+    def __init__(self, source, cache_dir=None):
+        self.source = source
+        self.cache_dir = cache_dir
+        self._pulses = {}
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, time):
+        return os.path.join(self.cache_dir, f'{time}.json')
+
+    def _read_cache(self, time):
+        if time in self._pulses:
+            return self._pulses[time]
+
+        if self.cache_dir and os.path.exists(self._cache_path(time)):
+            with open(self._cache_path(time)) as f:
+                self._pulses[time] = json.load(f)
+
+            return self._pulses[time]
+
+        return None
+
+    def _write_cache(self, time, pulse):
+        self._pulses[time] = pulse
+        if self.cache_dir:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(pulse, f)
+
+            os.replace(tmp_path, self._cache_path(time))
+
+    def get_pulse(self, timestamp):
+        """
+        Obtains the pulse at the specified time, from the cache if possible
+        @param timestamp    :   {datetime}
+                                Datetime specified for the pulse
+        @return             :   {dict}
+                                Pulse, as published by the beacon
+        """
+        time = pulse_time(timestamp)
+        pulse = self._read_cache(time)
+        if pulse is None:
+            pulse = self.source.get_pulse(time)
+            self._write_cache(time, pulse)
+
+        return pulse
+
+    def get_random_seed(self, timestamp):
+        """
+        Obtains the random value of the pulse at the specified time
+        @param timestamp    :   {datetime}
+                                Datetime specified for the pulse
+        @return             :   {str}
+                                Random pulse value, in hexadecimal
+        """
+        return self.get_pulse(timestamp)['localRandomValue']
+
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """
+    Builds the beacon client configured in settings.RANDOM_BEACON
+    @return :   {BeaconClient}
+                Beacon client shared by the process
+    """
+    config = {**DEFAULT_BEACON, **getattr(settings, 'RANDOM_BEACON', {})}
+    source = import_string(config['SOURCE'])(**config['OPTIONS'])
+    return BeaconClient(source, cache_dir=config['CACHE_DIR'])
+
+
+@receiver(setting_changed)
+def _reset_client(setting, **kwargs):
+    if setting == 'RANDOM_BEACON':
+        get_client.cache_clear()
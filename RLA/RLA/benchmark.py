@@ -0,0 +1,368 @@
+import gc
+import hashlib
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from RLA import engine, utils
+from RLA.store import CountStore
+
+RESULTS_VERSION = 1
+
+SCALES = {
+    'small': {'n_tables': 1000, 'n_candidates': 8, 'n_parties': 4, 'ballots_per_table': 300, 'n_seats': 3},
+    'regional': {'n_tables': 10000, 'n_candidates': 24, 'n_parties': 8, 'ballots_per_table': 350, 'n_seats': 6},
+    'national': {'n_tables': 43000, 'n_candidates': 40, 'n_parties': 10, 'ballots_per_table': 350, 'n_seats': 8},
+}
+
+BENCHMARK_SEED = '00' * 64
+
+
+def synthetic_count(n_tables, n_candidates, n_parties=0, ballots_per_table=350, seed=0):
+    """
+    Generates a preliminary count where the support of the candidates
+    decreases geometrically, so every winner has a margin, and the number
+    of ballots per table varies by up to 20% around ballots_per_table.
+    Candidates are split in consecutive blocks among the parties, so the
+    last parties are the smallest
+    @param n_tables             :   {int}
+                                    Number of tables
+    @param n_candidates         :   {int}
+                                    Number of candidates
+    @param n_parties            :   {int}
+                                    Number of parties, or 0 for a count
+                                    without a party column
+    @param ballots_per_table    :   {int}
+                                    Average number of ballots per table
+    @param seed                 :   {int}
+                                    Seed of the generator
+    @return                     :   {CountStore}
+                                    Synthetic count
+    """
+    rng = np.random.default_rng(seed)
+    shares = 0.9 ** np.arange(n_candidates)
+    shares /= shares.sum()
+    ballots = rng.integers(int(ballots_per_table * 0.8), int(ballots_per_table * 1.2) + 1, size=n_tables)
+    vote_matrix = rng.multinomial(ballots, shares).astype(np.int64)
+    width = len(str(n_candidates))
+    candidates = np.array([f'Candidate {c:0{width}d}' for c in range(n_candidates)])
+    parties, candidate_parties = None, None
+    if n_parties:
+        width = len(str(n_parties))
+        parties = np.array([f'Party {p:0{width}d}' for p in range(n_parties)])
+        candidate_parties = np.arange(n_candidates, dtype=np.int64) * n_parties // n_candidates
+
+    checksum = hashlib.sha256(vote_matrix.tobytes()).hexdigest()
+    return CountStore(np.arange(1, n_tables + 1), candidates, vote_matrix, checksum, parties, candidate_parties)
+
+
+def write_count_csv(store, path):
+    """
+    Writes a count in the format of the uploaded files
+    @param store    :   {CountStore}
+                        Vote count
+    @param path     :   {str}
+                        Path to the csv file
+    """
+    df = store.to_df()
+    columns = list(utils.COUNT_COLUMNS) + (['party'] if store.has_parties else [])
+    df[columns].to_csv(path, index=False, chunksize=utils.CSV_CHUNK_SIZE)
+
+
+def _recount_df(store, table_codes):
+    df = store.to_df()
+    return df[df['table'].isin(store.tables[table_codes])].reset_index(drop=True)
+
+
+def _context(store, election_type, audit_type, n_seats, shuffled=True):
+    n_winners = n_seats if election_type == utils.DHONDT else 1
+    context = engine.create_audit(store, election_type, audit_type, 0.05, n_winners)
+    if shuffled:
+        engine.init_shuffled(context, BENCHMARK_SEED)
+
+    return context
+
+
+def _init_shuffled(store, options, audit_type):
+    def setup():
+        return _context(store, options['election_type'], audit_type, options['n_seats'], shuffled=False)
+
+    return setup, lambda context: engine.init_shuffled(context, BENCHMARK_SEED)
+
+
+def _random_sample(store, options):
+    return lambda: store.tables, lambda tables: utils.random_sample(tables, options['sample_tables'], seed=BENCHMARK_SEED)
+
+
+def _get_sample(store, options):
+    context = _context(store, options['election_type'], utils.BALLOT_POLLING, options['n_seats'])
+    return lambda: context.audit, lambda audit: utils.get_sample(audit, options['sample_ballots'])
+
+
+def _comparison_recount(store, options):
+    context = _context(store, options['election_type'], utils.COMPARISON, options['n_seats'])
+    recount = _recount_df(store, np.unique(context.audit.get_shuffled(options['sample_tables'])))
+
+    def setup():
+        return _context(store, options['election_type'], utils.COMPARISON, options['n_seats'], shuffled=False)
+
+    return setup, lambda context: engine.apply_recount(context, recount)
+
+
+def _ballot_polling_SPRT(store, options):
+    context = _context(store, options['election_type'], utils.BALLOT_POLLING, options['n_seats'], shuffled=False)
+    subaudit = context.primary
+    recount = {c: options['sample_ballots'] * v // sum(subaudit.vote_count.values()) for c, v in subaudit.vote_count.items()}
+
+    def setup():
+        return {w: dict(losers) for w, losers in subaudit.log_T.items()}
+
+    def run(log_T):
+        return utils.ballot_polling_log_SPRT(subaudit.vote_count, recount, log_T, 0.05, subaudit.Sw, subaudit.Sl)
+
+    return setup, run
+
+
+def _ballot_polling_SPRT_exact(store, options):
+    context = _context(store, options['election_type'], utils.BALLOT_POLLING, options['n_seats'], shuffled=False)
+    subaudit = context.primary
+    recount = {c: options['sample_ballots'] * v // sum(subaudit.vote_count.values()) for c, v in subaudit.vote_count.items()}
+    updated = utils.ballot_polling_log_SPRT(subaudit.vote_count, recount, subaudit.log_T, 0.05, subaudit.Sw, subaudit.Sl)
+
+    def run(log_T):
+        utils.verify_log_SPRT(subaudit.vote_count, recount, log_T, updated, 0.05, subaudit.Sw, subaudit.Sl)
+
+    return lambda: subaudit.log_T, run
+
+
+def _dhondt_subaudits(store, options):
+    election = engine.get_election(utils.DHONDT)
+
+    def setup():
+        return engine.Audit(store, utils.DHONDT, utils.BALLOT_POLLING, 0.05, options['n_seats'])
+
+    return setup, lambda audit: election.create_subaudits(audit, store)
+
+
+def _dhondt_transforms(store, options):
+    election = engine.get_election(utils.DHONDT)
+    context = _context(store, utils.DHONDT, utils.COMPARISON, options['n_seats'], shuffled=False)
+    table_counts = store.vote_matrix[:options['sample_tables']]
+    vote_recount = dict(zip(store.candidates.tolist(), table_counts.sum(axis=0).tolist()))
+
+    def run(audit):
+        election.comparison_table_matrix(audit, store, table_counts)
+        election.transform_primary_recount(audit, vote_recount)
+        election.get_party_seat_pairs(context)
+
+    return lambda: context.audit, run
+
+
+def _pickled_fields(store, options):
+    from picklefield.fields import dbsafe_decode, dbsafe_encode
+
+    context = _context(store, options['election_type'], utils.BALLOT_POLLING, options['n_seats'], shuffled=False)
+    fields = [context.audit.vote_count, context.audit.accum_recount] + [subaudit.log_T for subaudit in context.subaudits]
+    return lambda: fields, lambda values: [dbsafe_decode(dbsafe_encode(value)) for value in values]
+
+
+def _store_from_csv(store, options):
+    path = options['csv_path']
+    return lambda: path, CountStore.from_csv
+
+
+BENCHMARKS = {
+    'store_from_csv': (_store_from_csv, False),
+    'init_shuffled_ballot_polling': (lambda store, options: _init_shuffled(store, options, utils.BALLOT_POLLING), False),
+    'init_shuffled_comparison': (lambda store, options: _init_shuffled(store, options, utils.COMPARISON), False),
+    'random_sample': (_random_sample, False),
+    'get_sample': (_get_sample, False),
+    'comparison_recount': (_comparison_recount, False),
+    'ballot_polling_SPRT': (_ballot_polling_SPRT, False),
+    'ballot_polling_SPRT_exact': (_ballot_polling_SPRT_exact, False),
+    'dhondt_subaudits': (_dhondt_subaudits, True),
+    'dhondt_transforms': (_dhondt_transforms, True),
+    'pickled_fields': (_pickled_fields, False),
+}
+
+
+def measure(setup, run, repeat=3):
+    """
+    Times a benchmark and measures its peak memory. The memory is traced
+    on a separate run, so tracing does not slow down the timed ones
+    @param setup    :   {callable}
+                        Builds the argument of run, outside of the measures
+    @param run      :   {callable}
+                        Code measured
+    @param repeat   :   {int}
+                        Number of timed runs
+    @return         :   {dict}
+                        Best and mean time in seconds, and peak memory
+                        allocated in bytes
+    """
+    times = []
+    for _ in range(repeat):
+        argument = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(argument)
+        times.append(time.perf_counter() - start)
+
+    argument = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(argument)
+        _, peak = tracemalloc.get_traced_memory()
+
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'seconds': min(times),
+        'mean_seconds': statistics.mean(times),
+        'repeat': repeat,
+        'peak_memory': peak,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(n_tables, n_candidates, n_parties=0, ballots_per_table=350, n_seats=1, election_type=None,
+                   sample_tables=1000, sample_ballots=10000, repeat=3, only=None, seed=0, log=None):
+    """
+    Runs the benchmarks of the audit hot paths over a synthetic count
+    @param n_tables             :   {int}
+                                    Number of tables
+    @param n_candidates         :   {int}
+                                    Number of candidates
+    @param n_parties            :   {int}
+                                    Number of parties, or 0 for a count
+                                    without a party column
+    @param ballots_per_table    :   {int}
+                                    Average number of ballots per table
+    @param n_seats              :   {int}
+                                    Seats of the D'Hondt benchmarks
+    @param election_type        :   {str}
+                                    Election type of the audit benchmarks,
+                                    D'Hondt if there are parties, else
+                                    simple majority, if None
+    @param sample_tables        :   {int}
+                                    Tables recounted per comparison round
+    @param sample_ballots       :   {int}
+                                    Ballots recounted per ballot polling round
+    @param repeat               :   {int}
+                                    Number of timed runs of each benchmark
+    @param only                 :   {list<str>}
+                                    Names of the benchmarks to run, all of
+                                    them if None
+    @param seed                 :   {int}
+                                    Seed of the synthetic count
+    @param log                  :   {callable}
+                                    Called with the name and the result of
+                                    each benchmark when it finishes
+    @return                     :   {dict}
+                                    Machine readable results
+    """
+    if election_type is None:
+        election_type = utils.DHONDT if n_parties else utils.SIMPLE_MAJORITY
+
+    store = synthetic_count(n_tables, n_candidates, n_parties, ballots_per_table, seed)
+    options = {
+        'election_type': election_type,
+        'n_seats': n_seats,
+        'sample_tables': min(sample_tables, n_tables),
+        'sample_ballots': sample_ballots,
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        options['csv_path'] = os.path.join(directory, 'count.csv')
+        write_count_csv(store, options['csv_path'])
+        for name, (benchmark, needs_parties) in BENCHMARKS.items():
+            if (only and name not in only) or (needs_parties and not n_parties):
+                continue
+
+            results[name] = measure(*benchmark(store, options), repeat=repeat)
+            if log is not None:
+                log(name, results[name])
+
+    return {
+        'version': RESULTS_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'revision': _git_revision(),
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        },
+        'parameters': {
+            'n_tables': n_tables,
+            'n_candidates': n_candidates,
+            'n_parties': n_parties,
+            'ballots_per_table': ballots_per_table,
+            'ballots': int(store.table_totals.sum()),
+            'n_seats': n_seats,
+            'election_type': election_type,
+            'sample_tables': options['sample_tables'],
+            'sample_ballots': sample_ballots,
+            'seed': seed,
+        },
+        'results': results,
+    }
+
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compares the results of two benchmark runs
+    @param baseline     :   {dict}
+                            Results of the reference run
+    @param current      :   {dict}
+                            Results of the new run
+    @param threshold    :   {float}
+                            Relative slowdown (or memory growth) above which
+                            a benchmark is reported as a regression
+    @return             :   {list<dict>}
+                            One entry per benchmark run in both, with the
+                            time and memory ratios (current / baseline) and
+                            whether it regressed
+    """
+    comparison = []
+    for name, result in current['results'].items():
+        if name not in baseline['results']:
+            continue
+
+        reference = baseline['results'][name]
+        time_ratio = result['seconds'] / reference['seconds'] if reference['seconds'] else float('inf')
+        memory_ratio = result['peak_memory'] / reference['peak_memory'] if reference['peak_memory'] else 1.0
+        comparison.append({
+            'name': name,
+            'seconds': (reference['seconds'], result['seconds']),
+            'peak_memory': (reference['peak_memory'], result['peak_memory']),
+            'time_ratio': time_ratio,
+            'memory_ratio': memory_ratio,
+            'regression': time_ratio > 1 + threshold or memory_ratio > 1 + threshold,
+        })
+
+    return comparison
@@ -0,0 +1,47 @@
+"""
+Audit engine: the statistical workflow of an audit (sample sizing,
+shuffling, SPRT updates) over in-memory state, without the web layer.
+The same functions run on the audits stored in the database
+"""
+from RLA.engine.elections import DHondt, Plurality, SuperMajority, get_election
+from RLA.engine.groups import (
+    apply_group_recount,
+    check_group_status,
+    draw_group_sample,
+    get_group_sample_size,
+    init_group_shuffled,
+    union_tables,
+)
+from RLA.engine.state import (
+    Audit,
+    AuditContext,
+    AuditMixin,
+    ContestGroup,
+    GroupContext,
+    MemoryShuffledMixin,
+    ShuffledMixin,
+    StratifiedContext,
+    Stratum,
+    SubAudit,
+    SubAuditMixin,
+)
+from RLA.engine.strata import (
+    apply_strata_recount,
+    check_strata_status,
+    create_stratified_audit,
+    draw_strata_sample,
+    get_strata_sample_sizes,
+    init_strata_shuffled,
+)
+from RLA.engine.workflow import (
+    apply_recount,
+    check_status,
+    create_audit,
+    create_subaudits,
+    draw_sample,
+    get_round_schedule,
+    get_sample_size,
+    init_shuffled,
+)
+from RLA.engine.rounds import next_round_size, round_schedule, stopping_pairs
+from RLA.engine.simulation import run_trial, simulate
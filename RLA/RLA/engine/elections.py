@@ -0,0 +1,305 @@
+import functools
+
+import numpy as np
+
+from RLA import utils
+from RLA.engine.rounds import next_round_size
+from RLA.engine.state import SubAudit
+
+
+@functools.lru_cache(maxsize=256)
+def _dhondt_allocation(vote_count, n_seats, max_seats):
+    return utils.dhondt_allocation(dict(vote_count), n_seats, None if max_seats is None else dict(max_seats))
+
+
+def dhondt_allocation(vote_count, n_seats, max_seats=None):
+    """
+    Allocates the seats of a D'Hondt election, caching the result so it
+    is computed once per audit (and again only if its count changes).
+    The result is shared, so it must not be modified
+    @param vote_count   :   {dict<str->int>}
+                            Reported votes per party
+    @param n_seats      :   {int}
+                            Number of seats of the election
+    @param max_seats    :   {dict<str->int>}
+                            Maximum number of seats of each party, n_seats
+                            if None
+    @return             :   {tuple<list<tuple<str,int>>,list<tuple<str,int>>,dict<str->int>,dict<str->int>>}
+                            Allocation, as returned by utils.dhondt_allocation
+    """
+    return _dhondt_allocation(
+        tuple(vote_count.items()),
+        n_seats,
+        None if max_seats is None else tuple(sorted(max_seats.items()))
+    )
+
+
+class Plurality:
+    """
+    Simple majority election: the n_winners most voted candidates win.
+    The other election types override the transforms between the reported
+    counts and the contests checked by each subaudit
+    """
+
+    def transform_primary_count(self, audit, vote_count):
+        return vote_count
+
+    def transform_primary_recount(self, audit, vote_recount):
+        return vote_recount
+
+    def transform_secondary_count(self, audit, vote_count):
+        return vote_count
+
+    def transform_secondary_recount(self, audit, vote_recount):
+        return vote_recount
+
+    def comparison_table_transform(self, audit, vote_count):
+        return vote_count
+
+    def comparison_table_matrix(self, audit, store, table_counts):
+        """
+        Transforms the counts of several tables at once, as
+        comparison_table_transform does for one table
+        @param audit        :   {Audit}
+                                Audit of the tables
+        @param store        :   {CountStore}
+                                Preliminary count
+        @param table_counts :   {ndarray<int>}
+                                Tables x candidates matrix, with the
+                                candidates of the store as columns
+        @return             :   {tuple<list<str>,ndarray<int>>}
+                                Columns of the primary contest and the
+                                tables x columns matrix
+        """
+        return store.candidates.tolist(), table_counts
+
+    @staticmethod
+    def create_subaudit(audit, W, L, vote_count, identifier):
+        """
+        Creates a subaudit with every winner-loser contest not yet tested
+        @param audit        :   {Audit}
+                                Audit of the subaudit
+        @param W            :   {list<str>}
+                                Winners of the contest
+        @param L            :   {list<str>}
+                                Losers of the contest
+        @param vote_count   :   {dict<str->int>}
+                                Reported votes per candidate
+        @param identifier   :   {str}
+                                Identifier of the subaudit in the audit
+        @return             :   {SubAudit}
+                                New subaudit
+        """
+        if audit.audit_type == utils.BALLOT_POLLING:
+            T, log_T = None, {w: {l: 0.0 for l in L if w != l} for w in W}
+
+        else:  # audit.audit_type == utils.COMPARISON or audit.audit_type == utils.BALLOT_COMPARISON
+            T, log_T = 1.0, None
+
+        return SubAudit(identifier, vote_count, T, {w: 0 for w in W}, {l: 0 for l in L}, audit=audit, log_T=log_T)
+
+    def create_subaudits(self, audit, store):
+        """
+        Sets the reported count of a new audit and creates its subaudits
+        @param audit    :   {Audit}
+                            New audit
+        @param store    :   {CountStore}
+                            Preliminary count
+        @return         :   {list<SubAudit>}
+                            Subaudits of the audit, the primary one first
+        """
+        vote_count = store.candidate_totals().sort_values(ascending=False).to_dict()
+        audit.vote_count = vote_count
+        audit.accum_recount = {c: 0 for c in vote_count}
+        W = list(vote_count.keys())[:audit.n_winners]
+        L = list(vote_count.keys())[audit.n_winners:]
+        return [self.create_subaudit(audit, W, L, vote_count, utils.PRIMARY)]
+
+    def get_sample_size(self, context):
+        """
+        Estimates the number of ballots (or tables, for comparison audits)
+        to sample in the next round. Ballot polling rounds reach the
+        target stopping probability, see rounds.next_round_size
+        @param context  :   {AuditContext}
+                            Audit and its subaudits
+        @return         :   {int}
+                            Sample size for the next round
+        """
+        audit = context.audit
+        if audit.audit_type == utils.BALLOT_POLLING:
+            sample_size = next_round_size(self, context)
+
+        else:
+            sample_size = self._comparison_sample_size(context)
+
+        return min(sample_size, audit.remaining_shuffled())
+
+    def comparison_bounds(self, context):
+        """
+        Gets the upper bounds on the MICRO of a sampled unit, a table or a
+        single ballot for ballot comparison audits, and of the whole contest
+        @param context  :   {AuditContext}
+                            Audit and its subaudits
+        @return         :   {tuple<float,float>}
+                            Bound for a sampled unit and for the contest
+        """
+        audit = context.audit
+        primary_subaudit = context.primary
+        Wp, Lp = primary_subaudit.get_W_L()
+        reported = self.transform_primary_count(audit, primary_subaudit.vote_count)
+        u = utils.MICRO_upper_bound(reported, Wp, Lp, primary_subaudit.Sw, primary_subaudit.Sl)
+        store = audit.get_store()
+        if audit.audit_type == utils.BALLOT_COMPARISON:
+            return u, u * int(store.table_totals.sum())
+
+        um = u * store.table_totals.max()
+        return um, um * len(store.tables)
+
+    def _comparison_sample_size(self, context):
+        _, U = self.comparison_bounds(context)
+        return utils.comparison_sample_size(
+            U,
+            context.audit.risk_limit / context.primary.max_p_value
+        )
+
+    def get_party_seat_pairs(self, context):
+        """
+        Gets the winner and loser (candidate, seat) pairs of the primary
+        contest
+        @param context  :   {AuditContext}
+                            Audit and its subaudits
+        @return         :   {tuple<list<tuple<str,int>>,list<tuple<str,int>>>}
+                            Winner and loser pairs
+        """
+        Wp, Lp = context.primary.get_W_L()
+        W = [(c, 0) for c in Wp]
+        L = [(c, 0) for c in Lp]
+        return W, L
+
+
+class SuperMajority(Plurality):
+    """
+    Super majority election: the most voted candidate against all the
+    others together
+    """
+
+    def transform_primary_count(self, audit, vote_count):
+        candidates = list(audit.vote_count.keys())
+        winner = candidates[0]
+        grouped_count = {
+            'Winner': vote_count[winner],
+            'Losers': sum([vote_count[c] for c in vote_count if c != winner])
+        }
+        return grouped_count
+
+    def transform_primary_recount(self, audit, vote_recount):
+        return self.transform_primary_count(audit, vote_recount)
+
+    def comparison_table_transform(self, audit, vote_count):
+        return self.transform_primary_count(audit, vote_count)
+
+    def comparison_table_matrix(self, audit, store, table_counts):
+        winner = store.candidates.tolist().index(list(audit.vote_count.keys())[0])
+        winner_votes = table_counts[:, winner]
+        return ['Winner', 'Losers'], np.column_stack([winner_votes, table_counts.sum(axis=1) - winner_votes])
+
+    def create_subaudits(self, audit, store):
+        vote_count = store.candidate_totals().sort_values(ascending=False).to_dict()
+        audit.vote_count = vote_count
+        audit.accum_recount = {c: 0 for c in vote_count}
+        audit.n_winners = 1
+        return [self.create_subaudit(audit, ['Winner'], ['Losers'], vote_count, utils.PRIMARY)]
+
+
+class DHondt(Plurality):
+    """
+    D'Hondt election: seats are allocated to parties (primary subaudit)
+    and then to the candidates of each party (one secondary subaudit per
+    winning party)
+    """
+
+    def transform_primary_recount(self, audit, vote_recount):
+        store = audit.get_store()
+        party_votes = store.party_votes([vote_recount.get(c, 0) for c in store.candidates.tolist()])
+        return dict(zip(store.parties.tolist(), party_votes.tolist()))
+
+    def comparison_table_transform(self, audit, vote_count):
+        return self.transform_primary_recount(audit, vote_count)
+
+    def comparison_table_matrix(self, audit, store, table_counts):
+        return store.parties.tolist(), store.party_votes(table_counts)
+
+    def create_subaudits(self, audit, store):
+        vote_count = store.party_totals().sort_values(ascending=False).to_dict()
+        audit.vote_count = vote_count
+        audit.accum_recount = {p: 0 for p in vote_count}
+        _, _, Sw, Sl = dhondt_allocation(vote_count, audit.n_winners)
+        primary_subaudit = self.create_subaudit(audit, list(Sw), list(Sl), vote_count, utils.PRIMARY)
+        primary_subaudit.Sw.update(Sw)
+        primary_subaudit.Sl.update(Sl)
+
+        subaudits = [primary_subaudit]
+        for party in Sw:
+            party_count = store.party_candidate_totals(party).sort_values(ascending=False).to_dict()
+            candidates = list(party_count.keys())
+            W = candidates[:primary_subaudit.Sw[party] - 1]
+            L = candidates[primary_subaudit.Sw[party] - 1:]
+            subaudits.append(self.create_subaudit(audit, W, L, party_count, party))
+
+        return subaudits
+
+    def get_sample_size(self, context):
+        audit = context.audit
+        if audit.audit_type == utils.BALLOT_POLLING:
+            # The rounds already cover the pairs of the secondary subaudits
+            return next_round_size(self, context)
+
+        if audit.audit_type == utils.BALLOT_COMPARISON:
+            # Sampled ballots check every pair, of parties and of candidates
+            return super().get_sample_size(context)
+
+        primary_subaudit = context.primary
+        sample_size = min(self._comparison_sample_size(context), audit.remaining_shuffled())
+        for subaudit in context.secondaries:
+            if not subaudit.validated():
+                sample_size = max(
+                    sample_size,
+                    utils.ASN(
+                        audit.risk_limit / subaudit.max_p_value,
+                        subaudit.vote_count,
+                        subaudit.Sw,
+                        subaudit.Sl
+                    )
+                )
+
+        return min(sample_size, audit.remaining_shuffled()) * len(primary_subaudit.vote_count.keys())
+
+    def get_party_seat_pairs(self, context):
+        audit = context.audit
+        store = audit.get_store()
+        members_per_party = np.bincount(store.candidate_parties, minlength=len(store.parties))
+        members = dict(zip(store.parties.tolist(), members_per_party.tolist()))
+        W, _, Sw, _ = dhondt_allocation(audit.vote_count, audit.n_winners, members)
+        L = [
+            (p, i) for p in audit.vote_count if p
+            for i in range(Sw.get(p, -1) + 1, min(audit.n_winners, members[p]))
+        ]
+        return list(W), L
+
+
+ELECTIONS = {
+    utils.SIMPLE_MAJORITY: Plurality,
+    utils.SUPER_MAJORITY: SuperMajority,
+    utils.DHONDT: DHondt,
+}
+
+
+def get_election(election_type):
+    """
+    Gets the rules of an election type
+    @param election_type    :   {str}
+                                Election type
+    @return                 :   {Plurality}
+                                Election rules
+    """
+    return ELECTIONS[election_type]()
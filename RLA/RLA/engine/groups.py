@@ -0,0 +1,186 @@
+import math
+
+import numpy as np
+
+from RLA import utils
+from RLA.engine.workflow import apply_recount, check_status, get_sample_size
+from RLA.instrumentation import span
+
+
+def union_tables(stores):
+    """
+    Gets the tables of a group of contests on the same ballots, with the
+    number of ballots of each table (the largest count of any contest)
+    @param stores   :   {list<CountStore>}
+                        Preliminary count of each contest
+    @return         :   {tuple<ndarray,ndarray<int>>}
+                        Sorted union of the tables and ballots per table
+    """
+    tables = stores[0].tables
+    for store in stores[1:]:
+        tables = np.union1d(tables, store.tables)
+
+    table_sizes = np.zeros(len(tables), dtype=np.int64)
+    for store in stores:
+        np.maximum.at(table_sizes, np.searchsorted(tables, store.tables), store.table_totals)
+
+    return tables, table_sizes
+
+
+def contest_ordinals(ordinals, tables, table_sizes, store):
+    """
+    Maps group ballot ordinals to the ballot ordinals of a contest. Ballots
+    of tables the contest does not have, or beyond its count of the table,
+    are skipped, so the contest gets a uniform sample of its own ballots
+    @param ordinals     :   {ndarray<int>}
+                            Group ballot ordinals
+    @param tables       :   {ndarray}
+                            Tables of the group
+    @param table_sizes  :   {ndarray<int>}
+                            Ballots per table of the group
+    @param store        :   {CountStore}
+                            Preliminary count of the contest
+    @return             :   {tuple<ndarray<int>,ndarray<int>>}
+                            Position in ordinals of the ballots kept and
+                            their ballot ordinal in the contest
+    """
+    table_codes = np.full(len(tables), -1, dtype=np.int64)
+    table_codes[np.searchsorted(tables, store.tables)] = np.arange(len(store.tables))
+    group_tables, ballots = utils.ballot_positions(ordinals, table_sizes)
+    codes = table_codes[group_tables]
+    kept = codes >= 0
+    kept[kept] = ballots[kept] < store.table_totals[codes[kept]]
+    starts = np.cumsum(store.table_totals) - store.table_totals
+    return np.flatnonzero(kept), starts[codes[kept]] + ballots[kept]
+
+
+def _group_tables(group_context):
+    return union_tables([context.audit.get_store() for context in group_context.contexts.values()])
+
+
+def init_group_shuffled(group_context, seed, progress=None):
+    """
+    Draws the shared shuffled sample of a group of ballot polling audits,
+    and the shuffled sample of each contest from it. The shared sample is
+    large enough for the contest that needs the most group ballots to
+    reach its own sample size
+    @param group_context    :   {GroupContext}
+                                Group and the contexts of its contests
+    @param seed             :   {str}
+                                Random seed, in hexadecimal
+    @param progress         :   {callable}
+                                Called with the fraction of the sample drawn
+    """
+    tables, table_sizes = _group_tables(group_context)
+    population_size = int(table_sizes.sum())
+    sample_sizes = {}
+    ratio = 0
+    for name, context in group_context.contexts.items():
+        audit = context.audit
+        ballots = int(audit.get_store().table_totals.sum())
+        sample_sizes[name] = min(audit.max_polls, ballots)
+        ratio = max(ratio, sample_sizes[name] / ballots if ballots else 0)
+
+    sample_size = math.ceil(ratio * population_size * utils.GROUP_SAMPLE_SLACK)
+    with span('random_indices', rows=sample_size):
+        shuffled = utils.random_indices(population_size, sample_size, seed=seed, progress=progress)
+
+    group = group_context.group
+    group.random_seed = seed
+    with span('save_shuffled'):
+        group.set_shuffled(shuffled)
+        for name, context in group_context.contexts.items():
+            audit = context.audit
+            _, ordinals = contest_ordinals(shuffled, tables, table_sizes, audit.get_store())
+            audit.random_seed = seed
+            audit.set_shuffled(ordinals[:sample_sizes[name]])
+
+
+def _contest_positions(group_context, tables, table_sizes):
+    group = group_context.group
+    shuffled = group.get_shuffled(group.shuffled_size, start=0)
+    return {
+        name: contest_ordinals(shuffled, tables, table_sizes, context.audit.get_store())[0]
+        for name, context in group_context.contexts.items()
+    }
+
+
+def get_group_sample_size(group_context):
+    """
+    Estimates the number of group ballots of the next round: enough for
+    every contest in progress to reach its own sample size
+    @param group_context    :   {GroupContext}
+                                Group and the contexts of its contests
+    @return                 :   {int}
+                                Number of ballots of the shared sample
+    """
+    group = group_context.group
+    tables, table_sizes = _group_tables(group_context)
+    positions = _contest_positions(group_context, tables, table_sizes)
+    end = group.shuffled_offset
+    for name, context in group_context.contexts.items():
+        audit = context.audit
+        if not audit.in_progress:
+            continue
+
+        sample_size = min(get_sample_size(context), audit.remaining_shuffled())
+        if sample_size > 0:
+            end = max(end, int(positions[name][audit.shuffled_offset + sample_size - 1]) + 1)
+
+    return end - group.shuffled_offset
+
+
+def draw_group_sample(group_context, sample_size):
+    """
+    Draws the next shared sample of the group, without consuming it
+    @param group_context    :   {GroupContext}
+                                Group and the contexts of its contests
+    @param sample_size      :   {int}
+                                Number of ballots of the shared sample
+    @return                 :   {dict<str->str>}
+                                Ballots to recount per table
+    """
+    tables, table_sizes = _group_tables(group_context)
+    table_codes, ballots = utils.ballot_positions(group_context.group.get_shuffled(sample_size), table_sizes)
+    return utils.group_ballots(tables[table_codes].tolist(), [str(ballot) for ballot in ballots.tolist()])
+
+
+def apply_group_recount(group_context, recounts, sample_size):
+    """
+    Applies the recount of a shared sample to every contest in progress,
+    consuming the sample of the group and of each contest
+    @param group_context    :   {GroupContext}
+                                Group and the contexts of its contests
+    @param recounts         :   {dict<str->DataFrame>}
+                                Recounted votes of each contest, with table,
+                                candidate, votes and party (for D'Hondt
+                                elections) columns
+    @param sample_size      :   {int}
+                                Number of ballots of the shared sample
+    """
+    group = group_context.group
+    active = {name for name, context in group_context.contexts.items() if context.audit.in_progress}
+    if set(recounts) != active:
+        raise ValueError(f'Expected the recount of the contests: {", ".join(sorted(active))}')
+
+    tables, table_sizes = _group_tables(group_context)
+    positions = _contest_positions(group_context, tables, table_sizes)
+    end = min(group.shuffled_offset + sample_size, group.shuffled_size)
+    for name in sorted(active):
+        context = group_context.contexts[name]
+        apply_recount(context, recounts[name])
+        context.audit.shuffled_offset = min(int(np.searchsorted(positions[name], end)), context.audit.shuffled_size)
+
+    group.shuffled_offset = end
+
+
+def check_group_status(group_context):
+    """
+    Updates whether each contest of the group is validated and still in
+    progress
+    @param group_context    :   {GroupContext}
+                                Group and the contexts of its contests
+    @return                 :   {bool}
+                                True if every contest is validated, else False
+    """
+    return all([check_status(context) for context in group_context.contexts.values()])
@@ -0,0 +1,80 @@
+import functools
+import math
+
+from RLA import utils
+
+
+@functools.lru_cache(maxsize=256)
+def _round_size(pairs, log_threshold, target, max_size):
+    return utils.round_size(pairs, log_threshold, target, max_size)
+
+
+def stopping_pairs(election, context):
+    """
+    Gets the winner-loser pairs of a ballot polling audit not yet
+    validated, with the state of their SPRT and the probability of a
+    ballot for each side under the reported count
+    @param election :   {Plurality}
+                        Rules of the election of the audit
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @return         :   {tuple<tuple<float,float,float,float,float>>}
+                        log_T, p_w, p_l, z_w and z_l of each pair, as taken
+                        by utils.stopping_probability
+    """
+    audit = context.audit
+    threshold = math.log(1 / audit.risk_limit)
+    primary_count = election.transform_primary_count(audit, context.primary.vote_count)
+    ballots = sum(primary_count.values())
+    counts = [(context.primary, primary_count)] + [
+        (subaudit, election.transform_secondary_count(audit, subaudit.vote_count)) for subaudit in context.secondaries
+    ]
+    pairs = []
+    for subaudit, vote_count in counts:
+        for winner, losers in subaudit.log_T.items():
+            for loser, log_T in losers.items():
+                if log_T >= threshold:
+                    continue
+
+                p_w = vote_count[winner] / ballots
+                p_l = vote_count[loser] / ballots
+                z_w = math.log(utils.gamma(winner, loser, subaudit.Sw, subaudit.Sl, vote_count)) if p_w else 0.0
+                z_l = math.log(utils.gamma(loser, winner, subaudit.Sl, subaudit.Sw, vote_count)) if p_l else 0.0
+                pairs.append((log_T, p_w, p_l, z_w, z_l))
+
+    return tuple(pairs)
+
+
+def next_round_size(election, context, target=utils.ROUND_STOPPING_PROBABILITY):
+    """
+    Gets the number of ballots of the next round of a ballot polling
+    audit: the smallest that validates it with the target probability,
+    if the reported count is right. Cached per audit state
+    @param election :   {Plurality}
+                        Rules of the election of the audit
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @param target   :   {float}
+                        Target stopping probability
+    @return         :   {int}
+                        Number of ballots of the next round
+    """
+    audit = context.audit
+    pairs = stopping_pairs(election, context)
+    return _round_size(pairs, math.log(1 / audit.risk_limit), target, audit.remaining_shuffled())
+
+
+def round_schedule(election, context, targets=utils.ROUND_SCHEDULE_PROBABILITIES):
+    """
+    Gets the size of the next round of a ballot polling audit for several
+    stopping probabilities
+    @param election :   {Plurality}
+                        Rules of the election of the audit
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @param targets  :   {tuple<float>}
+                        Stopping probabilities
+    @return         :   {list<tuple<float,int>>}
+                        Stopping probability and number of ballots
+    """
+    return [(target, next_round_size(election, context, target=target)) for target in targets]
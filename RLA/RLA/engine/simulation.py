@@ -0,0 +1,279 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from RLA import utils
+from RLA.engine.workflow import apply_recount, check_status, create_audit, get_sample_size, init_shuffled
+
+DEFAULT_QUANTILES = (0.5, 0.9, 0.99)
+
+_worker_store = None
+
+
+def trial_seed(seed, trial):
+    """
+    Derives the random seed of a trial, so every trial can be replayed
+    on its own
+    @param seed     :   {str}
+                        Seed of the simulation
+    @param trial    :   {int}
+                        Trial number
+    @return         :   {str}
+                        Seed of the trial, in hexadecimal
+    """
+    return hashlib.sha512(f'{seed}:{trial}'.encode()).hexdigest()
+
+
+def perturb_count(vote_matrix, error_rate, rng):
+    """
+    Builds a true count from the reported one, where each reported vote was
+    cast for another candidate (chosen uniformly) with probability error_rate
+    @param vote_matrix  :   {ndarray<int>}
+                            Reported table x candidate count
+    @param error_rate   :   {float}
+                            Probability that a reported vote is wrong
+    @param rng          :   {Generator}
+                            Random generator of the trial
+    @return             :   {ndarray<int>}
+                            True table x candidate count
+    """
+    n_candidates = vote_matrix.shape[1]
+    if not error_rate or n_candidates < 2:
+        return vote_matrix.copy()
+
+    errors = rng.binomial(vote_matrix, error_rate)
+    true_count = vote_matrix - errors
+    for c in range(n_candidates):
+        pvals = np.full(n_candidates, 1 / (n_candidates - 1))
+        pvals[c] = 0
+        true_count += rng.multinomial(errors[:, c], pvals)
+
+    return true_count
+
+
+def perturb_ballots(ballot_candidates, n_candidates, error_rate, rng):
+    """
+    Builds the true vote of each ballot from its cast vote record, which
+    was recorded for another candidate (chosen uniformly) with probability
+    error_rate
+    @param ballot_candidates    :   {ndarray<int>}
+                                    Recorded candidate of each ballot
+    @param n_candidates         :   {int}
+                                    Number of candidates
+    @param error_rate           :   {float}
+                                    Probability that a recorded vote is wrong
+    @param rng                  :   {Generator}
+                                    Random generator of the trial
+    @return                     :   {ndarray<int>}
+                                    True candidate of each ballot
+    """
+    true_candidates = ballot_candidates.copy()
+    if not error_rate or n_candidates < 2:
+        return true_candidates
+
+    wrong = rng.random(len(ballot_candidates)) < error_rate
+    shifts = rng.integers(1, n_candidates, size=int(wrong.sum()))
+    true_candidates[wrong] = (true_candidates[wrong] + shifts) % n_candidates
+    return true_candidates
+
+
+def _cvr_recount_df(store, ordinals, candidate_codes):
+    """
+    Builds the recount of sampled ballots, like the ones uploaded
+    @param store            :   {CVRStore}
+                                Cast vote records
+    @param ordinals         :   {ndarray<int>}
+                                Ordinal of each recounted ballot
+    @param candidate_codes  :   {ndarray<int>}
+                                Recounted candidate of each ballot
+    @return                 :   {DataFrame}
+                                Recount, with table, ballot, candidate,
+                                votes and party (if present) columns
+    """
+    columns = {
+        'table': store.tables[store.ballot_tables[ordinals]],
+        'ballot': store.ballot_ids[ordinals],
+        'candidate': store.candidates[candidate_codes],
+    }
+    if store.has_parties:
+        columns['party'] = store.parties[store.candidate_parties[candidate_codes]]
+
+    columns['votes'] = np.ones(len(ordinals), dtype=np.int64)
+    return pd.DataFrame(columns)
+
+
+def _recount_df(store, table_codes, recount):
+    """
+    Builds a recount dataframe, like the ones uploaded, from a matrix
+    @param store        :   {CountStore}
+                            Preliminary count
+    @param table_codes  :   {ndarray<int>}
+                            Rows of the recounted tables in the store
+    @param recount      :   {ndarray<int>}
+                            Recounted table x candidate count
+    @return             :   {DataFrame}
+                            Recount, with table, candidate, votes and party
+                            (if present) columns
+    """
+    rows, candidate_codes = np.indices(recount.shape).reshape(2, -1)
+    columns = {
+        'table': store.tables[table_codes[rows]],
+        'candidate': store.candidates[candidate_codes],
+    }
+    if store.has_parties:
+        columns['party'] = store.parties[store.candidate_parties[candidate_codes]]
+
+    columns['votes'] = recount.ravel()
+    return pd.DataFrame(columns)
+
+
+def run_trial(store, election_type, audit_type, risk_limit, n_winners, max_polls, error_rate, seed, max_rounds):
+    """
+    Runs an audit against synthetic recounts until it is validated, reaches
+    the maximum number of ballots or exhausts its sample
+    @param store            :   {CountStore}
+                                Preliminary count, a CVRStore for ballot
+                                comparison audits
+    @param election_type    :   {str}
+                                Election type
+    @param audit_type       :   {str}
+                                Audit type
+    @param risk_limit       :   {float}
+                                Risk limit of the audit
+    @param n_winners        :   {int}
+                                Number of winners (seats)
+    @param max_polls        :   {int}
+                                Maximum number of ballots to recount
+    @param error_rate       :   {float}
+                                Probability that a reported vote is wrong
+    @param seed             :   {str}
+                                Seed of the trial, in hexadecimal
+    @param max_rounds       :   {int}
+                                Maximum number of rounds
+    @return                 :   {tuple<int,int,int,bool>}
+                                Ballots recounted, tables visited, rounds
+                                and whether the audit was validated
+    """
+    rng = np.random.default_rng(int(seed[:32], 16))
+    if audit_type == utils.BALLOT_COMPARISON:
+        true_candidates = perturb_ballots(store.ballot_candidates, len(store.candidates), error_rate, rng)
+
+    else:
+        true_count = perturb_count(store.vote_matrix, error_rate, rng)
+
+    context = create_audit(store, election_type, audit_type, risk_limit, n_winners, max_polls)
+    audit = context.audit
+    init_shuffled(context, seed)
+    visited = np.zeros(len(store.tables), dtype=bool)
+    rounds = 0
+    while audit.in_progress and rounds < max_rounds:
+        sample_size = get_sample_size(context)
+        if sample_size <= 0:
+            break
+
+        sample = audit.get_shuffled(sample_size)
+        if audit_type == utils.BALLOT_POLLING:
+            table_codes, _ = utils.ballot_positions(sample, store.table_totals)
+            ballots = np.bincount(table_codes, minlength=len(store.tables))
+            table_codes = np.flatnonzero(ballots)
+            tables = true_count[table_codes]
+            recount = rng.multinomial(ballots[table_codes], tables / tables.sum(axis=1, keepdims=True))
+            recount_df = _recount_df(store, table_codes, recount)
+
+        elif audit_type == utils.BALLOT_COMPARISON:
+            table_codes = np.unique(store.ballot_tables[sample])
+            recount_df = _cvr_recount_df(store, sample, true_candidates[sample])
+
+        else:  # audit_type == utils.COMPARISON
+            table_codes = np.unique(sample)
+            recount_df = _recount_df(store, table_codes, true_count[table_codes])
+
+        visited[table_codes] = True
+        apply_recount(context, recount_df)
+        check_status(context)
+        rounds += 1
+
+    return audit.polled_ballots, int(visited.sum()), rounds, bool(audit.validated)
+
+
+def _init_worker(store):
+    global _worker_store
+    _worker_store = store
+
+
+def _run_trials(args):
+    trials, seed, options = args
+    return [run_trial(_worker_store, seed=trial_seed(seed, trial), **options) for trial in trials]
+
+
+def simulate(store, election_type, audit_type, risk_limit, n_winners=1, max_polls=None, error_rate=0.0, trials=1000,
+             workers=None, seed='', max_rounds=100, quantiles=DEFAULT_QUANTILES):
+    """
+    Estimates the distribution of the workload of an audit, replaying it
+    against synthetic recounts generated from the preliminary count. Each
+    trial has its own seed, derived from the simulation seed, so the
+    results do not depend on the number of workers
+    @param store            :   {CountStore}
+                                Preliminary count
+    @param election_type    :   {str}
+                                Election type
+    @param audit_type       :   {str}
+                                Audit type
+    @param risk_limit       :   {float}
+                                Risk limit of the audit
+    @param n_winners        :   {int}
+                                Number of winners (seats)
+    @param max_polls        :   {int}
+                                Maximum number of ballots to recount, all
+                                of them if None
+    @param error_rate       :   {float}
+                                Probability that a reported vote is wrong
+    @param trials           :   {int}
+                                Number of audits simulated
+    @param workers          :   {int}
+                                Number of worker processes, one per CPU if
+                                None, or in process if 1
+    @param seed             :   {str}
+                                Seed of the simulation
+    @param max_rounds       :   {int}
+                                Maximum number of rounds per audit
+    @param quantiles        :   {tuple<float>}
+                                Quantiles reported
+    @return                 :   {dict}
+                                Fraction of validated audits and quantiles of
+                                the ballots, tables and rounds per audit
+    """
+    if trials < 1:
+        raise ValueError(f'At least one trial is needed, got {trials}')
+
+    options = {
+        'election_type': election_type,
+        'audit_type': audit_type,
+        'risk_limit': risk_limit,
+        'n_winners': n_winners,
+        'max_polls': max_polls,
+        'error_rate': error_rate,
+        'max_rounds': max_rounds,
+    }
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_worker(store)
+        results = _run_trials((range(trials), seed, options))
+
+    else:
+        n_chunks = min(4 * workers, trials)
+        chunks = [(range(start, trials, n_chunks), seed, options) for start in range(n_chunks)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(store,)) as executor:
+            results = [result for chunk in executor.map(_run_trials, chunks) for result in chunk]
+
+    ballots, tables, rounds, validated = (np.array(values) for values in zip(*results))
+    return {
+        'trials': trials,
+        'validated': float(validated.mean()),
+        'ballots': {q: float(np.quantile(ballots, q)) for q in quantiles},
+        'tables': {q: float(np.quantile(tables, q)) for q in quantiles},
+        'rounds': {q: float(np.quantile(rounds, q)) for q in quantiles},
+    }
@@ -0,0 +1,286 @@
+import numpy as np
+
+from RLA import utils
+
+
+class ShuffledMixin:
+    """
+    Consumption of a shuffled sample, shared by audits and contest groups,
+    in memory or stored in the database
+    """
+
+    def remaining_shuffled(self):
+        return self.shuffled_size - self.shuffled_offset
+
+    def consume_shuffled(self, size):
+        self.shuffled_offset = min(self.shuffled_offset + size, self.shuffled_size)
+
+
+class MemoryShuffledMixin(ShuffledMixin):
+    """
+    Shuffled sample kept in memory
+    """
+
+    def set_shuffled(self, ordinals, save=True):
+        self.shuffled = np.asarray(ordinals, dtype=np.int64)
+        self.shuffled_size = len(ordinals)
+        self.shuffled_offset = 0
+
+    def clear_shuffled(self, save=True):
+        self.shuffled = None
+        self.shuffled_size = 0
+        self.shuffled_offset = 0
+
+    def get_shuffled(self, size=None, start=None):
+        if self.shuffled is None:
+            return np.empty(0, dtype=np.int64)
+
+        if start is None:
+            start = self.shuffled_offset
+
+        if size is None:
+            size = self.shuffled_size - start
+
+        return self.shuffled[start:start + size].copy()
+
+
+class AuditMixin(ShuffledMixin):
+    """
+    Recount bookkeeping shared by the in-memory audits of the engine and
+    the audits stored in the database
+    """
+
+    def _update_accum_recounted(self, recount, save=True):
+        for c in recount:
+            self.accum_recount[c] += recount[c]
+
+        if save:
+            self.save()
+
+    def get_grouped(self, df):
+        if self.election_type == utils.DHONDT:
+            group = df.groupby('party')
+
+        else:  # self.election_type == utils.SIMPLE_MAJORITY or self.election_type == utils.SUPER_MAJORITY
+            group = df.groupby('candidate')
+
+        return group.sum()['votes'].sort_values(ascending=False).to_dict()
+
+    def add_polled_ballots(self, recount_df, save=True, consume=True):
+        vote_recount = self.get_grouped(recount_df)
+        self._update_accum_recounted(vote_recount, save=False)
+        self.polled_ballots += sum(vote_recount.values())
+
+        if consume:
+            if self.audit_type == utils.COMPARISON:
+                consumed = len(recount_df['table'].unique())
+
+            else:  # ballots, for ballot polling and ballot comparison audits
+                consumed = sum(vote_recount.values())
+
+            self.consume_shuffled(consumed)
+
+        if save:
+            self.save()
+
+
+class SubAuditMixin:
+    """
+    Risk checks shared by the in-memory subaudits of the engine and the
+    subaudits stored in the database
+    """
+
+    def validated(self):
+        if self.audit.audit_type == utils.BALLOT_POLLING:
+            return utils.log_validated(self.log_T, self.audit.risk_limit)
+
+        else:  # self.audit.audit_type == utils.COMPARISON or self.audit.audit_type == utils.BALLOT_COMPARISON
+            return self.T >= 1 / self.audit.risk_limit
+
+    def get_W_L(self):
+        W = [p for p in self.Sw]
+        L = [p for p in self.Sl if p not in W]
+        return W, L
+
+
+class Audit(MemoryShuffledMixin, AuditMixin):
+    """
+    In-memory audit, with the same attributes as the stored one, over a
+    vote count store and a shuffled sample kept in memory
+    """
+
+    def __init__(self, store, election_type, audit_type, risk_limit, n_winners=1, max_polls=None):
+        self.store = store
+        self.election_type = election_type
+        self.audit_type = audit_type
+        self.risk_limit = risk_limit
+        self.n_winners = n_winners
+        self.max_polls = max_polls if max_polls is not None else int(store.table_totals.sum())
+        self.polled_ballots = 0
+        self.vote_count = {}
+        self.accum_recount = {}
+        self.max_p_value = 1
+        self.validated = False
+        self.in_progress = True
+        self.random_seed = None
+        self.shuffled = None
+        self.shuffled_size = 0
+        self.shuffled_offset = 0
+        self.round_size = 0
+        self.round_tables = set()
+
+    def save(self):
+        pass
+
+    def get_store(self):
+        return self.store
+
+    def is_initialized(self):
+        return self.shuffled is not None
+
+
+class SubAudit(SubAuditMixin):
+    """
+    In-memory subaudit: one contest of the audit with its test statistics
+    """
+
+    def __init__(self, identifier, vote_count, T, Sw, Sl, audit=None, log_T=None):
+        self.identifier = identifier
+        self.audit = audit
+        self.vote_count = vote_count
+        self.T = T
+        self.log_T = log_T
+        self.Sw = Sw
+        self.Sl = Sl
+        self.max_p_value = 1
+
+
+class AuditContext:
+    """
+    Audit together with its subaudits, the state every engine operation
+    works on. With verify_exact, every ballot polling SPRT update is
+    checked against the same update in Decimal arithmetic
+    """
+    verify_exact = False
+
+    def __init__(self, audit, subaudits):
+        self.audit = audit
+        self.subaudits = subaudits
+        for subaudit in subaudits:
+            subaudit.audit = audit
+
+    @property
+    def primary(self):
+        return next(subaudit for subaudit in self.subaudits if subaudit.identifier == utils.PRIMARY)
+
+    @property
+    def secondaries(self):
+        return [subaudit for subaudit in self.subaudits if subaudit.identifier != utils.PRIMARY]
+
+    def is_validated(self):
+        return all(subaudit.validated() for subaudit in self.subaudits)
+
+    def memoize(self, name, compute):
+        """
+        Gets an estimate that only depends on the state of the audit, like
+        the size of the next round. In memory it is always computed again
+        @param name     :   {str}
+                            Name of the estimate
+        @param compute  :   {callable}
+                            Computes the estimate
+        @return         :   {object}
+                            Estimate
+        """
+        return compute()
+
+    def save(self):
+        pass
+
+
+class ContestGroup(MemoryShuffledMixin):
+    """
+    In-memory group of contests on the same ballots, audited with a
+    shared shuffled sample of the ballots of all their tables
+    """
+
+    def __init__(self):
+        self.random_seed = None
+        self.shuffled = None
+        self.shuffled_size = 0
+        self.shuffled_offset = 0
+
+    def save(self):
+        pass
+
+
+class GroupContext:
+    """
+    Contest group together with the context of each of its contests
+    """
+
+    def __init__(self, group, contexts):
+        self.group = group
+        self.contexts = contexts
+
+    def in_progress(self):
+        return any(context.audit.in_progress for context in self.contexts.values())
+
+    def save(self):
+        pass
+
+
+class Stratum(MemoryShuffledMixin, AuditMixin):
+    """
+    In-memory stratum of a stratified audit: part of the tables, with its
+    own audit type, shuffled sample and p-value for each pair of the
+    contest and each share of the margin
+    """
+
+    def __init__(self, name, store, election_type, audit_type, max_polls):
+        self.name = name
+        self.store = store
+        self.election_type = election_type
+        self.audit_type = audit_type
+        self.max_polls = max_polls
+        self.polled_ballots = 0
+        labels = store.parties if election_type == utils.DHONDT and store.has_parties else store.candidates
+        self.accum_recount = {label: 0 for label in labels.tolist()}
+        self.candidate_codes = None
+        self.reported = None
+        self.recounted = None
+        self.um = None
+        self.U = None
+        self.log_factors = None
+        self.p_values = None
+        self.random_seed = None
+        self.shuffled = None
+        self.shuffled_size = 0
+        self.shuffled_offset = 0
+
+    def save(self):
+        pass
+
+    def get_store(self):
+        return self.store
+
+
+class StratifiedContext:
+    """
+    Audit of a contest split in strata, together with the winner-loser
+    pairs every stratum tests: the weight of a vote for each candidate in
+    the margin of the pair, and the margin in the whole contest
+    """
+
+    def __init__(self, context, strata, pairs, coefficients, margins):
+        self.context = context
+        self.strata = strata
+        self.pairs = pairs
+        self.coefficients = coefficients
+        self.margins = margins
+
+    @property
+    def audit(self):
+        return self.context.audit
+
+    def save(self):
+        pass
@@ -0,0 +1,480 @@
+import hashlib
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from RLA import utils
+from RLA.engine.elections import get_election
+from RLA.engine.state import Stratum, StratifiedContext
+from RLA.engine.workflow import create_audit
+from RLA.instrumentation import span
+
+STRATUM_AUDIT_TYPES = (utils.BALLOT_POLLING, utils.COMPARISON, utils.BALLOT_COMPARISON)
+
+
+def stratum_seed(seed, name):
+    """
+    Derives the random seed of a stratum, so every stratum draws its own
+    sample
+    @param seed :   {str}
+                    Seed of the audit
+    @param name :   {str}
+                    Name of the stratum
+    @return     :   {str}
+                    Seed of the stratum, in hexadecimal
+    """
+    return hashlib.sha512(f'{seed}:{name}'.encode()).hexdigest()
+
+
+def contest_pairs(context):
+    """
+    Gets the winner-loser pairs of a contest as linear functions of the
+    votes per candidate: the margin of a pair is the sum of the votes for
+    each candidate times its coefficient. Pairs of parties weigh the votes
+    with the divisor of the seat of the other party, like MICRO does
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @return         :   {tuple<list<tuple>,ndarray<float>,ndarray<float>>}
+                        Winner and loser of each pair, pairs x candidates
+                        coefficients and reported margin of each pair
+    """
+    audit = context.audit
+    election = get_election(audit.election_type)
+    store = audit.get_store()
+    n_candidates = len(store.candidates)
+    columns, column_matrix = election.comparison_table_matrix(audit, store, np.eye(n_candidates, dtype=np.int64))
+    index = {c: i for i, c in enumerate(columns)}
+    pairs = []
+    coefficients = []
+    W, L = election.get_party_seat_pairs(context)
+    for w, sw in W:
+        for l, sl in L:
+            if w != l:
+                pairs.append((w, l))
+                coefficients.append(utils.d(sl) * column_matrix[:, index[w]] - utils.d(sw) * column_matrix[:, index[l]])
+
+    candidate_index = {c: i for i, c in enumerate(store.candidates.tolist())}
+    for subaudit in context.secondaries:
+        Wp, Lp = subaudit.get_W_L()
+        for w in Wp:
+            for l in Lp:
+                if w != l:
+                    pairs.append((w, l))
+                    row = np.zeros(n_candidates)
+                    row[candidate_index[w]] = 1
+                    row[candidate_index[l]] = -1
+                    coefficients.append(row)
+
+    coefficients = np.array(coefficients, dtype=float).reshape(-1, n_candidates)
+    return pairs, coefficients, coefficients @ store.vote_matrix.sum(axis=0)
+
+
+def _candidate_codes(store, candidates):
+    codes = np.searchsorted(store.candidates, candidates)
+    codes = np.minimum(codes, len(store.candidates) - 1)
+    if len(codes) and (store.candidates[codes] != candidates).any():
+        raise ValueError('Unknown candidates: ' + ', '.join(sorted(set(candidates) - set(store.candidates.tolist()))))
+
+    return codes
+
+
+def _pair_weights(coefficients):
+    # Weight of a vote for the winner and for the loser of each pair
+    winners = np.where(coefficients > 0, coefficients, 0).max(axis=1, initial=0)
+    losers = np.where(coefficients < 0, -coefficients, 0).max(axis=1, initial=0)
+    return winners, losers
+
+
+def create_stratified_audit(store, election_type, risk_limit, strata, n_winners=1, max_polls=None):
+    """
+    Creates an in-memory stratified audit over a preliminary count. Every
+    table belongs to exactly one stratum, audited by ballot polling or
+    comparison of its tables, or by ballot comparison of its cast vote
+    records, which must add up to the count of its tables
+    @param store            :   {CountStore}
+                                Preliminary count of the whole contest
+    @param election_type    :   {str}
+                                Election type
+    @param risk_limit       :   {float}
+                                Maximum p-value accepted to validate the election
+    @param strata           :   {dict<str->tuple<str,object>>}
+                                Audit type of each stratum, with its tables
+                                or, for ballot comparison, its CVRStore
+    @param n_winners        :   {int}
+                                Number of winners (seats) of the election
+    @param max_polls        :   {int}
+                                Maximum number of ballots to recount in each
+                                stratum, all of them if None
+    @return                 :   {StratifiedContext}
+                                New audit with its strata
+    """
+    context = create_audit(store, election_type, utils.STRATIFIED, risk_limit, n_winners, max_polls)
+    audit = context.audit
+    pairs, coefficients, margins = contest_pairs(context)
+    winners, losers = _pair_weights(coefficients)
+    bound = ((winners + losers) / np.maximum(margins, 1)).max(initial=0)
+    allocations = np.linspace(0, 1, utils.STRATUM_ALLOCATION_STEPS + 1)
+    seen = np.zeros(len(store.tables), dtype=np.int64)
+    stratum_objects = {}
+    for name, (audit_type, source) in strata.items():
+        if audit_type not in STRATUM_AUDIT_TYPES:
+            raise ValueError(f'Stratum {name} has an unknown audit type: {audit_type}')
+
+        if audit_type == utils.BALLOT_COMPARISON:
+            table_codes = np.array([store.table_index.get(table, -1) for table in source.tables.tolist()], dtype=np.int64)
+            candidate_codes = _candidate_codes(store, source.candidates)
+            stratum_store = source
+
+        else:
+            table_codes = np.array([store.table_index.get(table, -1) for table in source], dtype=np.int64)
+            candidate_codes = np.arange(len(store.candidates))
+            stratum_store = store.subset(table_codes[table_codes >= 0])
+
+        if (table_codes < 0).any():
+            raise ValueError(f'Stratum {name} has tables outside the preliminary count')
+
+        seen[table_codes] += 1
+        stratum = Stratum(name, stratum_store, election_type, audit_type, audit.max_polls)
+        stratum.candidate_codes = candidate_codes
+        table_counts = np.zeros((len(stratum_store.tables), len(store.candidates)), dtype=np.int64)
+        table_counts[:, candidate_codes] = stratum_store.vote_matrix
+        if audit_type == utils.BALLOT_COMPARISON and (table_counts != store.vote_matrix[table_codes]).any():
+            raise ValueError(f'The cast vote records of stratum {name} do not match the preliminary count')
+
+        stratum.reported = table_counts.sum(axis=0)
+        stratum.recounted = np.zeros(len(store.candidates), dtype=np.int64)
+        if audit_type == utils.BALLOT_POLLING:
+            stratum.p_values = utils.polling_stratum_p_values(
+                stratum.reported, stratum.recounted, coefficients, margins, allocations
+            )
+
+        else:
+            units = len(stratum_store.ballot_ids) if audit_type == utils.BALLOT_COMPARISON else len(stratum_store.tables)
+            unit_size = 1 if audit_type == utils.BALLOT_COMPARISON else int(stratum_store.table_totals.max(initial=0))
+            stratum.um = bound * unit_size
+            stratum.U = stratum.um * units
+            stratum.log_factors = np.zeros((len(pairs), len(allocations)))
+            stratum.p_values = utils.comparison_stratum_p_values(stratum.log_factors, stratum.U, allocations)
+
+        stratum_objects[name] = stratum
+
+    if (seen != 1).any():
+        raise ValueError('Every table must belong to exactly one stratum')
+
+    return StratifiedContext(context, stratum_objects, pairs, coefficients, margins)
+
+
+def _table_error_bounds(stratified, stratum):
+    # Largest overstatement of each table for any pair, in MICRO units:
+    # every ballot of the table turned into a vote for the loser
+    counts = stratum.store.vote_matrix.astype(float)
+    coefficients = stratified.coefficients[:, stratum.candidate_codes]
+    _, losers = _pair_weights(coefficients)
+    bounds = (counts @ coefficients.T + np.outer(counts.sum(axis=1), losers)) / np.maximum(stratified.margins, 1)
+    return bounds.max(axis=1, initial=0)
+
+
+def init_strata_shuffled(stratified, seed, progress=None):
+    """
+    Draws the shuffled sample of every stratum, with the sampler of its
+    audit type: ballot ordinals for ballot polling and ballot comparison
+    strata, or table ordinals weighted by their error bound for comparison
+    strata
+    @param stratified   :   {StratifiedContext}
+                            Audit and its strata
+    @param seed         :   {str}
+                            Random seed, in hexadecimal
+    @param progress     :   {callable}
+                            Called with the fraction of the strata drawn
+    """
+    audit = stratified.audit
+    for i, (name, stratum) in enumerate(stratified.strata.items()):
+        store = stratum.get_store()
+        if stratum.audit_type == utils.BALLOT_POLLING:
+            population_size = int(store.table_totals.sum())
+            sample_size = min(stratum.max_polls, population_size)
+            weights = None
+
+        elif stratum.audit_type == utils.BALLOT_COMPARISON:
+            population_size = len(store.ballot_ids)
+            sample_size = min(stratum.max_polls, population_size)
+            weights = None
+
+        else:  # stratum.audit_type == utils.COMPARISON
+            population_size = len(store.tables)
+            sample_size = population_size
+            weights = _table_error_bounds(stratified, stratum)
+
+        with span('random_indices', rows=sample_size):
+            shuffled = utils.random_indices(
+                population_size=population_size,
+                sample_size=sample_size,
+                weights=weights if weights is None or weights.sum() > 0 else None,
+                seed=stratum_seed(seed, name)
+            )
+
+        stratum.random_seed = stratum_seed(seed, name)
+        stratum.set_shuffled(shuffled)
+        if progress is not None:
+            progress((i + 1) / len(stratified.strata))
+
+    audit.random_seed = seed
+
+
+def _margin_shares(stratified):
+    # Share of the margin of each pair reported in each stratum, the
+    # allocation the sample sizes aim for
+    shares = np.array([
+        stratified.coefficients @ stratum.reported for stratum in stratified.strata.values()
+    ], dtype=float)
+    shares = np.maximum(shares, 0)
+    totals = shares.sum(axis=0)
+    return np.where(totals > 0, shares / np.where(totals > 0, totals, 1), 1 / len(shares))
+
+
+def _polling_gains(stratified, stratum, shares):
+    # Expected log likelihood ratio gained per ballot sampled in a ballot
+    # polling stratum, when the reported count is right
+    coefficients = stratified.coefficients
+    a, b = _pair_weights(coefficients)
+    w = (coefficients > 0) @ stratum.reported
+    l = (coefficients < 0) @ stratum.reported
+    n = w + l
+    ballots = max(int(stratum.reported.sum()), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p0 = (a * w - b * l - shares * stratified.margins + b * n) / ((a + b) * n)
+        p1 = w / n
+        gains = (n / ballots) * (
+            np.where(p1 > 0, p1 * np.log(p1 / p0), 0) + np.where(p1 < 1, (1 - p1) * np.log((1 - p1) / (1 - p0)), 0)
+        )
+
+    return np.where((n > 0) & (p0 > 0) & (p0 < p1), gains, 0)
+
+
+def get_strata_sample_sizes(stratified):
+    """
+    Estimates the sample size of the next round of each stratum: enough
+    for the p-value of every pair, at the share of the margin reported in
+    the stratum, to reach the risk whose Fisher combination over the strata
+    is the risk limit, assuming no errors. Later rounds aim lower, by the
+    ratio between the risk limit and the combined p-value
+    @param stratified   :   {StratifiedContext}
+                            Audit and its strata
+    @return             :   {dict<str->int>}
+                            Number of ballots (or tables, for comparison
+                            strata) to sample in each stratum
+    """
+    audit = stratified.audit
+    if not audit.in_progress:
+        return {name: 0 for name in stratified.strata}
+
+    shares = _margin_shares(stratified)
+    active = (shares > 0).any(axis=1)
+    target = utils.stratum_risk(audit.risk_limit, max(int(active.sum()), 1))
+    if audit.polled_ballots:
+        # The shares of the margin were not the worst allocation: escalate
+        # every stratum by what the combined p-value still lacks
+        target *= min(1, audit.risk_limit / audit.max_p_value)
+
+    steps = utils.STRATUM_ALLOCATION_STEPS
+    sample_sizes = {}
+    for s, (name, stratum) in enumerate(stratified.strata.items()):
+        current = stratum.p_values[np.arange(len(stratified.pairs)), np.floor(shares[s] * steps).astype(np.int64)]
+        if stratum.audit_type == utils.BALLOT_POLLING:
+            gains = _polling_gains(stratified, stratum, shares[s])
+
+        sample_size = 0
+        for i, share in enumerate(shares[s].tolist()):
+            if share <= 0 or current[i] <= target:
+                continue
+
+            if stratum.audit_type == utils.BALLOT_POLLING:
+                size = math.ceil(math.log(current[i] / target) / gains[i]) if gains[i] > 0 else math.inf
+
+            else:  # comparison and ballot comparison strata, with no errors
+                size = utils.comparison_sample_size(stratum.U / share, target / current[i]) if share < stratum.U else 0
+
+            sample_size = max(sample_size, size)
+
+        if active[s] and sample_size == 0:
+            sample_size = 1
+
+        sample_sizes[name] = min(sample_size, stratum.remaining_shuffled())
+
+    return sample_sizes
+
+
+def draw_strata_sample(stratified, sample_sizes):
+    """
+    Draws the next sample of every stratum, without consuming it
+    @param stratified   :   {StratifiedContext}
+                            Audit and its strata
+    @param sample_sizes :   {dict<str->int>}
+                            Sample size of each stratum
+    @return             :   {dict<str->dict<str->str>>}
+                            Ballots to recount per table of each stratum
+    """
+    return {
+        name: utils.get_sample(stratum, sample_sizes[name])
+        for name, stratum in stratified.strata.items() if sample_sizes.get(name)
+    }
+
+
+def _update_stratum(task):
+    # Runs in a worker process: only arrays go in and out
+    audit_type, state, reports, recounts, draws, missing, coefficients, margins, um, U, allocations = task
+    if audit_type == utils.BALLOT_POLLING:
+        return state, utils.polling_stratum_p_values(reports, recounts, coefficients, margins, allocations)
+
+    micro = np.maximum(0, (reports - recounts) @ coefficients.T / margins[None, :])
+    micro[missing] = um
+    state = state + utils.comparison_stratum_log_factors(micro, draws, um, U, allocations)
+    return state, utils.comparison_stratum_p_values(state, U, allocations)
+
+
+def _comparison_task(stratified, stratum, recount, sample):
+    # Reported and recounted count of each sampled unit, with the times it
+    # was drawn. Units of the sample missing from the recount count as the
+    # largest overstatement
+    store = stratum.get_store()
+    n_candidates = len(stratified.audit.get_store().candidates)
+    units, draws = np.unique(sample, return_counts=True)
+    recounted = np.zeros((len(units), n_candidates), dtype=np.int64)
+    if stratum.audit_type == utils.BALLOT_COMPARISON:
+        ordinals = store.ballot_ordinals(recount['table'].to_numpy(), recount['ballot'].to_numpy())
+        positions = np.searchsorted(units, ordinals)
+        positions = np.minimum(positions, len(units) - 1)
+        found = (ordinals >= 0) & (units[positions] == ordinals)
+        first = np.zeros(len(ordinals), dtype=bool)
+        first[np.unique(ordinals, return_index=True)[1]] = True
+        found &= first
+        reported = np.zeros_like(recounted)
+        reported[np.arange(len(units)), stratum.candidate_codes[store.ballot_candidates[units]]] = 1
+
+    else:  # stratum.audit_type == utils.COMPARISON
+        table_codes = np.array([store.table_index.get(table, -1) for table in recount['table'].tolist()], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(units, table_codes), len(units) - 1)
+        found = (table_codes >= 0) & (units[positions] == table_codes)
+        reported = np.zeros_like(recounted)
+        reported[:, stratum.candidate_codes] = store.vote_matrix[units]
+
+    if len(units):
+        votes = recount['votes'].to_numpy(dtype=np.int64)[found]
+        candidates = _candidate_codes(stratified.audit.get_store(), recount['candidate'].to_numpy(dtype=str)[found])
+        np.add.at(recounted, (positions[found], candidates), votes)
+
+    missing = ~np.isin(np.arange(len(units)), positions[found])
+    return reported, recounted, draws, missing
+
+
+def apply_strata_recount(stratified, recounts, sample_sizes, workers=None, executor=None):
+    """
+    Applies the recount of the samples of a round and updates the p-values
+    of every stratum, computing the strata in parallel worker processes
+    @param stratified   :   {StratifiedContext}
+                            Audit and its strata
+    @param recounts     :   {dict<str->DataFrame>}
+                            Recounted votes of each sampled stratum, with
+                            table, candidate, votes, ballot (for ballot
+                            comparison strata) and party (for D'Hondt
+                            elections) columns
+    @param sample_sizes :   {dict<str->int>}
+                            Sample size of each stratum in the round
+    @param workers      :   {int}
+                            Number of worker processes, the number of CPUs
+                            if None. With 1, strata are computed in-process
+    @param executor     :   {Executor}
+                            Pool to compute the strata with, kept by the
+                            caller across rounds
+    @return             :   {float}
+                            Combined p-value of the audit
+    """
+    audit = stratified.audit
+    sampled = {name for name, size in sample_sizes.items() if size}
+    if set(recounts) != sampled:
+        raise ValueError(f'Expected the recount of the strata: {", ".join(sorted(sampled))}')
+
+    allocations = np.linspace(0, 1, utils.STRATUM_ALLOCATION_STEPS + 1)
+    margins = np.maximum(stratified.margins, 1)  # pairs without a positive margin never validate anyway
+    names = sorted(sampled)
+    tasks = []
+    for name in names:
+        stratum = stratified.strata[name]
+        recount = recounts[name]
+        if stratum.audit_type == utils.BALLOT_POLLING:
+            codes = _candidate_codes(audit.get_store(), recount['candidate'].to_numpy(dtype=str))
+            stratum.recounted = stratum.recounted + np.bincount(
+                codes, weights=recount['votes'].to_numpy(dtype=np.int64), minlength=len(stratum.recounted)
+            ).astype(np.int64)
+            tasks.append((stratum.audit_type, None, stratum.reported, stratum.recounted, None, None,
+                          stratified.coefficients, margins, None, None, allocations))
+
+        else:
+            reported, recounted, draws, missing = _comparison_task(
+                stratified, stratum, recount, stratum.get_shuffled(sample_sizes[name])
+            )
+            tasks.append((stratum.audit_type, stratum.log_factors, reported, recounted, draws, missing,
+                          stratified.coefficients, margins, stratum.um, stratum.U, allocations))
+
+    with span('strata_update', rows=len(tasks)):
+        workers = workers or os.cpu_count() or 1
+        if executor is not None:
+            results = list(executor.map(_update_stratum, tasks))
+
+        elif workers == 1 or len(tasks) < 2:
+            results = [_update_stratum(task) for task in tasks]
+
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+                results = list(pool.map(_update_stratum, tasks))
+
+    for name, (log_factors, p_values) in zip(names, results):
+        stratum = stratified.strata[name]
+        recount = recounts[name]
+        stratum.log_factors = log_factors
+        stratum.p_values = p_values
+        stratum.add_polled_ballots(recount, save=False, consume=False)
+        stratum.consume_shuffled(sample_sizes[name])
+        audit.add_polled_ballots(recount, save=False, consume=False)
+
+    audit.max_p_value = stratified_max_p_value(stratified)
+    return audit.max_p_value
+
+
+def stratified_max_p_value(stratified):
+    """
+    Combined p-value of a stratified audit, see utils.stratified_p_value
+    @param stratified   :   {StratifiedContext}
+                            Audit and its strata
+    @return             :   {float}
+                            Max p-value for all the pairs
+    """
+    if not len(stratified.pairs) or (stratified.margins <= 0).any():
+        return 1.0 if len(stratified.pairs) else 0.0
+
+    return utils.stratified_p_value([stratum.p_values for stratum in stratified.strata.values()])
+
+
+def check_strata_status(stratified):
+    """
+    Updates whether the stratified audit is validated and still in
+    progress
+    @param stratified   :   {StratifiedContext}
+                            Audit and its strata
+    @return             :   {bool}
+                            True if the audit is validated, else False
+    """
+    audit = stratified.audit
+    if audit.max_p_value <= audit.risk_limit:
+        audit.validated = True
+        for stratum in stratified.strata.values():
+            stratum.clear_shuffled(save=False)
+
+    exhausted = all(stratum.remaining_shuffled() <= 0 for stratum in stratified.strata.values())
+    if audit.validated or audit.max_polls <= audit.polled_ballots or exhausted:
+        audit.in_progress = False
+
+    return audit.validated
+
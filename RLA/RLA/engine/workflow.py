@@ -0,0 +1,374 @@
+import numpy as np
+import pandas as pd
+
+from RLA import utils
+from RLA.engine.elections import get_election
+from RLA.engine.rounds import round_schedule
+from RLA.engine.state import Audit, AuditContext
+from RLA.instrumentation import span
+
+
+def create_audit(store, election_type, audit_type, risk_limit, n_winners=1, max_polls=None):
+    """
+    Creates an in-memory audit over a preliminary count
+    @param store            :   {CountStore}
+                                Preliminary count
+    @param election_type    :   {str}
+                                Election type
+    @param audit_type       :   {str}
+                                Audit type (ballot polling, comparison or
+                                ballot comparison)
+    @param risk_limit       :   {float}
+                                Maximum p-value accepted to validate the election
+    @param n_winners        :   {int}
+                                Number of winners (seats) of the election
+    @param max_polls        :   {int}
+                                Maximum number of ballots to recount, all of
+                                them if None
+    @return                 :   {AuditContext}
+                                New audit with its subaudits
+    """
+    audit = Audit(store, election_type, audit_type, risk_limit, n_winners, max_polls)
+    return AuditContext(audit, create_subaudits(audit, store))
+
+
+def create_subaudits(audit, store):
+    """
+    Sets the reported count of a new audit and creates its subaudits
+    @param audit    :   {Audit}
+                        New audit
+    @param store    :   {CountStore}
+                        Preliminary count
+    @return         :   {list<SubAudit>}
+                        Subaudits of the audit, the primary one first
+    """
+    return get_election(audit.election_type).create_subaudits(audit, store)
+
+
+def init_shuffled(context, seed, progress=None):
+    """
+    Draws the shuffled sample of the audit: ballot ordinals for ballot
+    polling and ballot comparison audits, or table ordinals weighted by
+    their error bound for comparison audits
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @param seed     :   {str}
+                        Random seed, in hexadecimal
+    @param progress :   {callable}
+                        Called with the fraction of the sample drawn
+    """
+    audit = context.audit
+    primary_subaudit = context.primary
+    election = get_election(audit.election_type)
+    with span('load_store'):
+        store = audit.get_store()
+
+    if audit.audit_type == utils.BALLOT_POLLING:
+        population_size = int(store.table_totals.sum())
+        sample_size = min(audit.max_polls, sum(primary_subaudit.vote_count.values()))
+        weights = None
+
+    elif audit.audit_type == utils.BALLOT_COMPARISON:
+        population_size = len(store.ballot_ids)
+        sample_size = min(audit.max_polls, population_size)
+        weights = None
+
+    else:  # audit.audit_type == utils.COMPARISON
+        Wp, Lp = primary_subaudit.get_W_L()
+        reported = election.transform_primary_count(audit, audit.vote_count)
+        margin = {w: {l: reported[w] - reported[l] for l in Lp if l != w} for w in Wp}
+        population_size = len(store.tables)
+        with span('error_bounds', rows=population_size):
+            columns, table_counts = election.comparison_table_matrix(audit, store, store.vote_matrix)
+            weights = utils.batch_error_upper_bounds(table_counts, columns, margin, Wp, Lp)
+
+        sample_size = population_size
+
+    with span('random_indices', rows=sample_size):
+        shuffled = utils.random_indices(
+            population_size=population_size,
+            sample_size=sample_size,
+            weights=weights,
+            seed=seed,
+            progress=progress
+        )
+
+    audit.random_seed = seed
+    with span('save_shuffled'):
+        audit.set_shuffled(shuffled)
+
+
+def get_sample_size(context):
+    """
+    Estimates the sample size of the next round. A round that already
+    has part of its recount keeps its size until all its tables are in
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @return         :   {int}
+                        Number of ballots (or tables, for comparison audits)
+    """
+    if context.audit.round_size:
+        return context.audit.round_size
+
+    election = get_election(context.audit.election_type)
+    return context.memoize('sample_size', lambda: election.get_sample_size(context))
+
+
+def get_round_schedule(context):
+    """
+    Gets the size of the next round for several stopping probabilities,
+    to plan how many ballots to pull. Only ballot polling audits have one
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @return         :   {list<tuple<float,int>>}
+                        Stopping probability and number of ballots
+    """
+    if context.audit.audit_type != utils.BALLOT_POLLING:
+        return []
+
+    election = get_election(context.audit.election_type)
+    return context.memoize('round_schedule', lambda: round_schedule(election, context))
+
+
+def draw_sample(context, sample_size):
+    """
+    Draws the next sample of the audit, without consuming it
+    @param context      :   {AuditContext}
+                            Audit and its subaudits
+    @param sample_size  :   {int}
+                            Number of ballots (or tables, for comparison audits)
+    @return             :   {tuple<dict<str->str>,int>}
+                            Ballots to recount per table and number of
+                            ballots to recount
+    """
+    audit = context.audit
+    tables = utils.get_sample(audit, sample_size)
+    if audit.audit_type == utils.COMPARISON:
+        store = audit.get_store()
+        sample_size = sum(store.table_totals[store.table_index[table]] for table in tables)
+
+    return tables, sample_size
+
+
+def _process_ballot_polling_subaudit(audit, subaudit, vote_count, vote_recount, verify_exact=False):
+    args = (audit.risk_limit, subaudit.Sw, subaudit.Sl)
+    log_T = utils.ballot_polling_log_SPRT(vote_count, vote_recount, subaudit.log_T, *args)
+    if verify_exact:
+        utils.verify_log_SPRT(vote_count, vote_recount, subaudit.log_T, log_T, *args)
+
+    subaudit.log_T = log_T
+    subaudit.max_p_value = utils.max_log_p_value(subaudit.log_T)
+    audit.max_p_value = max(audit.max_p_value, subaudit.max_p_value)
+
+
+def _process_comparison_subaudit(election, audit, subaudit, columns, table_counts, table_recounts, W, L, um, U,
+                                 draws=None, missing=None):
+    reported_count = election.transform_primary_count(audit, subaudit.vote_count)
+    reported_columns = list(reported_count.keys())
+    index = {c: i for i, c in enumerate(columns)}
+    positions = [index[c] for c in reported_columns]
+    args = (
+        utils.count_matrix([reported_count], reported_columns)[0],
+        table_counts[:, positions],
+        table_recounts[:, positions],
+        utils.pair_arrays(W, reported_columns),
+        utils.pair_arrays(L, reported_columns),
+        um,
+        U
+    )
+    if draws is None:
+        _, factor = utils.batch_comparison_SPRT(*args)
+
+    else:
+        _, factor = utils.ballot_comparison_SPRT(*args, draws, missing)
+
+    subaudit.T *= factor
+
+
+def _ballot_polling_recount(election, context, real_recount):
+    audit = context.audit
+    real_vote_recount = real_recount.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
+
+    # Primary subaudit
+    subaudit = context.primary
+    vote_count = election.transform_primary_count(audit, subaudit.vote_count)
+    vote_recount = election.transform_primary_recount(audit, real_vote_recount)
+    _process_ballot_polling_subaudit(audit, subaudit, vote_count, vote_recount, context.verify_exact)
+
+    # Secondary subaudits
+    for subaudit in context.secondaries:
+        vote_count = election.transform_secondary_count(audit, subaudit.vote_count)
+        vote_recount = election.transform_secondary_recount(audit, real_vote_recount)
+        _process_ballot_polling_subaudit(audit, subaudit, vote_count, vote_recount, context.verify_exact)
+
+
+def _compare_counts(election, context, table_counts, table_recounts, draws=None, missing=None):
+    audit = context.audit
+    store = audit.get_store()
+    um, U = election.comparison_bounds(context)
+    W, L = election.get_party_seat_pairs(context)
+    columns, primary_counts = election.comparison_table_matrix(audit, store, table_counts)
+    _, primary_recounts = election.comparison_table_matrix(audit, store, table_recounts)
+    _process_comparison_subaudit(
+        election, audit, context.primary, columns, primary_counts, primary_recounts, W, L, um, U, draws, missing
+    )
+
+    # Secondary subaudits check candidates, so they use the counts as they are
+    candidates = store.candidates.tolist()
+    for subaudit in context.secondaries:
+        Wp, Lp = subaudit.get_W_L()
+        W = [(c, 0) for c in Wp]
+        L = [(c, 0) for c in Lp]
+        _process_comparison_subaudit(
+            election, audit, subaudit, candidates, table_counts, table_recounts, W, L, um, U, draws, missing
+        )
+
+    for subaudit in context.subaudits:
+        subaudit.max_p_value = 1 / subaudit.T
+
+    audit.max_p_value = max(subaudit.max_p_value for subaudit in context.subaudits)
+
+
+def _comparison_recount(election, context, real_recount):
+    store = context.audit.get_store()
+    recounts = real_recount.groupby(['table', 'candidate'])['votes'].sum().unstack(fill_value=0)
+    recounts = recounts.reindex(columns=store.candidates, fill_value=0)
+    table_counts = store.vote_matrix[[store.table_index[table] for table in recounts.index]]
+    table_recounts = recounts.to_numpy(dtype=np.int64)
+    _compare_counts(election, context, table_counts, table_recounts)
+
+
+def _ballot_comparison_recount(election, context, real_recount, sample=None):
+    # Without the sample of the round every recount row is one draw. With
+    # it, each sampled ballot of the recounted tables counts as many times
+    # as it was drawn, and the ones missing count as the largest overstatement
+    store = context.audit.get_store()
+    ordinals = store.ballot_ordinals(real_recount['table'].to_numpy(), real_recount['ballot'].to_numpy())
+    recounted = np.searchsorted(store.candidates, real_recount['candidate'].to_numpy(dtype=str))
+    if sample is None:
+        draws = np.ones(len(ordinals), dtype=np.int64)
+        missing = np.zeros(len(ordinals), dtype=bool)
+
+    else:
+        tables = np.unique(store.table_codes(real_recount['table'].unique()))
+        sample = sample[np.isin(store.ballot_tables[sample], tables)]
+        first = ~pd.Index(ordinals).duplicated()
+        index = pd.Index(ordinals[first])
+        ordinals, draws = np.unique(sample, return_counts=True)
+        positions = index.get_indexer(ordinals)
+        missing = positions < 0
+        recounted = np.where(missing, 0, recounted[first][positions])
+
+    rows = np.arange(len(ordinals))
+    ballot_counts = np.zeros((len(ordinals), len(store.candidates)), dtype=np.int64)
+    ballot_counts[rows, store.ballot_candidates[ordinals]] = 1
+    ballot_recounts = np.zeros_like(ballot_counts)
+    ballot_recounts[rows[~missing], recounted[~missing]] = 1
+    _compare_counts(election, context, ballot_counts, ballot_recounts, draws, missing)
+
+
+def new_round_tables(context, real_recount, sample_size):
+    """
+    Filters a recount of the current round down to the tables of its
+    sample not applied yet, opening the round if needed
+    @param context      :   {AuditContext}
+                            Audit and its subaudits
+    @param real_recount :   {DataFrame}
+                            Recounted votes, with a table column
+    @param sample_size  :   {int}
+                            Number of ballots (or tables, for comparison
+                            audits) of the round, used if no round is open
+    @return             :   {tuple<DataFrame,set>}
+                            Rows of the new tables and the tables of the
+                            round sample
+    """
+    audit = context.audit
+    if not audit.round_size:
+        audit.round_size = min(sample_size, audit.remaining_shuffled())
+        audit.round_tables = set()
+
+    round_tables = set(utils.get_sample(audit, audit.round_size))
+    new_tables = round_tables - audit.round_tables
+    return real_recount[real_recount['table'].isin(list(new_tables))], round_tables
+
+
+def apply_recount(context, real_recount, sample_size=None):
+    """
+    Applies the recount of a sample and updates the test statistics of
+    every subaudit. Without a sample size the recount is a whole round,
+    consumed from the shuffled sample as it is applied. With one, it can
+    be part of a round: tables outside the round sample or already
+    applied are skipped, and the round is consumed once all its tables
+    are in, so retried or overlapping uploads do not count twice
+    @param context      :   {AuditContext}
+                            Audit and its subaudits
+    @param real_recount :   {DataFrame}
+                            Recounted votes, with table, candidate, votes
+                            and party (for D'Hondt elections) columns
+    @param sample_size  :   {int}
+                            Number of ballots (or tables, for comparison
+                            audits) of the round the recount belongs to
+    @return             :   {int}
+                            Number of tables applied
+    """
+    audit = context.audit
+    election = get_election(audit.election_type)
+    round_tables = None
+    sample = None
+    if sample_size is not None:
+        with span('new_tables', rows=len(real_recount)):
+            real_recount, round_tables = new_round_tables(context, real_recount, sample_size)
+            if audit.audit_type == utils.BALLOT_COMPARISON:
+                sample = audit.get_shuffled(audit.round_size)
+
+    applied = real_recount['table'].nunique()
+    if not applied:
+        return 0
+
+    with span('add_polled_ballots', rows=len(real_recount)):
+        audit.add_polled_ballots(real_recount, save=False, consume=round_tables is None)
+
+    audit.max_p_value = 0
+    with span('sprt'):
+        if audit.audit_type == utils.BALLOT_POLLING:
+            _ballot_polling_recount(election, context, real_recount)
+
+        elif audit.audit_type == utils.BALLOT_COMPARISON:
+            _ballot_comparison_recount(election, context, real_recount, sample)
+
+        else:  # audit.audit_type == utils.COMPARISON
+            _comparison_recount(election, context, real_recount)
+
+    if round_tables is not None:
+        audit.round_tables = audit.round_tables | set(real_recount['table'].unique().tolist())
+        if audit.round_tables >= round_tables:
+            # Consumed as whole recounts are: ballots, or distinct tables
+            if audit.audit_type == utils.COMPARISON:
+                audit.consume_shuffled(len(round_tables))
+
+            else:  # ballots, for ballot polling and ballot comparison audits
+                audit.consume_shuffled(audit.round_size)
+
+            audit.round_size = 0
+            audit.round_tables = set()
+
+    return applied
+
+
+def check_status(context):
+    """
+    Updates whether the audit is validated and still in progress
+    @param context  :   {AuditContext}
+                        Audit and its subaudits
+    @return         :   {bool}
+                        True if the audit is validated, else False
+    """
+    audit = context.audit
+    if context.is_validated():
+        audit.validated = True
+        audit.clear_shuffled(save=False)  # to save space in storage
+
+    if audit.validated or audit.max_polls <= audit.polled_ballots:
+        audit.in_progress = False
+
+    return audit.validated
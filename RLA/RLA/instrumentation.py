@@ -0,0 +1,88 @@
+import contextlib
+import contextvars
+import cProfile
+import marshal
+import time
+
+_recorder = contextvars.ContextVar('span_recorder', default=None)
+
+
+class SpanRecorder:
+    """
+    Collects the spans timed while it is active, in the order they start,
+    with the depth at which they are nested
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.depth = 0
+        self.seconds = 0
+        self.profile = None
+        self._start = time.perf_counter()
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._start
+
+    def totals(self, key):
+        return sum(span[key] for span in self.spans if span[key] is not None)
+
+
+@contextlib.contextmanager
+def recording(profile=False):
+    """
+    Activates a span recorder for the code run inside the block
+    @param profile  :   {bool}
+                        Whether to also profile the block, keeping the
+                        statistics in the pstats format
+    @return         :   {SpanRecorder}
+                        Recorder of the block
+    """
+    recorder = SpanRecorder()
+    token = _recorder.set(recorder)
+    profiler = cProfile.Profile() if profile else None
+    if profiler is not None:
+        profiler.enable()
+
+    try:
+        yield recorder
+
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.create_stats()
+            recorder.profile = marshal.dumps(profiler.stats)
+
+        _recorder.reset(token)
+        recorder.finish()
+
+
+@contextlib.contextmanager
+def span(name, rows=None, bytes_read=None):
+    """
+    Times a phase, if a recorder is active. The rows processed and bytes
+    read can also be set on the yielded span once they are known
+    @param name         :   {str}
+                            Name of the phase
+    @param rows         :   {int}
+                            Rows processed by the phase
+    @param bytes_read   :   {int}
+                            Bytes read by the phase
+    @return             :   {dict}
+                            Span being timed
+    """
+    recorder = _recorder.get()
+    entry = {'name': name, 'depth': 0, 'seconds': 0, 'rows': rows, 'bytes_read': bytes_read}
+    if recorder is None:
+        yield entry
+        return
+
+    entry['depth'] = recorder.depth
+    recorder.spans.append(entry)
+    recorder.depth += 1
+    start = time.perf_counter()
+    try:
+        yield entry
+
+    finally:
+        entry['seconds'] = time.perf_counter() - start
+        recorder.depth -= 1
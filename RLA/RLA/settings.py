@@ -127,6 +127,78 @@ MEDIA_ROOT = 'files/'
 MEDIA_URL = '/files/'
 
 
+# Random beacon
+# SOURCE can be replaced by 'RLA.beacon.FileBeaconSource', with
+# OPTIONS = {'path': ...}, to read pulses from local files
+
+RANDOM_BEACON = {
+    'SOURCE': 'RLA.beacon.RemoteBeaconSource',
+    'OPTIONS': {
+        'url': 'https://random.uchile.cl/beacon/2.0/pulse/time/',
+        'timeout': 10,
+        'retries': 3,
+    },
+    'CACHE_DIR': os.path.join(BASE_DIR, 'beacon_cache'),
+}
+
+
+# Audit jobs
+# With ASYNC, samples are drawn and recounts uploaded through the bulk API
+# are applied by in process worker threads (or by the run_audit_jobs
+# command). Without it, the first recount page view draws the sample and
+# uploads are applied by the request. Running initializations older than
+# STALE_AFTER seconds are retried, and failed ones RETRY_AFTER seconds
+# after they failed. Queued recounts are applied in
+# transactions of up to RECOUNT_BATCH_SIZE uploads.
+
+AUDIT_JOBS = {
+    'ASYNC': True,
+    'STALE_AFTER': 600,
+    'RETRY_AFTER': 300,
+    'RECOUNT_BATCH_SIZE': 100,
+}
+
+
+# Audit instrumentation
+# With ENABLED, the phases of recount uploads, batches and initializations
+# are timed and stored with the audit. Recount page views are only stored
+# for a fraction PAGE_VIEW_RATE of them, or when slower than
+# PAGE_VIEW_SLOWER_THAN seconds. With PROFILE, a fraction PROFILE_RATE of
+# the stored ones is also profiled, keeping a pstats file with the timings.
+
+AUDIT_INSTRUMENTATION = {
+    'ENABLED': True,
+    'PROFILE': False,
+    'PROFILE_RATE': 1.0,
+    'PAGE_VIEW_RATE': 0.01,
+    'PAGE_VIEW_SLOWER_THAN': 1.0,
+}
+
+
+# Ballot polling SPRT
+# The test statistics are kept as log likelihood ratios in floating point.
+# With VERIFY_EXACT, every update is also computed in Decimal arithmetic
+# and the recount fails if both disagree.
+
+AUDIT_SPRT = {
+    'VERIFY_EXACT': False,
+}
+
+
+# Audit estimates
+# With ENABLED, the size of the next round and its schedule are kept in
+# the CACHE alias for up to TIMEOUT seconds, together with the state of
+# the audit they were computed from. They are discarded once a recount
+# is saved. With the default cache, each process keeps its own entries,
+# still checked against the state of the audit before being used.
+
+AUDIT_ESTIMATES = {
+    'ENABLED': True,
+    'CACHE': 'default',
+    'TIMEOUT': 3600,
+}
+
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
@@ -0,0 +1,730 @@
+import functools
+import hashlib
+import io
+import os
+
+import numpy as np
+import pandas as pd
+
+from RLA import utils
+
+STORE_VERSION = 3
+
+
+class CountFileError(ValueError):
+    pass
+
+
+def file_checksum(path, block_size=1 << 20):
+    """
+    Computes the SHA-256 checksum of a file, reading it in blocks
+    @param path         :   {str}
+                            Path to the file
+    @param block_size   :   {int}
+                            Number of bytes read per block
+    @return             :   {str}
+                            Hexadecimal digest of the file contents
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def upload_checksum(f):
+    """
+    Computes the SHA-256 checksum of an uploaded file, reading it in
+    chunks and leaving it at its start
+    @param f    :   {File}
+                    Uploaded file
+    @return     :   {str}
+                    Hexadecimal digest of the file contents
+    """
+    sha256 = hashlib.sha256()
+    f.seek(0)
+    for chunk in f.chunks():
+        sha256.update(chunk)
+
+    f.seek(0)
+    return sha256.hexdigest()
+
+
+def check_headers(columns, party=False, cvr=False):
+    """
+    Checks that the header of a vote count file has the required columns
+    @param columns  :   {iterable<str>}
+                        Columns of the file
+    @param party    :   {bool}
+                        Whether the party column is required
+    @param cvr      :   {bool}
+                        Whether the file has cast vote records, one row
+                        per ballot, instead of votes per table
+    @return         :   {list<str>}
+                        Missing columns (empty if the header is valid)
+    """
+    required = list(utils.CVR_COLUMNS if cvr else utils.COUNT_COLUMNS) + (['party'] if party else [])
+    return [column for column in required if column not in set(columns)]
+
+
+def read_headers(f):
+    """
+    Reads the header of an uploaded vote count file, leaving the file at
+    its start so it can be saved afterwards
+    @param f    :   {File}
+                    Uploaded csv file
+    @return     :   {list<str>}
+                    Columns of the file
+    """
+    f.seek(0)
+    try:
+        columns = list(pd.read_csv(f, nrows=0).columns)
+
+    except (ValueError, UnicodeDecodeError):
+        columns = []
+
+    f.seek(0)
+    return columns
+
+
+def split_contests(f):
+    """
+    Splits an uploaded recount of several contests, with a contest column,
+    into one csv file per contest without that column
+    @param f    :   {File}
+                    Uploaded csv file
+    @return     :   {dict<str->bytes>}
+                    Contents of the csv file of each contest
+    """
+    f.seek(0)
+    df = pd.read_csv(f, dtype={utils.CONTEST_COLUMN: str, 'table': str, 'candidate': str, 'party': str})
+    f.seek(0)
+    return {
+        contest: part.drop(columns=utils.CONTEST_COLUMN).to_csv(index=False).encode()
+        for contest, part in df.groupby(utils.CONTEST_COLUMN, sort=True)
+    }
+
+
+def read_count_chunks(path, chunksize=utils.CSV_CHUNK_SIZE):
+    """
+    Reads a vote count csv file in chunks of bounded size. The header is
+    validated once, with the first chunk
+    @param path         :   {str}
+                            Path to the csv file
+    @param chunksize    :   {int}
+                            Number of rows per chunk
+    @return             :   {generator<DataFrame>}
+                            Chunks with the table, candidate, votes and
+                            party (if present) columns
+    """
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    missing = check_headers(columns)
+    if missing:
+        raise CountFileError(f'Missing columns in {os.path.basename(path)}: {", ".join(missing)}')
+
+    usecols = list(utils.COUNT_COLUMNS) + (['party'] if 'party' in columns else [])
+    dtype = {'table': str, 'candidate': str, 'party': str}
+    with pd.read_csv(path, usecols=usecols, dtype=dtype, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def read_cvr_chunks(path, chunksize=utils.CSV_CHUNK_SIZE):
+    """
+    Reads a cast vote record csv file, with one row per ballot, in chunks
+    of bounded size. The header is validated once, with the first chunk
+    @param path         :   {str}
+                            Path to the csv file
+    @param chunksize    :   {int}
+                            Number of rows per chunk
+    @return             :   {generator<DataFrame>}
+                            Chunks with the table, ballot, candidate and
+                            party (if present) columns
+    """
+    columns = list(pd.read_csv(path, nrows=0).columns)
+    missing = check_headers(columns, cvr=True)
+    if missing:
+        raise CountFileError(f'Missing columns in {os.path.basename(path)}: {", ".join(missing)}')
+
+    usecols = list(utils.CVR_COLUMNS) + (['party'] if 'party' in columns else [])
+    dtype = {'table': str, 'ballot': str, 'candidate': str, 'party': str}
+    with pd.read_csv(path, usecols=usecols, dtype=dtype, chunksize=chunksize) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+class _LabelEncoder:
+    """
+    Assigns integer codes to labels in order of appearance, across chunks
+    """
+
+    def __init__(self):
+        self.labels = []
+        self.index = pd.Index([], dtype=object)
+
+    def encode(self, column):
+        codes = self.index.get_indexer(column)
+        missing = codes < 0
+        if missing.any():
+            self.labels.extend(pd.unique(column[missing]))
+            self.index = pd.Index(self.labels, dtype=object)
+            codes = self.index.get_indexer(column)
+
+        return codes
+
+    def sorted_labels(self, numeric=False):
+        """
+        Gets the labels sorted, with the new code of each previous code
+        @param numeric  :   {bool}
+                            Whether labels that are all integers are
+                            parsed as such, as pandas would
+        @return         :   {tuple<ndarray,ndarray>}
+                            Sorted labels and the position of each one
+                            in the sorted labels, by previous code
+        """
+        labels = np.array(self.labels, dtype=str)
+        if numeric and len(labels):
+            try:
+                integers = labels.astype(np.int64)
+                if (integers.astype(str) == labels).all():
+                    labels = integers
+
+            except ValueError:
+                pass
+
+        order = np.argsort(labels, kind='stable')
+        remap = np.empty(len(order), dtype=np.int64)
+        remap[order] = np.arange(len(order))
+        return labels[order], remap
+
+
+def _grow(matrix, n_rows, n_columns):
+    """
+    Makes room in a dense matrix for at least n_rows x n_columns cells,
+    doubling its size when needed
+    @param matrix       :   {ndarray<int>}
+                            Matrix to grow
+    @param n_rows       :   {int}
+                            Number of rows needed
+    @param n_columns    :   {int}
+                            Number of columns needed
+    @return             :   {ndarray<int>}
+                            Matrix with the same values and enough room
+    """
+    rows, columns = matrix.shape
+    if n_rows <= rows and n_columns <= columns:
+        return matrix
+
+    grown = np.zeros((max(n_rows, 2 * rows), max(n_columns, 2 * columns)), dtype=matrix.dtype)
+    grown[:rows, :columns] = matrix
+    return grown
+
+
+class CountAccumulator:
+    """
+    Accumulates a vote count read in chunks into a dense table x candidate
+    matrix, remembering the party of each candidate
+    """
+
+    def __init__(self):
+        self.tables = _LabelEncoder()
+        self.candidates = _LabelEncoder()
+        self.parties = None
+        self.candidate_parties = np.full(16, -1, dtype=np.int64)
+        self.vote_matrix = np.zeros((16, 16), dtype=np.int64)
+
+    def add(self, chunk):
+        """
+        Adds a chunk of the vote count
+        @param chunk    :   {DataFrame}
+                            Rows with the table, candidate, votes and
+                            optionally party columns
+        @return         :   {tuple<ndarray<int>,ndarray<int>>}
+                            Table and candidate code of each row
+        """
+        table_codes = self.tables.encode(chunk['table'].astype(str))
+        candidate_codes = self.candidates.encode(chunk['candidate'].astype(str))
+        votes = chunk['votes'].to_numpy(dtype=np.int64)
+        self.vote_matrix = _grow(self.vote_matrix, len(self.tables.labels), len(self.candidates.labels))
+        np.add.at(self.vote_matrix, (table_codes, candidate_codes), votes)
+
+        if 'party' in chunk.columns:
+            if self.parties is None:
+                self.parties = _LabelEncoder()
+
+            party_codes = self.parties.encode(chunk['party'].fillna(''))
+            if len(self.candidate_parties) < len(self.candidates.labels):
+                grown = np.full(2 * len(self.candidates.labels), -1, dtype=np.int64)
+                grown[:len(self.candidate_parties)] = self.candidate_parties
+                self.candidate_parties = grown
+
+            candidates, first = np.unique(candidate_codes, return_index=True)
+            unset = self.candidate_parties[candidates] < 0
+            self.candidate_parties[candidates[unset]] = party_codes[first[unset]]
+
+        return table_codes, candidate_codes
+
+    def finish(self, checksum):
+        """
+        Builds the store with the accumulated vote count
+        @param checksum :   {str}
+                            Checksum of the source file
+        @return         :   {CountStore}
+                            Encoded vote count
+        """
+        tables, table_remap = self.tables.sorted_labels(numeric=True)
+        candidates, candidate_remap = self.candidates.sorted_labels()
+        vote_matrix = np.zeros((len(tables), len(candidates)), dtype=np.int64)
+        vote_matrix[np.ix_(table_remap, candidate_remap)] = self.vote_matrix[:len(tables), :len(candidates)]
+
+        parties, candidate_parties = None, None
+        if self.parties is not None:
+            parties, party_remap = self.parties.sorted_labels()
+            candidate_parties = np.empty(len(candidates), dtype=np.int64)
+            candidate_parties[candidate_remap] = party_remap[self.candidate_parties[:len(candidates)]]
+
+        return CountStore(tables, candidates, vote_matrix, checksum, parties, candidate_parties)
+
+
+class CVRAccumulator(CountAccumulator):
+    """
+    Accumulates cast vote records read in chunks, keeping the table, ballot
+    and candidate of each ballot besides the count of its table
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.ballot_tables = []
+        self.ballot_ids = []
+        self.ballot_candidates = []
+
+    def add(self, chunk):
+        """
+        Adds a chunk of cast vote records
+        @param chunk    :   {DataFrame}
+                            Rows with the table, ballot, candidate and
+                            optionally party columns
+        @return         :   {tuple<ndarray<int>,ndarray<int>>}
+                            Table and candidate code of each row
+        """
+        table_codes, candidate_codes = super().add(chunk.assign(votes=1))
+        self.ballot_tables.append(table_codes)
+        self.ballot_ids.append(chunk['ballot'].to_numpy(dtype=str))
+        self.ballot_candidates.append(candidate_codes)
+        return table_codes, candidate_codes
+
+    def finish(self, checksum):
+        """
+        Builds the store with the accumulated cast vote records, sorted by
+        table and ballot
+        @param checksum :   {str}
+                            Checksum of the source file
+        @return         :   {CVRStore}
+                            Encoded cast vote records
+        """
+        store = super().finish(checksum)
+        _, table_remap = self.tables.sorted_labels(numeric=True)
+        _, candidate_remap = self.candidates.sorted_labels()
+        ballot_tables = table_remap[np.concatenate(self.ballot_tables or [np.empty(0, dtype=np.int64)])]
+        ballot_ids = np.concatenate(self.ballot_ids or [np.empty(0, dtype=str)])
+        ballot_candidates = candidate_remap[np.concatenate(self.ballot_candidates or [np.empty(0, dtype=np.int64)])]
+        order = np.lexsort((ballot_ids, ballot_tables))
+        ballot_tables, ballot_ids, ballot_candidates = ballot_tables[order], ballot_ids[order], ballot_candidates[order]
+        repeated = (ballot_tables[1:] == ballot_tables[:-1]) & (ballot_ids[1:] == ballot_ids[:-1])
+        if repeated.any():
+            position = np.flatnonzero(repeated)[0]
+            raise CountFileError(
+                f'Ballot {ballot_ids[position]} of table {store.tables[ballot_tables[position]]} is repeated'
+            )
+
+        return CVRStore(
+            store.tables, store.candidates, store.vote_matrix, checksum, ballot_tables, ballot_ids, ballot_candidates,
+            store.parties, store.candidate_parties
+        )
+
+
+class CountStore:
+    """
+    Columnar representation of a vote count file, as a dense table x
+    candidate matrix with sorted table, candidate and party labels
+    """
+
+    def __init__(self, tables, candidates, vote_matrix, checksum, parties=None, candidate_parties=None,
+                 version=STORE_VERSION):
+        self.tables = tables
+        self.candidates = candidates
+        self.vote_matrix = vote_matrix
+        self.checksum = checksum
+        self.parties = parties
+        self.candidate_parties = candidate_parties
+        self.version = version
+        self.table_index = {table: i for i, table in enumerate(tables.tolist())}
+        self.table_totals = vote_matrix.sum(axis=1)
+        self._candidate_party_map = None
+
+    @property
+    def has_parties(self):
+        return self.parties is not None
+
+    def subset(self, table_codes):
+        """
+        Gets the count of some of the tables, with the same candidates and
+        parties
+        @param table_codes  :   {ndarray<int>}
+                                Rows of the tables in the store
+        @return             :   {CountStore}
+                                Count of those tables
+        """
+        table_codes = np.sort(np.asarray(table_codes, dtype=np.int64))
+        return CountStore(
+            self.tables[table_codes],
+            self.candidates,
+            self.vote_matrix[table_codes],
+            self.checksum,
+            self.parties,
+            self.candidate_parties,
+            self.version
+        )
+
+    @classmethod
+    def from_csv(cls, path, chunksize=utils.CSV_CHUNK_SIZE):
+        """
+        Parses a vote count csv file into a store, in a single pass over
+        chunks of bounded size
+        @param path         :   {str}
+                                Path to the csv file
+        @param chunksize    :   {int}
+                                Number of rows read per chunk
+        @return             :   {CountStore}
+                                Encoded vote count
+        """
+        accumulator = CountAccumulator()
+        for chunk in read_count_chunks(path, chunksize):
+            accumulator.add(chunk)
+
+        return accumulator.finish(file_checksum(path))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a store previously written with dump
+        @param path :   {str}
+                        Path to the store file
+        @return     :   {CountStore}
+                        Encoded vote count
+        """
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {key: data[key] for key in data.files}
+
+        kwargs = {}
+        store_class = CountStore
+        if 'ballot_ids' in arrays:
+            store_class = CVRStore
+            kwargs = {key: arrays[key] for key in ('ballot_tables', 'ballot_ids', 'ballot_candidates')}
+
+        return store_class(
+            tables=arrays['tables'],
+            candidates=arrays['candidates'],
+            vote_matrix=arrays['vote_matrix'],
+            checksum=str(arrays['checksum']),
+            parties=arrays.get('parties'),
+            candidate_parties=arrays.get('candidate_parties'),
+            version=int(arrays['version']),
+            **kwargs
+        )
+
+    def dump(self):
+        """
+        Serializes the store into the numpy binary format
+        @return :   {bytes}
+                    Serialized store
+        """
+        buffer = io.BytesIO()
+        np.savez(buffer, **self._arrays())
+        return buffer.getvalue()
+
+    def _arrays(self):
+        arrays = {
+            'tables': self.tables,
+            'candidates': self.candidates,
+            'vote_matrix': self.vote_matrix,
+            'checksum': np.array(self.checksum),
+            'version': np.array(self.version)
+        }
+        if self.has_parties:
+            arrays['parties'] = self.parties
+            arrays['candidate_parties'] = self.candidate_parties
+
+        return arrays
+
+    def is_valid(self, checksum):
+        """
+        Checks that the store was built by this version of the code
+        from the file with the given checksum
+        @param checksum :   {str}
+                            Expected checksum of the source file
+        @return         :   {bool}
+                            True if the store can be used, else False
+        """
+        return self.version == STORE_VERSION and self.checksum == checksum
+
+    def table_votes(self, table):
+        """
+        Gets the reported number of votes for each candidate in a table
+        @param table    :   {str}
+                            Table identifier
+        @return         :   {dict<str->int>}
+                            Number of votes per candidate in the table
+        """
+        return utils.get_table_votes(self.vote_matrix, self.table_index, self.candidates.tolist(), table)
+
+    def candidate_totals(self):
+        """
+        Gets the number of votes of each candidate
+        @return :   {Series}
+                    Votes per candidate, indexed by the sorted candidates
+        """
+        return pd.Series(self.vote_matrix.sum(axis=0), index=self.candidates, name='votes')
+
+    def party_totals(self):
+        """
+        Gets the number of votes of each party
+        @return :   {Series}
+                    Votes per party, indexed by the sorted parties
+        """
+        return pd.Series(self.party_votes(self.vote_matrix.sum(axis=0)), index=self.parties, name='votes')
+
+    def party_votes(self, votes):
+        """
+        Rolls votes per candidate up to votes per party, with a single
+        bincount over the candidate to party index
+        @param votes    :   {ndarray<int>}
+                            Votes per candidate (in the order of candidates),
+                            for one table or a tables x candidates matrix
+        @return         :   {ndarray<int>}
+                            Votes per party (in the order of parties), with
+                            the same number of dimensions
+        """
+        votes = np.asarray(votes, dtype=np.int64)
+        n_parties = len(self.parties)
+        rows = votes.reshape(-1, len(self.candidates))
+        bins = (np.arange(len(rows))[:, None] * n_parties + self.candidate_parties[None, :]).ravel()
+        totals = np.bincount(bins, weights=rows.ravel(), minlength=len(rows) * n_parties)
+        return totals.astype(np.int64).reshape(votes.shape[:-1] + (n_parties,))
+
+    def party_candidate_totals(self, party):
+        """
+        Gets the number of votes of each candidate of a party
+        @param party    :   {str}
+                            Party of the candidates
+        @return         :   {Series}
+                            Votes per candidate of the party, indexed by
+                            the sorted candidates
+        """
+        totals = self.candidate_totals()
+        return totals[self.parties[self.candidate_parties] == party]
+
+    def candidate_party_map(self):
+        """
+        Gets the party of each candidate
+        @return :   {dict<str->str>}
+                    Party per candidate
+        """
+        if self._candidate_party_map is None:
+            self._candidate_party_map = dict(zip(self.candidates.tolist(), self.parties[self.candidate_parties].tolist()))
+
+        return self._candidate_party_map
+
+    def table_codes(self, tables):
+        """
+        Gets the row of each table in the vote matrix
+        @param tables   :   {ndarray}
+                            Table identifiers, as read from a csv file
+        @return         :   {ndarray<int>}
+                            Row of each table, -1 for unknown tables
+        """
+        tables = pd.Series(np.asarray(tables))
+        if self.tables.dtype.kind == 'i':
+            numeric = pd.to_numeric(tables, errors='coerce')
+            valid = numeric.notna().to_numpy()
+            tables = numeric.fillna(0).to_numpy(dtype=np.int64)
+
+        else:
+            valid = np.ones(len(tables), dtype=bool)
+            tables = tables.to_numpy(dtype=str)
+
+        if not len(self.tables):
+            return np.full(len(tables), -1, dtype=np.int64)
+
+        codes = np.minimum(np.searchsorted(self.tables, tables), len(self.tables) - 1)
+        return np.where(valid & (self.tables[codes] == tables), codes, -1)
+
+    def read_recount(self, path):
+        """
+        Parses the recount of sampled tables, checking that its tables,
+        candidates and parties are the ones of this count
+        @param path :   {str}
+                        Path to the csv file, with table, candidate, votes
+                        and party (for D'Hondt elections) columns
+        @return     :   {DataFrame}
+                        Recount, with table, candidate, votes and party
+                        (if present) columns
+        """
+        recount = CountStore.from_csv(path)
+        unknown = recount.candidates[~np.isin(recount.candidates, self.candidates)]
+        if len(unknown):
+            raise CountFileError(f'Unknown candidate {unknown[0]}')
+
+        codes = self.table_codes(recount.tables)
+        if (codes < 0).any():
+            raise CountFileError(f'Unknown table {recount.tables[codes < 0][0]}')
+
+        df = recount.to_df()
+        # Labels of the preliminary count, the recount types its own on its own
+        labels = dict(zip(recount.tables.tolist(), self.tables[codes].tolist()))
+        df['table'] = df['table'].map(labels).to_numpy(dtype=self.tables.dtype)
+        if self.has_parties:
+            parties = df['candidate'].map(self.candidate_party_map())
+            if 'party' not in df:
+                df.insert(2, 'party', parties.to_numpy())
+
+            elif (df['party'] != parties).any():
+                row = df[df['party'] != parties].iloc[0]
+                raise CountFileError(f'Candidate {row["candidate"]} is not from party {row["party"]}')
+
+        return df
+
+    def to_df(self):
+        """
+        Decodes the store into a vote count dataframe, with one row per
+        table and candidate
+        @return :   {DataFrame}
+                    Vote count, with table, candidate, votes and
+                    party columns (if present)
+        """
+        table_codes, candidate_codes = np.indices(self.vote_matrix.shape).reshape(2, -1)
+        columns = {
+            'table': self.tables[table_codes],
+            'candidate': self.candidates[candidate_codes],
+        }
+        if self.has_parties:
+            columns['party'] = self.parties[self.candidate_parties[candidate_codes]]
+
+        columns['votes'] = self.vote_matrix.ravel()
+        return pd.DataFrame(columns)
+
+
+class CVRStore(CountStore):
+    """
+    Columnar representation of a cast vote record file: the table, ballot
+    identifier and candidate of each ballot, sorted by table and ballot so
+    the position of a ballot is its global ballot ordinal, together with
+    the count of each table as in CountStore
+    """
+
+    def __init__(self, tables, candidates, vote_matrix, checksum, ballot_tables, ballot_ids, ballot_candidates,
+                 parties=None, candidate_parties=None, version=STORE_VERSION):
+        super().__init__(tables, candidates, vote_matrix, checksum, parties, candidate_parties, version)
+        self.ballot_tables = ballot_tables
+        self.ballot_ids = ballot_ids
+        self.ballot_candidates = ballot_candidates
+        self.table_starts = np.cumsum(self.table_totals) - self.table_totals
+
+    @classmethod
+    def from_csv(cls, path, chunksize=utils.CSV_CHUNK_SIZE):
+        """
+        Parses a cast vote record csv file into a store, in a single pass
+        over chunks of bounded size
+        @param path         :   {str}
+                                Path to the csv file
+        @param chunksize    :   {int}
+                                Number of rows read per chunk
+        @return             :   {CVRStore}
+                                Encoded cast vote records
+        """
+        accumulator = CVRAccumulator()
+        for chunk in read_cvr_chunks(path, chunksize):
+            accumulator.add(chunk)
+
+        return accumulator.finish(file_checksum(path))
+
+    def _arrays(self):
+        arrays = super()._arrays()
+        arrays['ballot_tables'] = self.ballot_tables
+        arrays['ballot_ids'] = self.ballot_ids
+        arrays['ballot_candidates'] = self.ballot_candidates
+        return arrays
+
+    def ballot_ordinals(self, tables, ballots):
+        """
+        Looks ballots up by table and ballot identifier, with a binary
+        search in the ballots of each table
+        @param tables   :   {ndarray}
+                            Table of each ballot
+        @param ballots  :   {ndarray<str>}
+                            Identifier of each ballot in its table
+        @return         :   {ndarray<int>}
+                            Ordinal of each ballot, -1 for unknown ballots
+        """
+        codes = self.table_codes(tables)
+        ballots = np.asarray(ballots, dtype=str)
+        ordinals = np.full(len(codes), -1, dtype=np.int64)
+        for code in np.unique(codes[codes >= 0]):
+            rows = np.flatnonzero(codes == code)
+            start = self.table_starts[code]
+            table_ballots = self.ballot_ids[start:start + self.table_totals[code]]
+            positions = np.minimum(np.searchsorted(table_ballots, ballots[rows]), len(table_ballots) - 1)
+            found = table_ballots[positions] == ballots[rows]
+            ordinals[rows[found]] = start + positions[found]
+
+        return ordinals
+
+    def read_recount(self, path):
+        """
+        Parses the recount of sampled ballots, with one row per ballot, into
+        a recount dataframe with one vote per row
+        @param path :   {str}
+                        Path to the csv file, with table, ballot and
+                        candidate columns
+        @return     :   {DataFrame}
+                        Recount, with table, ballot, candidate, votes and
+                        party (if present) columns
+        """
+        df = pd.concat(list(read_cvr_chunks(path)), ignore_index=True)
+        ordinals = self.ballot_ordinals(df['table'].to_numpy(), df['ballot'].to_numpy())
+        if (ordinals < 0).any():
+            row = df[ordinals < 0].iloc[0]
+            raise CountFileError(f'Unknown ballot {row["ballot"]} of table {row["table"]}')
+
+        unknown = ~df['candidate'].isin(self.candidates)
+        if unknown.any():
+            raise CountFileError(f'Unknown candidate {df["candidate"][unknown].iloc[0]}')
+
+        columns = {
+            'table': self.tables[self.ballot_tables[ordinals]],
+            'ballot': self.ballot_ids[ordinals],
+            'candidate': df['candidate'].to_numpy(dtype=str),
+        }
+        if self.has_parties:
+            columns['party'] = df['candidate'].map(self.candidate_party_map()).to_numpy()
+
+        columns['votes'] = np.ones(len(df), dtype=np.int64)
+        return pd.DataFrame(columns)
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_load(path, mtime, size):
+    return CountStore.load(path)
+
+
+def load_store(path):
+    """
+    Loads a store, reusing the already loaded one if the file did not change
+    @param path :   {str}
+                    Path to the store file
+    @return     :   {CountStore}
+                    Encoded vote count
+    """
+    stat = os.stat(path)
+    return _cached_load(path, stat.st_mtime_ns, stat.st_size)
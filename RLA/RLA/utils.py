@@ -1,35 +1,90 @@
 import bisect
+import heapq
 import itertools
 import math
 import operator
 from decimal import Decimal
 
-import requests
+import numpy as np
+from Crypto.Cipher import ChaCha20
 from clcert_chachagen import ChaChaGen
 
+from RLA import beacon
+
 SIMPLE_MAJORITY = 'simplemajority'
 SUPER_MAJORITY = 'supermajority'
 DHONDT = 'dhondt'
 
 BALLOT_POLLING = 'ballotpolling'
 COMPARISON = 'comparison'
+BALLOT_COMPARISON = 'ballotcomparison'
+STRATIFIED = 'stratified'
 
 PRIMARY = 'primary'
 
+WINNER = 'winner'
+LOSER = 'loser'
+
+INIT_PENDING = 'pending'
+INIT_QUEUED = 'queued'
+INIT_RUNNING = 'running'
+INIT_READY = 'ready'
+INIT_FAILED = 'failed'
+
+RECOUNT_QUEUED = 'queued'
+RECOUNT_APPLIED = 'applied'
+RECOUNT_FAILED = 'failed'
+RECOUNT_NOTHING_PENDING = 'None of its tables is pending in the current round'
+
+TIMING_RECOUNT_GET = 'recount_get'
+TIMING_RECOUNT_POST = 'recount_post'
+TIMING_INITIALIZATION = 'initialization'
+TIMING_RECOUNT_BATCH = 'recount_batch'
+TIMINGS_SHOWN = 20
+AUDITS_PER_PAGE = 50
+GROUP_SAMPLE_SLACK = 1.1
+ROUND_STOPPING_PROBABILITY = 0.9
+ROUND_SCHEDULE_PROBABILITIES = (0.5, 0.75, 0.9, 0.99)
+STOPPING_TAIL_SDS = 8
+LOG_P_VALUE_CAP = 700
+STRATUM_ALLOCATION_STEPS = 50
+
+BATCH_CHUNK_SIZE = 1 << 22
+RANDOM_CHUNK_SIZE = 1 << 20
+CSV_CHUNK_SIZE = 1 << 16
+
+COUNT_COLUMNS = ('table', 'candidate', 'votes')
+CVR_COLUMNS = ('table', 'ballot', 'candidate')
+CONTEST_COLUMN = 'contest'
+
 
 def get_random_seed(timestamp):
     """
     Obtains the random pulse at the specified time from the beacon
     @param timestamp    :   {django.db.models.DateTimeField}
                             Datetime specified for the pulse
-    @return             :   {bytes}
-                            Random pulse value in bytes format
+    @return             :   {str}
+                            Random pulse value in hexadecimal format
     """
-    beacon_api = 'https://random.uchile.cl/beacon/2.0/pulse/time/'
-    seed_time = int(timestamp.timestamp() * 1000)  # 13 digits with 0's at the end (1587495000000)
-    response = requests.get(beacon_api + str(seed_time))
-    random_seed = response.json()['pulse']['localRandomValue']
-    return random_seed
+    return beacon.get_client().get_random_seed(timestamp)
+
+
+def ballot_positions(ordinals, table_sizes):
+    """
+    Maps global ballot ordinals, that count the ballots table by table, to
+    the table and the position of the ballot inside that table
+    @param ordinals     :   {ndarray<int>}
+                            Global ballot ordinals
+    @param table_sizes  :   {ndarray<int>}
+                            Number of ballots cast at each table
+    @return             :   {tuple<ndarray<int>,ndarray<int>>}
+                            Table index and ballot index inside the table
+                            for each ordinal
+    """
+    ends = np.cumsum(table_sizes)
+    tables = np.searchsorted(ends, ordinals, side='right')
+    ballots = ordinals - (ends[tables] - table_sizes[tables])
+    return tables, ballots
 
 
 def get_sample(audit, sample_size):
@@ -42,19 +97,45 @@ def get_sample(audit, sample_size):
     @return             :   {dict<str->str>}
                             Dictionary with the ballots to sample per table
     """
-    sample = audit.shuffled[:sample_size]
-    tables = {}
-    for table, ballot in sample:
-        if table not in tables:
-            tables[table] = []
+    sample = audit.get_shuffled(sample_size)
+    store = audit.get_store()
+    if audit.audit_type == BALLOT_POLLING:
+        table_codes, ballots = ballot_positions(sample, store.table_totals)
+        ballots = [str(ballot) for ballot in ballots.tolist()]
+
+    elif audit.audit_type == BALLOT_COMPARISON:
+        table_codes = store.ballot_tables[sample]
+        ballots = store.ballot_ids[sample].tolist()
 
-        tables[table].append(str(ballot))
+    else:  # audit.audit_type == COMPARISON
+        table_codes = sample
+        ballots = ['All'] * len(sample)
 
-    for table in tables:
-        tables[table].sort()
+    return group_ballots(store.tables[table_codes].tolist(), ballots)
 
-    tables = {table: ', '.join(tables[table]) for table in sorted(tables)}
-    return tables
+
+def group_ballots(tables, ballots):
+    """
+    Groups the ballots of a sample by table, as they are shown to recount them
+    @param tables   :   {list<str>}
+                        Table of each sampled ballot
+    @param ballots  :   {list<str>}
+                        Position of each sampled ballot in its table, or
+                        'All' for whole tables
+    @return         :   {dict<str->str>}
+                        Dictionary with the ballots to sample per table
+    """
+    grouped = {}
+    for table, ballot in zip(tables, ballots):
+        if table not in grouped:
+            grouped[table] = []
+
+        grouped[table].append(ballot)
+
+    for table in grouped:
+        grouped[table].sort()
+
+    return {table: ', '.join(grouped[table]) for table in sorted(grouped)}
 
 
 def max_p_value(T):
@@ -208,6 +289,162 @@ def ballot_polling_SPRT(vote_count, recount, T, risk_limit, Sw, Sl):
     return T
 
 
+class SPRTVerificationError(ArithmeticError):
+    pass
+
+
+def pair_matrix(log_T):
+    """
+    Lays the pairs of a log SPRT state out as a matrix
+    @param log_T    :   {dict<str->dict<str->float>>}
+                        Log likelihood ratio of each winner-loser pair
+    @return         :   {tuple<list<str>,list<str>,ndarray<float>>}
+                        Winners, losers and the winners x losers matrix,
+                        with nan where a pair is not tested
+    """
+    winners = list(log_T)
+    losers = list(dict.fromkeys(l for w in winners for l in log_T[w]))
+    matrix = np.array([[log_T[w].get(l, np.nan) for l in losers] for w in winners], dtype=np.float64)
+    return winners, losers, matrix.reshape(len(winners), len(losers))
+
+
+def log_gammas(vote_count, winners, losers, Sw, Sl):
+    """
+    Logarithms of the likelihood ratios of a ballot for the winner and of
+    a ballot for the loser of every pair, as gamma computes them
+    @param vote_count   :   {dict<str->int>}
+                            Reported ballots cast for each candidate
+    @param winners      :   {list<str>}
+                            Winners, the rows of the matrices
+    @param losers       :   {list<str>}
+                            Losers, the columns of the matrices
+    @param Sw           :   {dict<str->int>}
+                            Max seat number for each winning party
+    @param Sl           :   {dict<str->int>}
+                            Min seat number for each losing party
+    @return             :   {tuple<ndarray<float>,ndarray<float>>}
+                            Winners x losers matrices for winner and loser ballots
+    """
+    t_w = np.array([vote_count[w] for w in winners], dtype=np.float64)[:, None]
+    t_l = np.array([vote_count[l] for l in losers], dtype=np.float64)[None, :]
+    d_w = np.array([d(Sw[w]) for w in winners], dtype=np.float64)[:, None]
+    d_l = np.array([d(Sl[l]) for l in losers], dtype=np.float64)[None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_total = np.log(t_w + t_l)
+        log_y1 = np.log(t_w) - log_total + np.log(d_w + d_l) - np.log(d_w)
+        log_y2 = np.log(t_l) - log_total + np.log(d_w + d_l) - np.log(d_l)
+
+    return log_y1, log_y2
+
+
+def ballot_polling_log_SPRT(vote_count, recount, log_T, risk_limit, Sw, Sl):
+    """
+    Calculates Wald's Sequential Probability Ratio Test for each contest
+    between winner-loser, as ballot_polling_SPRT does, with the log
+    likelihood ratios of all the pairs updated at once
+    @param vote_count   :   {dict<str->int>}
+                            Reported ballots cast for each candidate
+    @param recount      :   {dict<str->int>}
+                            Recounted ballots for each candidate
+    @param log_T        :   {dict<str->dict<str->float>>}
+                            Log likelihood ratio of each winner-loser pair
+    @param risk_limit   :   {float}
+                            Maximum p-value accepted to validate the election
+    @param Sw           :   {dict<str->int>}
+                            Max seat number for each winning party
+    @param Sl           :   {dict<str->int>}
+                            Min seat number for each losing party
+    @return             :   {dict<str->dict<str->float>>}
+                            Updated log likelihood ratios
+    """
+    winners, losers, matrix = pair_matrix(log_T)
+    log_y1, log_y2 = log_gammas(vote_count, winners, losers, Sw, Sl)
+    recount_w = np.array([recount.get(w, 0) for w in winners], dtype=np.float64)[:, None]
+    recount_l = np.array([recount.get(l, 0) for l in losers], dtype=np.float64)[None, :]
+    with np.errstate(invalid='ignore'):
+        # 0 * -inf is nan: a candidate without reported votes and no recounted ones
+        update = (
+            np.nan_to_num(recount_w * log_y1, nan=0.0, neginf=-np.inf) +
+            np.nan_to_num(recount_l * log_y2, nan=0.0, neginf=-np.inf)
+        )
+
+    active = matrix < math.log(1 / risk_limit)
+    matrix = np.where(active, matrix + update, matrix)
+    return {
+        w: {l: float(matrix[i, j]) for j, l in enumerate(losers) if l in log_T[w]}
+        for i, w in enumerate(winners)
+    }
+
+
+def verify_log_SPRT(vote_count, recount, log_T, updated, risk_limit, Sw, Sl, tolerance=1e-9):
+    """
+    Checks a log SPRT update against the same update done with Decimal
+    arithmetic by ballot_polling_SPRT
+    @param vote_count   :   {dict<str->int>}
+                            Reported ballots cast for each candidate
+    @param recount      :   {dict<str->int>}
+                            Recounted ballots for each candidate
+    @param log_T        :   {dict<str->dict<str->float>>}
+                            Log likelihood ratios before the update
+    @param updated      :   {dict<str->dict<str->float>>}
+                            Log likelihood ratios after the update
+    @param risk_limit   :   {float}
+                            Maximum p-value accepted to validate the election
+    @param Sw           :   {dict<str->int>}
+                            Max seat number for each winning party
+    @param Sl           :   {dict<str->int>}
+                            Min seat number for each losing party
+    @param tolerance    :   {float}
+                            Largest difference accepted, relative to the
+                            log likelihood ratio
+    """
+    T = {w: {l: Decimal(log_T[w][l]).exp() for l in log_T[w]} for w in log_T}
+    exact = ballot_polling_SPRT(vote_count, {c: recount.get(c, 0) for c in vote_count}, T, risk_limit, Sw, Sl)
+    for w in exact:
+        for l, value in exact[w].items():
+            expected = float(value.ln()) if value > 0 else -math.inf
+            if not math.isclose(updated[w][l], expected, rel_tol=tolerance, abs_tol=tolerance):
+                raise SPRTVerificationError(f'Log SPRT of {w} against {l} is {updated[w][l]}, expected {expected}')
+
+
+def log_p_value(log_T):
+    """
+    Gets the p-value of a pair from its log likelihood ratio, capped to the
+    float range
+    @param log_T    :   {float}
+                        Log likelihood ratio of the pair
+    @return         :   {float}
+                        P-value of the pair
+    """
+    return math.exp(min(-log_T, LOG_P_VALUE_CAP))
+
+
+def max_log_p_value(log_T):
+    """
+    Calculates the maximum p-value from the log likelihood ratios of a
+    ballot polling audit, as max_p_value does
+    @param log_T    :   {dict<str->dict<str->float>>}
+                        Log likelihood ratio of each winner-loser pair
+    @return         :   {float}
+                        Max p-value for all the contests
+    """
+    return max((log_p_value(value) for losers in log_T.values() for value in losers.values()), default=0)
+
+
+def log_validated(log_T, alpha):
+    """
+    Checks if every winner-loser pair reached the risk limit, as validated does
+    @param log_T    :   {dict<str->dict<str->float>>}
+                        Log likelihood ratio of each winner-loser pair
+    @param alpha    :   {float}
+                        Risk limit for this audit
+    @return         :   {bool}
+                        True if the election has been validated, else False
+    """
+    threshold = math.log(1 / alpha)
+    return all(value >= threshold for losers in log_T.values() for value in losers.values())
+
+
 def comparison_SPRT(report_count, table_report, table_recount, W, L, um, U, gamma=0.95):
     """
     Calculates Wald's Sequential Probability Ratio Test for the worst possible case
@@ -333,6 +570,155 @@ def comparison_sample_size(U, risk_limit, gamma=0.95):
     return math.ceil(min_sample_size / gamma)
 
 
+def _binomial_log_pmf(log_factorials, n, k, p):
+    log_pmf = log_factorials[n] - log_factorials[k] - log_factorials[n - k]
+    if p > 0:
+        log_pmf = log_pmf + k * math.log(p)
+
+    else:
+        log_pmf = np.where(k > 0, -np.inf, log_pmf)
+
+    if p < 1:
+        log_pmf = log_pmf + (n - k) * math.log1p(-p)
+
+    else:
+        log_pmf = np.where(k < n, -np.inf, log_pmf)
+
+    return log_pmf
+
+
+def _tail_range(n, p, tail):
+    sd = math.sqrt(n * p * (1 - p))
+    return max(0, math.floor(n * p - tail * sd)), min(n, math.ceil(n * p + tail * sd))
+
+
+def pair_stopping_probability(n, log_T, p_w, p_l, z_w, z_l, log_threshold, log_factorials=None, tail=STOPPING_TAIL_SDS):
+    """
+    Probability that the ballot polling SPRT of a winner-loser pair
+    reaches the threshold after n more ballots, sampled with replacement
+    from a population that matches the reported count. The number of
+    ballots for either candidate is binomial, and so is the number of them
+    for the winner, so the probability is the sum of the binomial tails
+    over a grid, truncated to tail standard deviations
+    @param n                :   {int}
+                                Number of ballots sampled
+    @param log_T            :   {float}
+                                Current log likelihood ratio of the pair
+    @param p_w              :   {float}
+                                Probability that a ballot is for the winner
+    @param p_l              :   {float}
+                                Probability that a ballot is for the loser
+    @param z_w              :   {float}
+                                Log likelihood ratio of a ballot for the winner
+    @param z_l              :   {float}
+                                Log likelihood ratio of a ballot for the loser
+    @param log_threshold    :   {float}
+                                Log likelihood ratio that validates the pair
+    @param log_factorials   :   {ndarray<float>}
+                                Logarithms of 0! to n!, computed if None
+    @param tail             :   {float}
+                                Standard deviations kept around the means
+    @return                 :   {float}
+                                Stopping probability
+    """
+    need = log_threshold - log_T
+    if need <= 0:
+        return 1.0
+
+    if n == 0 or p_w == 0 or z_w <= z_l:
+        return 0.0
+
+    if log_factorials is None:
+        log_factorials = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, n + 1)))))
+
+    q = min(1.0, p_w + p_l)
+    s = p_w / q
+    k_lo, k_hi = _tail_range(n, q, tail)
+    k = np.arange(k_lo, k_hi + 1)
+    k_pmf = np.exp(_binomial_log_pmf(log_factorials, n, k, q))
+    x_min = np.ceil((need - k * z_l) / (z_w - z_l)).astype(np.int64)
+    x_lo = _tail_range(k_lo, s, tail)[0]
+    x_hi = _tail_range(k_hi, s, tail)[1]
+    x = np.arange(x_lo, x_hi + 1)
+    probability = 0.0
+    chunk = max(1, BATCH_CHUNK_SIZE // len(x))
+    for start in range(0, len(k), chunk):
+        k_chunk = k[start:start + chunk, None]
+        valid = (x <= k_chunk) & (x >= x_min[start:start + chunk, None])
+        log_pmf = _binomial_log_pmf(log_factorials, k_chunk, np.minimum(x, k_chunk), s)
+        x_tail = np.where(valid, np.exp(log_pmf), 0).sum(axis=1)
+        probability += float(np.dot(k_pmf[start:start + chunk], x_tail))
+
+    return min(1.0, probability)
+
+
+def stopping_probability(n, pairs, log_threshold, tail=STOPPING_TAIL_SDS):
+    """
+    Probability that every winner-loser pair of a ballot polling audit
+    reaches the threshold after n more ballots, taking the pairs as
+    independent
+    @param n                :   {int}
+                                Number of ballots sampled
+    @param pairs            :   {list<tuple<float,float,float,float,float>>}
+                                log_T, p_w, p_l, z_w and z_l of each pair,
+                                as taken by pair_stopping_probability
+    @param log_threshold    :   {float}
+                                Log likelihood ratio that validates a pair
+    @param tail             :   {float}
+                                Standard deviations kept around the means
+    @return                 :   {float}
+                                Stopping probability
+    """
+    log_factorials = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, n + 1)))))
+    probability = 1.0
+    for pair in pairs:
+        probability *= pair_stopping_probability(n, *pair, log_threshold, log_factorials=log_factorials, tail=tail)
+        if probability == 0:
+            break
+
+    return probability
+
+
+def round_size(pairs, log_threshold, target, max_size):
+    """
+    Finds the smallest number of ballots that validates a ballot polling
+    audit with at least the target probability, by doubling the size and
+    then bisecting it
+    @param pairs            :   {list<tuple<float,float,float,float,float>>}
+                                Pairs not yet validated, as taken by
+                                stopping_probability
+    @param log_threshold    :   {float}
+                                Log likelihood ratio that validates a pair
+    @param target           :   {float}
+                                Target stopping probability
+    @param max_size         :   {int}
+                                Largest size allowed
+    @return                 :   {int}
+                                Size of the round, max_size if the target
+                                cannot be reached
+    """
+    if not pairs or max_size <= 0:
+        return 0
+
+    high = 1
+    while stopping_probability(high, pairs, log_threshold) < target:
+        if high >= max_size:
+            return max_size
+
+        high = min(2 * high, max_size)
+
+    low = high // 2
+    while high - low > 1:
+        middle = (low + high) // 2
+        if stopping_probability(middle, pairs, log_threshold) < target:
+            low = middle
+
+        else:
+            high = middle
+
+    return high
+
+
 def dhondt_W_L_sets(vote_count, n_winners):
     """
     Obtains the winner and loser sets, given the amount of votes
@@ -352,18 +738,63 @@ def dhondt_W_L_sets(vote_count, n_winners):
     return W, L
 
 
-def get_table_votes(vote_count_df, table):
+def dhondt_allocation(vote_count, n_seats, max_seats=None):
+    """
+    Allocates the seats of a D'Hondt election with a heap of the next
+    pseudo-candidate (party, column) of each party, in O(seats * log(parties)).
+    Ties are broken as in dhondt_W_L_sets over every pseudo-candidate:
+    lower column first, then the order of vote_count
+    @param vote_count   :   {dict<str->int>}
+                            Reported votes per party, parties without a
+                            name are ignored
+    @param n_seats      :   {int}
+                            Number of seats of the election
+    @param max_seats    :   {dict<str->int>}
+                            Maximum number of seats of each party (e.g. its
+                            number of candidates), n_seats if None
+    @return             :   {tuple<list<tuple<str,int>>,list<tuple<str,int>>,dict<str->int>,dict<str->int>>}
+                            Winning pseudo-candidates in allocation order,
+                            the first losing pseudo-candidate of each party
+                            in the order they would be allocated next, and
+                            the largest winning and smallest losing column
+                            of each party
+    """
+    parties = [party for party in vote_count if party]
+    limits = [n_seats if max_seats is None else min(n_seats, max_seats[party]) for party in parties]
+    heap = [(-p(party, vote_count, 0), 0, rank) for rank, party in enumerate(parties) if limits[rank] > 0]
+    heapq.heapify(heap)
+    W = []
+    while heap and len(W) < n_seats:
+        _, s, rank = heapq.heappop(heap)
+        W.append((parties[rank], s))
+        if s + 1 < limits[rank]:
+            heapq.heappush(heap, (-p(parties[rank], vote_count, s + 1), s + 1, rank))
+
+    L = [(parties[rank], s) for _, s, rank in sorted(heap)]
+    Sw = {}
+    for party, s in W:
+        Sw[party] = s
+
+    Sl = {party: s for party, s in L}
+    return W, L, Sw, Sl
+
+
+def get_table_votes(vote_matrix, table_index, candidates, table):
     """
     Gets the number of votes for each candidate in a specific table
-    @param vote_count_df    :   {DataFrame}
-                                Pandas dataframe with the vote count
+    @param vote_matrix      :   {ndarray<int>}
+                                Dense table x candidate matrix with the vote count
+    @param table_index      :   {dict<str->int>}
+                                Row of the vote matrix for each table
+    @param candidates       :   {list<str>}
+                                Candidate for each column of the vote matrix
     @param table            :   {str}
                                 Table identifier
     @return                 :   {dict<str->int>}
                                 Number of votes per candidate in the table
     """
-    df = vote_count_df[vote_count_df['table'] == table]
-    return df.groupby('candidate').sum()['votes'].to_dict()
+    row = vote_matrix[table_index[table]]
+    return dict(zip(candidates, row.tolist()))
 
 
 def MICRO(reported, table_report, recount, W, L):
@@ -393,6 +824,151 @@ def MICRO(reported, table_report, recount, W, L):
     return micro
 
 
+def count_matrix(counts, columns):
+    """
+    Stacks vote counts into a matrix, with one row per count
+    @param counts   :   {list<dict<str->int>>}
+                        Vote counts, usually one per table
+    @param columns  :   {list<str>}
+                        Candidate (or party) for each column of the matrix
+    @return         :   {ndarray<int>}
+                        Matrix with the votes of each count, missing
+                        candidates count as 0
+    """
+    return np.array([[count.get(c, 0) for c in columns] for count in counts], dtype=np.int64).reshape(-1, len(columns))
+
+
+def pair_arrays(pairs, columns):
+    """
+    Splits a list of candidate, column pairs into index arrays
+    @param pairs    :   {list<tuple<str,int>>}
+                        List of tuples with pairs candidate, column
+    @param columns  :   {list<str>}
+                        Candidate (or party) for each column of the count matrices
+    @return         :   {tuple<ndarray<int>,ndarray<int>>}
+                        Index of the candidate in columns and column number
+                        for each pair
+    """
+    index = {c: i for i, c in enumerate(columns)}
+    candidates = np.array([index[c] for c, _ in pairs], dtype=np.intp)
+    seats = np.array([s for _, s in pairs], dtype=np.int64)
+    return candidates, seats
+
+
+def batch_MICRO(reported, table_reports, table_recounts, W, L):
+    """
+    Maximum In Contest Relative Overstatement for many tables at once,
+    equivalent to calling MICRO for each table
+    @param reported         :   {ndarray<int>}
+                                Reported cast ballots per column
+    @param table_reports    :   {ndarray<int>}
+                                Tables x columns matrix with the reported
+                                cast ballots in each table
+    @param table_recounts   :   {ndarray<int>}
+                                Tables x columns matrix with the recounted
+                                cast ballots in each table
+    @param W                :   {tuple<ndarray<int>,ndarray<int>>}
+                                Column index and seat column of each winning pair
+    @param L                :   {tuple<ndarray<int>,ndarray<int>>}
+                                Column index and seat column of each losing pair
+    @return                 :   {ndarray<float>}
+                                MICRO for each recounted table
+    """
+    w, sw = W
+    l, sl = L
+    valid = w[:, None] != l[None, :]
+    wi, li = np.nonzero(valid)
+    w, sw, l, sl = w[wi], d(sw[wi]), l[li], d(sl[li])
+    y = (sl * reported[w] - sw * reported[l]).astype(float)
+
+    errors = np.asarray(table_reports) - np.asarray(table_recounts)
+    micro = np.zeros(len(errors))
+    if len(y) == 0:
+        return micro
+
+    chunk = max(1, BATCH_CHUNK_SIZE // len(y))
+    for start in range(0, len(errors), chunk):
+        e_chunk = errors[start:start + chunk]
+        x = sl * e_chunk[:, w] - sw * e_chunk[:, l]
+        micro[start:start + chunk] = np.maximum(0, (x / y).max(axis=1))
+
+    return micro
+
+
+def batch_comparison_SPRT(reported, table_reports, table_recounts, W, L, um, U, gamma=0.95):
+    """
+    Calculates Wald's Sequential Probability Ratio Test for many tables at once,
+    equivalent to multiplying the comparison_SPRT of each table
+    @param reported         :   {ndarray<int>}
+                                Reported cast ballots per column
+    @param table_reports    :   {ndarray<int>}
+                                Tables x columns matrix with the reported
+                                cast ballots in each table
+    @param table_recounts   :   {ndarray<int>}
+                                Tables x columns matrix with the recounted
+                                cast ballots in each table
+    @param W                :   {tuple<ndarray<int>,ndarray<int>>}
+                                Column index and seat column of each winning pair
+    @param L                :   {tuple<ndarray<int>,ndarray<int>>}
+                                Column index and seat column of each losing pair
+    @param um               :   {float}
+                                Upper bound on the MICRO for the table, scaled for multiple
+                                votes per table
+    @param U                :   {float}
+                                Upper bound on the MICRO for the whole contest
+    @param gamma            :   {float}
+                                Security factor for escalating on errors
+    @return                 :   {tuple<ndarray<float>,float>}
+                                MICRO for each table and the product of the
+                                update factors of all the tables
+    """
+    micro = batch_MICRO(reported, table_reports, table_recounts, W, L)
+    Dm = micro / um
+    factors = gamma * (1 - Dm) / (1 - 1 / U) + 1 - gamma
+    return micro, float(np.prod(factors))
+
+
+def ballot_comparison_SPRT(reported, ballot_reports, ballot_recounts, W, L, um, U, draws, missing=None, gamma=0.95):
+    """
+    Calculates Wald's Sequential Probability Ratio Test for sampled ballots,
+    comparing each cast vote record with its recount, as
+    batch_comparison_SPRT does with batches of a single ballot
+    @param reported         :   {ndarray<int>}
+                                Reported cast ballots per column
+    @param ballot_reports   :   {ndarray<int>}
+                                Ballots x columns matrix with the vote of
+                                each cast vote record
+    @param ballot_recounts  :   {ndarray<int>}
+                                Ballots x columns matrix with the recounted
+                                vote of each ballot
+    @param W                :   {tuple<ndarray<int>,ndarray<int>>}
+                                Column index and seat column of each winning pair
+    @param L                :   {tuple<ndarray<int>,ndarray<int>>}
+                                Column index and seat column of each losing pair
+    @param um               :   {float}
+                                Upper bound on the MICRO for a ballot
+    @param U                :   {float}
+                                Upper bound on the MICRO for the whole contest
+    @param draws            :   {ndarray<int>}
+                                Times each ballot was drawn in the sample
+    @param missing          :   {ndarray<bool>}
+                                Ballots that were not found, counted with
+                                the largest overstatement
+    @param gamma            :   {float}
+                                Security factor for escalating on errors
+    @return                 :   {tuple<ndarray<float>,float>}
+                                MICRO for each ballot and the product of the
+                                update factors of all the draws
+    """
+    micro = batch_MICRO(reported, ballot_reports, ballot_recounts, W, L)
+    if missing is not None:
+        micro[missing] = um
+
+    Dm = micro / um
+    factors = gamma * (1 - Dm) / (1 - 1 / U) + 1 - gamma
+    return micro, float(np.prod(factors ** np.asarray(draws)))
+
+
 def MICRO_upper_bound(reported, Wp, Lp, Sw, Sl):
     """
     MICRO upper bound for the contest
@@ -446,6 +1022,389 @@ def batch_error_upper_bound(batch_count, margin, Wp, Lp):
     return up
 
 
+def batch_error_upper_bounds(table_counts, columns, margin, Wp, Lp):
+    """
+    Upper bound on the error for many batches at once, equivalent to
+    calling batch_error_upper_bound for each batch
+    @param table_counts :   {ndarray<int>}
+                            Batches x columns matrix with the vote count
+                            of each batch
+    @param columns      :   {list<str>}
+                            Candidate (or party) for each column
+    @param margin       :   {dict<str->dict<str->int>>}
+                            Margin between each winner and loser
+    @param Wp           :   {list<str>}
+                            List of candidates that won at least 1 seat
+    @param Lp           :   {list<str>}
+                            List of candidates that lost at least 1 seat
+    @return             :   {ndarray<float>}
+                            Maximum upper bound on the error for each batch
+    """
+    index = {c: i for i, c in enumerate(columns)}
+    totals = table_counts.sum(axis=1)
+    up = np.zeros(len(table_counts))
+    for w in Wp:
+        for l in Lp:
+            if w != l:
+                up = np.maximum(up, (table_counts[:, index[w]] - table_counts[:, index[l]] + totals) / margin[w][l])
+
+    return up
+
+
+def polling_stratum_p_values(reported, recounted, coefficients, margins, allocations):
+    """
+    P-values of a ballot polling stratum for each pair of the contest and
+    each share of the margin allocated to the stratum. The null hypothesis
+    of a share is that the recount takes at least that share of the margin
+    away from the stratum, tested with Wald's SPRT against the reported
+    share of the winner among the ballots for either candidate of the pair,
+    assuming the recount does not change how many ballots there are for
+    either candidate
+    @param reported     :   {ndarray<int>}
+                            Reported cast ballots per candidate in the stratum
+    @param recounted    :   {ndarray<int>}
+                            Recounted cast ballots per candidate in the
+                            sample of the stratum
+    @param coefficients :   {ndarray<float>}
+                            Pairs x candidates matrix with the weight of a
+                            vote for each candidate in the margin of the pair
+    @param margins      :   {ndarray<float>}
+                            Reported margin of each pair in the whole contest
+    @param allocations  :   {ndarray<float>}
+                            Shares of the margin allocated to the stratum
+    @return             :   {ndarray<float>}
+                            Pairs x allocations matrix of p-values
+    """
+    winners = coefficients > 0
+    losers = coefficients < 0
+    a = np.where(winners, coefficients, 0).max(axis=1)[:, None]
+    b = np.where(losers, -coefficients, 0).max(axis=1)[:, None]
+    w = (winners @ reported)[:, None]
+    l = (losers @ reported)[:, None]
+    k_w = (winners @ recounted)[:, None]
+    k_l = (losers @ recounted)[:, None]
+    n = w + l
+    with np.errstate(divide='ignore', invalid='ignore'):
+        null_margin = a * w - b * l - allocations[None, :] * margins[:, None]
+        p0 = (null_margin + b * n) / ((a + b) * n)
+        p1 = w / n
+        log_LR = np.where(k_w > 0, k_w * np.log(p1 / p0), 0) + np.where(k_l > 0, k_l * np.log((1 - p1) / (1 - p0)), 0)
+        p_values = np.exp(np.minimum(-log_LR, 0))
+
+    p_values = np.where(p0 >= p1, 1.0, p_values)
+    p_values = np.where(p0 <= 0, 0.0, p_values)
+    return np.where(n > 0, p_values, np.where(allocations[None, :] > 0, 0.0, 1.0))
+
+
+def comparison_stratum_log_factors(micro, draws, um, U, allocations, gamma=0.95):
+    """
+    Log update factors of the comparison SPRT of a stratum for each pair
+    of the contest and each share of the margin allocated to the stratum,
+    as comparison_SPRT does with the whole margin
+    @param micro        :   {ndarray<float>}
+                            Units x pairs matrix with the MICRO of each
+                            sampled table (or ballot) for each pair
+    @param draws        :   {ndarray<int>}
+                            Times each unit was drawn in the sample
+    @param um           :   {float}
+                            Upper bound on the MICRO for a unit of the stratum
+    @param U            :   {float}
+                            Upper bound on the MICRO for the whole stratum
+    @param allocations  :   {ndarray<float>}
+                            Shares of the margin allocated to the stratum
+    @param gamma        :   {float}
+                            Security factor for escalating on errors
+    @return             :   {ndarray<float>}
+                            Pairs x allocations matrix with the sum of the
+                            log update factors of all the draws
+    """
+    scale = np.where(allocations < U, 1 - allocations / U, np.inf)
+    factors = gamma * (1 - micro[:, :, None] / um) / scale[None, None, :] + 1 - gamma
+    return np.tensordot(np.asarray(draws, dtype=float), np.log(factors), axes=1)
+
+
+def comparison_stratum_p_values(log_factors, U, allocations):
+    """
+    P-values of a comparison stratum from the sum of its log update factors
+    @param log_factors  :   {ndarray<float>}
+                            Pairs x allocations matrix from
+                            comparison_stratum_log_factors
+    @param U            :   {float}
+                            Upper bound on the MICRO for the whole stratum
+    @param allocations  :   {ndarray<float>}
+                            Shares of the margin allocated to the stratum
+    @return             :   {ndarray<float>}
+                            Pairs x allocations matrix of p-values
+    """
+    p_values = np.exp(np.minimum(-log_factors, 0))
+    return np.where(allocations[None, :] >= U, 0.0, p_values)
+
+
+def fisher_combined_p_value(p_values):
+    """
+    Combines independent p-values with Fisher's method, using the closed
+    form of the chi-squared survival function for even degrees of freedom
+    @param p_values :   {ndarray<float>}
+                        P-values to combine, along the last axis
+    @return         :   {ndarray<float>}
+                        Combined p-value
+    """
+    p_values = np.asarray(p_values, dtype=float)
+    with np.errstate(divide='ignore'):
+        half = -np.log(p_values).sum(axis=-1)
+
+    term = np.ones_like(half)
+    series = np.ones_like(half)
+    for i in range(1, p_values.shape[-1]):
+        term = term * half / i
+        series = series + term
+
+    with np.errstate(invalid='ignore'):
+        combined = np.exp(-half) * series
+
+    return np.where(np.isinf(half), 0.0, np.minimum(combined, 1.0))
+
+
+def allocation_floors(n_strata, steps=STRATUM_ALLOCATION_STEPS):
+    """
+    Grid of margin allocations covering every way to split the margin
+    between the strata: any split, rounded down to the grid, is at least
+    one of these allocations in every stratum
+    @param n_strata :   {int}
+                        Number of strata
+    @param steps    :   {int}
+                        Number of steps of the grid
+    @return         :   {ndarray<int>}
+                        Allocations x strata matrix of grid steps
+    """
+    total = steps - n_strata + 1
+    bars = np.array(list(itertools.combinations(range(total + n_strata - 1), n_strata - 1)), dtype=np.int64)
+    bars = bars.reshape(-1, n_strata - 1)
+    edges = np.hstack([np.full((len(bars), 1), -1), bars, np.full((len(bars), 1), total + n_strata - 1)])
+    return np.diff(edges, axis=1) - 1
+
+
+def stratified_p_value(stratum_p_values, steps=STRATUM_ALLOCATION_STEPS):
+    """
+    P-value of a stratified audit: the Fisher combination of the stratum
+    p-values, maximized over the ways to split the margin of each pair
+    between the strata. Stratum p-values decrease with the share of the
+    margin, so rounding the shares down to the grid is conservative
+    @param stratum_p_values :   {list<ndarray<float>>}
+                                Pairs x (steps + 1) p-values of each stratum
+    @param steps            :   {int}
+                                Number of steps of the grid
+    @return                 :   {float}
+                                Max p-value for all the pairs
+    """
+    floors = allocation_floors(len(stratum_p_values), steps)
+    combined = np.stack([p_values[:, floors[:, s]] for s, p_values in enumerate(stratum_p_values)], axis=-1)
+    return float(fisher_combined_p_value(combined).max(initial=0))
+
+
+def stratum_risk(risk_limit, n_strata):
+    """
+    Risk each stratum must reach so that the Fisher combination of equal
+    stratum p-values reaches the risk limit
+    @param risk_limit   :   {float}
+                            Risk limit of the audit
+    @param n_strata     :   {int}
+                            Number of strata
+    @return             :   {float}
+                            P-value each stratum must reach
+    """
+    low, high = math.log(risk_limit), 0.0
+    for _ in range(60):
+        middle = (low + high) / 2
+        if fisher_combined_p_value(np.full(n_strata, math.exp(middle))) > risk_limit:
+            high = middle
+
+        else:
+            low = middle
+
+    return math.exp(low)
+
+
+class BulkChaChaGen(ChaChaGen):
+    """
+    ChaChaGen that can also generate many random floats at once, consuming
+    the key stream exactly as the same number of calls to random() would
+    """
+    max_leading_zeros = 8
+
+    def _position(self):
+        return (self._block_counter - 1) * 64 + self._next_byte_index
+
+    def _seek(self, position):
+        block, self._next_byte_index = divmod(position, 64)
+        self.cipher = ChaCha20.new(key=self.key, nonce=self.iv)
+        self.cipher.seek(block * 64)
+        self._rand_block = self.cipher.encrypt(self.zeros)
+        self._block_counter = block + 1
+
+    def _stream(self, position, size):
+        cipher = ChaCha20.new(key=self.key, nonce=self.iv)
+        cipher.seek(position)
+        return np.frombuffer(cipher.encrypt(bytes(size)), dtype=np.uint8)
+
+    def _draws(self, long_offsets, long_lengths, n, size):
+        """
+        Walks the offsets of consecutive draws in a chunk of the key stream.
+        Almost every draw takes 7 bytes, so the walk only stops at the offsets
+        where a draw takes more
+        @param long_offsets :   {ndarray<int>}
+                                Offsets at which a draw would take more than 7 bytes
+        @param long_lengths :   {ndarray<int>}
+                                Number of bytes of the draw starting at each of
+                                those offsets, 0 if unknown
+        @param n            :   {int}
+                                Number of offsets in the chunk
+        @param size         :   {int}
+                                Maximum number of draws
+        @return             :   {tuple<ndarray<int>,ndarray<int>>}
+                                Offset and length of each draw, in order
+        """
+        residues = long_offsets % 7
+        offsets_by_residue = [long_offsets[residues == r].tolist() for r in range(7)]
+        lengths_by_residue = [long_lengths[residues == r].tolist() for r in range(7)]
+        starts = []
+        counts = []
+        lengths = []
+        position = 0
+        drawn = 0
+        while position < n and drawn < size:
+            r = position % 7
+            i = bisect.bisect_left(offsets_by_residue[r], position)
+            if i < len(offsets_by_residue[r]):
+                long_offset = offsets_by_residue[r][i]
+                long_length = lengths_by_residue[r][i]
+
+            else:
+                long_offset = n
+                long_length = 0
+
+            count = min(-(-(long_offset - position) // 7), size - drawn)
+            if count:
+                starts.append(position)
+                counts.append(count)
+                lengths.append(7)
+                drawn += count
+
+            if long_offset >= n or drawn == size:
+                break
+
+            starts.append(long_offset)
+            counts.append(1)
+            lengths.append(long_length)
+            drawn += 1
+            if not long_length:
+                break
+
+            position = long_offset + long_length
+
+        counts = np.array(counts, dtype=np.int64)
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        offsets = np.repeat(np.array(starts, dtype=np.int64), counts) + 7 * (np.arange(counts.sum()) - first)
+        return offsets, np.repeat(np.array(lengths, dtype=np.int64), counts)
+
+    def random_array(self, size):
+        """
+        Generates size random floats in [0, 1), equal to calling random()
+        size times
+        @param size :   {int}
+                        Number of random floats
+        @return     :   {ndarray<float>}
+                        Random floats, in generation order
+        """
+        values = np.empty(size)
+        filled = 0
+        max_length = 8 + self.max_leading_zeros
+        while filled < size:
+            chunk = min(size - filled, RANDOM_CHUNK_SIZE)
+            n = 8 * chunk + 64
+            position = self._position()
+            stream = np.concatenate(([0], self._stream(position, n + max_length)))
+
+            # A draw takes 7 bytes, plus one for each leading zero byte, plus one
+            # if its first non zero byte is smaller than 16
+            long_offsets = np.flatnonzero(stream[1:n + 1] < 16)
+            zeros = np.zeros(len(long_offsets), dtype=np.int64)
+            run = np.ones(len(long_offsets), dtype=bool)
+            for k in range(self.max_leading_zeros):
+                run &= stream[1 + long_offsets + k] == 0
+                zeros += run
+
+            long_lengths = 7 + zeros + (stream[1 + long_offsets + zeros] < 16)
+            long_lengths[zeros == self.max_leading_zeros] = 0
+
+            offsets, lengths = self._draws(long_offsets, long_lengths, n, chunk)
+            unknown = np.flatnonzero(lengths == 0)
+            if len(unknown):
+                offsets, lengths = offsets[:unknown[0]], lengths[:unknown[0]]
+
+            ends = offsets + lengths
+            window = stream[ends[:, None] + np.arange(-7, 1)].astype(np.uint64)
+            window[:, 0] *= lengths >= 8
+            v = np.zeros(len(offsets), dtype=np.uint64)
+            for k in range(8):
+                v = (v << np.uint64(8)) | window[:, k]
+
+            shift = np.zeros(len(offsets), dtype=np.uint64)
+            for k in range(53, 61):
+                shift += v >= np.uint64(1 << k)
+
+            values[filled:filled + len(offsets)] = np.ldexp(
+                (v >> shift).astype(float),
+                (shift.astype(np.int64) - 8 * lengths).astype(np.int32)
+            )
+            filled += len(offsets)
+            self._seek(position + (int(ends[-1]) if len(ends) else 0))
+            if len(unknown):
+                values[filled] = self.random()
+                filled += 1
+
+        return values
+
+
+def random_indices(population_size, sample_size, weights=None, seed=None, progress=None):
+    """
+    Generate the indices of a random sample from a population of the given
+    size, following the weight distribution and the random seed. The result
+    is the same as the one of random_sample, in bulk
+    @param population_size  :   {int}
+                                Size of the universe from which to obtain the random sample
+    @param sample_size      :   {int}
+                                Random sample size
+    @param weights          :   {list<float>}
+                                Weight distribution for the random sample
+    @param seed             :   {int|bytes}
+                                Random seed
+    @param progress         :   {callable}
+                                Called with the fraction of the sample drawn
+                                after each chunk
+    @return                 :   {ndarray<int>}
+                                Indices of the random sample of size <sample_size>
+    """
+    chacha = BulkChaChaGen(seed=seed)
+    if weights is not None:
+        cum_weights = np.cumsum(weights)
+
+    indices = np.empty(sample_size, dtype=np.int64)
+    for start in range(0, sample_size, RANDOM_CHUNK_SIZE):
+        draws = chacha.random_array(min(RANDOM_CHUNK_SIZE, sample_size - start))
+        if weights is None:
+            chunk = np.floor(draws * population_size)
+
+        else:
+            chunk = np.searchsorted(cum_weights[:-1], draws * cum_weights[-1], side='right')
+
+        indices[start:start + len(draws)] = np.minimum(chunk, population_size - 1)
+        if progress is not None:
+            progress((start + len(draws)) / sample_size)
+
+    return indices
+
+
 def random_sample(population, sample_size, weights=None, seed=None):
     """
     Generate a random sample from the given population, following the weight
@@ -461,14 +1420,5 @@ def random_sample(population, sample_size, weights=None, seed=None):
     @return             :   {list<any>}
                             Random sample of size <sample_size>
     """
-    chacha = ChaChaGen(seed=seed)
-    if weights is None:
-        weights = [1] * len(population)
-
-    cum_weights = list(itertools.accumulate(weights))
-    total = cum_weights[-1]
-    hi = len(cum_weights) - 1
-    return [
-        population[bisect.bisect(cum_weights, chacha.random() * total, 0, hi)]
-        for i in range(sample_size)
-    ]
+    indices = random_indices(len(population), sample_size, weights=weights, seed=seed)
+    return [population[i] for i in indices.tolist()]
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+from RLA import engine
+from audit.models import Audit, ContestGroup, SubAudit, save_subaudit_state
+
+DEFAULT_AUDIT_SPRT = {
+    'VERIFY_EXACT': False,
+}
+
+DEFAULT_AUDIT_ESTIMATES = {
+    'ENABLED': True,
+    'CACHE': 'default',
+    'TIMEOUT': 3600,
+}
+
+
+def _config():
+    return {**DEFAULT_AUDIT_SPRT, **getattr(settings, 'AUDIT_SPRT', {})}
+
+
+def _estimates_config():
+    return {**DEFAULT_AUDIT_ESTIMATES, **getattr(settings, 'AUDIT_ESTIMATES', {})}
+
+
+def estimates_key(audit_pk):
+    return f'audit:{audit_pk}:estimates'
+
+
+def invalidate_estimates(audit_pk):
+    """
+    Discards the cached estimates of an audit
+    @param audit_pk :   {int}
+                        Primary key of the audit
+    """
+    config = _estimates_config()
+    if config['ENABLED']:
+        caches[config['CACHE']].delete(estimates_key(audit_pk))
+
+
+class AuditContext(engine.AuditContext):
+    """
+    Stored audit and its subaudits, loaded once per request (the subaudits
+    on first use) and mutated in memory, then written back together by save
+    """
+
+    def __init__(self, audit, lock=False):
+        self.audit = audit
+        self.lock = lock
+        self._subaudits = None
+        self.verify_exact = _config()['VERIFY_EXACT']
+
+    @classmethod
+    def load(cls, audit_pk, lock=False):
+        """
+        Loads an audit, to load its subaudits when needed. With lock, the
+        audit and then its subaudits are locked until the end of the
+        transaction, so concurrent recounts apply one after the other
+        @param audit_pk :   {int}
+                            Primary key of the audit
+        @param lock     :   {bool}
+                            Whether to lock the rows, inside a transaction
+        @return         :   {AuditContext}
+                            Context of the audit
+        """
+        audits = Audit.objects.select_for_update() if lock else Audit.objects
+        return cls(audits.get(pk=audit_pk), lock=lock)
+
+    @property
+    def subaudits(self):
+        if self._subaudits is None:
+            subaudits = SubAudit.objects.select_for_update() if self.lock else SubAudit.objects
+            self._subaudits = list(
+                subaudits.filter(audit=self.audit).order_by('pk').prefetch_related(
+                    'reported_counts', 'seats', 'contests'
+                )
+            )
+            for subaudit in self._subaudits:
+                subaudit.audit = self.audit
+
+        return self._subaudits
+
+    def is_validated(self):
+        return self.audit.is_validated()
+
+    def _fingerprint(self):
+        # Read from the audit row alone, so a cache hit loads no subaudit.
+        # Its max p-value bounds those of the subaudits, and saving the
+        # context discards the entry anyway
+        audit = self.audit
+        return audit.polled_ballots, audit.max_p_value, audit.max_polls, audit.shuffled_size, audit.shuffled_offset
+
+    def memoize(self, name, compute):
+        """
+        Gets an estimate from the cache, computing it only when the audit
+        has changed since it was cached. Every estimate of the audit is
+        kept in one entry, together with the audit row it was computed
+        from
+        @param name     :   {str}
+                            Name of the estimate
+        @param compute  :   {callable}
+                            Computes the estimate
+        @return         :   {object}
+                            Estimate
+        """
+        config = _estimates_config()
+        if not config['ENABLED']:
+            return compute()
+
+        cache = caches[config['CACHE']]
+        key = estimates_key(self.audit.pk)
+        fingerprint = self._fingerprint()
+        cached = cache.get(key)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, {})
+
+        if name not in cached[1]:
+            cached[1][name] = compute()
+            cache.set(key, cached, config['TIMEOUT'])
+
+        return cached[1][name]
+
+    def save(self):
+        """
+        Writes the audit and its loaded subaudits in a single transaction,
+        with one bulk update per table. Once committed, the cached
+        estimates of the audit are discarded
+        """
+        audit_pk = self.audit.pk
+        if self._subaudits is None:
+            self.audit.save()
+            transaction.on_commit(lambda: invalidate_estimates(audit_pk))
+            return
+
+        with transaction.atomic():
+            self.audit.save()
+            SubAudit.objects.bulk_update(self._subaudits, ['statistic', 'max_p_value'])
+            save_subaudit_state(self._subaudits)
+            transaction.on_commit(lambda: invalidate_estimates(audit_pk))
+
+
+class GroupContext(engine.GroupContext):
+    """
+    Stored contest group and the contexts of its audits, keyed by contest
+    """
+
+    @classmethod
+    def load(cls, group_pk):
+        """
+        Loads a contest group with its audits
+        @param group_pk :   {int}
+                            Primary key of the group
+        @return         :   {GroupContext}
+                            Context of the group
+        """
+        group = ContestGroup.objects.get(pk=group_pk)
+        audits = Audit.objects.filter(group=group).order_by('pk')
+        return cls(group, {audit.contest: AuditContext(audit) for audit in audits})
+
+    def save(self):
+        """
+        Writes the group and every audit of it in a single transaction
+        """
+        with transaction.atomic():
+            self.group.save()
+            for context in self.contexts.values():
+                context.save()
@@ -1,10 +1,10 @@
 from decimal import Decimal
 
-import pandas as pd
 from django import forms
 
-from audit.models import Audit
+from audit.models import Audit, ContestGroup
 from RLA import utils
+from RLA.store import check_headers, read_headers
 
 
 class ListElectionTypesForm(forms.Form):
@@ -28,7 +28,8 @@ class CreateAuditForm(forms.Form):
     )
     audit_types = (
         (utils.BALLOT_POLLING, 'Ballot Polling'),
-        (utils.COMPARISON, 'Comparison')
+        (utils.COMPARISON, 'Comparison'),
+        (utils.BALLOT_COMPARISON, 'Ballot Comparison (Cast Vote Records)')
     )
     election_type = forms.ChoiceField(
         choices=election_types,
@@ -42,7 +43,8 @@ class CreateAuditForm(forms.Form):
     )
     random_seed_time = forms.DateTimeField(
         label='Random Seed Time',
-        required=True
+        help_text='Taken from the contest group, if any',
+        required=False
     )
     risk_limit = forms.FloatField(
         min_value=0.0,
@@ -64,6 +66,57 @@ class CreateAuditForm(forms.Form):
         label='Preliminary Count File',
         required=True
     )
+    group = forms.ModelChoiceField(
+        queryset=ContestGroup.objects.all(),
+        label='Contest Group',
+        required=False
+    )
+    contest = forms.CharField(
+        max_length=64,
+        label='Contest',
+        required=False
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        group = cleaned_data.get('group')
+        if group is not None:
+            self._check_group(cleaned_data, group)
+
+        elif cleaned_data.get('random_seed_time') is None and 'random_seed_time' not in self.errors:
+            self.add_error('random_seed_time', 'This field is required.')
+
+        count_file = cleaned_data.get('preliminary_count_file')
+        if count_file is not None:
+            party = cleaned_data.get('election_type') == utils.DHONDT
+            cvr = cleaned_data.get('audit_type') == utils.BALLOT_COMPARISON
+            if check_headers(read_headers(count_file), party=party, cvr=cvr):
+                self.add_error('preliminary_count_file', 'Headers not valid')
+
+        return cleaned_data
+
+    def _check_group(self, cleaned_data, group):
+        """
+        Checks that the audit can join the contest group, and takes the
+        random seed time of the group
+        @param cleaned_data :   {dict}
+                                Cleaned data of the form
+        @param group        :   {ContestGroup}
+                                Group the audit joins
+        """
+        cleaned_data['random_seed_time'] = group.random_seed_time
+        if cleaned_data.get('audit_type') != utils.BALLOT_POLLING:
+            self.add_error('audit_type', 'Contest groups only support ballot polling audits')
+
+        if group.shuffled:
+            self.add_error('group', 'The sample of the group has already been drawn')
+
+        contest = cleaned_data.get('contest')
+        if not contest:
+            self.add_error('contest', 'Contests of a group must be named')
+
+        elif group.audits.filter(contest=contest).exists():
+            self.add_error('contest', 'The group already has a contest with this name')
 
     def save(self):
         audit = Audit.objects.create(
@@ -74,11 +127,31 @@ class CreateAuditForm(forms.Form):
             n_winners=self.cleaned_data['n_winners'],
             max_polls=self.cleaned_data['max_polls'],
             preliminary_count=self.cleaned_data['preliminary_count_file'],
+            group=self.cleaned_data['group'],
+            contest=self.cleaned_data['contest'],
         )
         audit.save()
         return audit
 
 
+class CreateContestGroupForm(forms.Form):
+    name = forms.CharField(
+        max_length=128,
+        label='Name',
+        required=True
+    )
+    random_seed_time = forms.DateTimeField(
+        label='Random Seed Time',
+        required=True
+    )
+
+    def save(self):
+        return ContestGroup.objects.create(
+            name=self.cleaned_data['name'],
+            random_seed_time=self.cleaned_data['random_seed_time']
+        )
+
+
 class AuditForm(forms.Form):
     risk_limit = forms.FloatField(min_value=0.0, max_value=1.0)
     random_seed_time = forms.DateTimeField()
@@ -89,10 +162,15 @@ class RecountForm(forms.Form):
     recount = forms.FileField()
     recounted_ballots = forms.IntegerField(widget=forms.HiddenInput())
 
+    def __init__(self, *args, cvr=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cvr = cvr
+        if cvr:
+            self.fields['recount'].help_text = 'One row per sampled ballot, with table, ballot and candidate columns'
+
     def is_valid(self):
         valid = super().is_valid()
-        df = pd.read_csv(self.cleaned_data['recount'])
-        if not set(df.columns) >= {'table', 'candidate', 'votes'}:
+        if valid and check_headers(read_headers(self.cleaned_data['recount']), cvr=self.cvr):
             valid = False
             self.add_error('recount', 'Headers not valid')
 
@@ -105,3 +183,18 @@ class RecountForm(forms.Form):
         #     )
 
         return valid
+
+
+class GroupRecountForm(forms.Form):
+    recount = forms.FileField()
+    sample_size = forms.IntegerField(widget=forms.HiddenInput())
+
+    def is_valid(self):
+        valid = super().is_valid()
+        if valid:
+            columns = read_headers(self.cleaned_data['recount'])
+            if check_headers(columns) or utils.CONTEST_COLUMN not in columns:
+                valid = False
+                self.add_error('recount', 'Headers not valid')
+
+        return valid
@@ -0,0 +1,75 @@
+import contextlib
+import logging
+import random
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import DatabaseError
+
+from RLA import instrumentation
+from audit.models import RecountTiming
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUDIT_INSTRUMENTATION = {
+    'ENABLED': True,
+    'PROFILE': False,
+    'PROFILE_RATE': 1.0,
+    'PAGE_VIEW_RATE': 0.01,
+    'PAGE_VIEW_SLOWER_THAN': 1.0,
+}
+
+
+def _config():
+    return {**DEFAULT_AUDIT_INSTRUMENTATION, **getattr(settings, 'AUDIT_INSTRUMENTATION', {})}
+
+
+def _save(timing, recorder):
+    timing.seconds = recorder.seconds
+    timing.spans = recorder.spans
+    timing.rows = recorder.totals('rows')
+    timing.bytes_read = recorder.totals('bytes_read')
+    try:
+        if recorder.profile is not None:
+            name = f'profile_{timing.audit_id}_{timing.request}.prof'
+            timing.profile.save(name, ContentFile(recorder.profile), save=False)
+
+        timing.save()
+
+    except (OSError, DatabaseError):
+        logger.exception('Could not store the timing of audit %s', timing.audit_id)
+
+
+@contextlib.contextmanager
+def timed(audit_pk, request, page_view=False):
+    """
+    Times the phases of a request on an audit and stores them, even if
+    the request fails. The recount registry of the request can be set on
+    the yielded timing before the block ends. Page views, refreshed
+    constantly, are only stored for a fraction PAGE_VIEW_RATE of them or
+    when slower than PAGE_VIEW_SLOWER_THAN seconds
+    @param audit_pk     :   {int}
+                            Primary key of the audit
+    @param request      :   {str}
+                            Kind of request timed
+    @param page_view    :   {bool}
+                            Whether the request only shows the audit
+    @return             :   {RecountTiming}
+                            Timing of the request, saved when the block ends
+    """
+    config = _config()
+    timing = RecountTiming(audit_id=audit_pk, request=request)
+    if not config['ENABLED']:
+        yield timing
+        return
+
+    sampled = not page_view or random.random() < config['PAGE_VIEW_RATE']
+    profile = sampled and config['PROFILE'] and random.random() < config['PROFILE_RATE']
+    recorder = None
+    try:
+        with instrumentation.recording(profile=profile) as recorder:
+            yield timing
+
+    finally:
+        if recorder is not None and (sampled or recorder.seconds > config['PAGE_VIEW_SLOWER_THAN']):
+            _save(timing, recorder)
@@ -0,0 +1,397 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from RLA import engine, utils
+from audit import instrumentation
+from audit.context import AuditContext, GroupContext
+from audit.models import Audit, RecountRegistry
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUDIT_JOBS = {
+    'ASYNC': True,
+    'STALE_AFTER': 600,
+    'RETRY_AFTER': 300,
+    'RECOUNT_BATCH_SIZE': 100,
+}
+
+
+def _config():
+    return {**DEFAULT_AUDIT_JOBS, **getattr(settings, 'AUDIT_JOBS', {})}
+
+
+def _claimable():
+    config = _config()
+    now = timezone.now()
+    stale = now - timedelta(seconds=config['STALE_AFTER'])
+    failed = now - timedelta(seconds=config['RETRY_AFTER'])
+    return (
+        Q(init_status__in=[utils.INIT_PENDING, utils.INIT_QUEUED]) |
+        Q(init_status=utils.INIT_FAILED, init_updated__lt=failed) |
+        Q(init_status=utils.INIT_RUNNING, init_updated__lt=stale)
+    )
+
+
+def retry_time(audit):
+    """
+    Gets when a failed initialization can be retried
+    @param audit    :   {Audit}
+                        Audit whose initialization failed
+    @return         :   {datetime}
+                        Time of the next attempt
+    """
+    return audit.init_updated + timedelta(seconds=_config()['RETRY_AFTER'])
+
+
+def _report_progress(audit_pk, progress):
+    Audit.objects.filter(pk=audit_pk).update(init_progress=progress, init_updated=timezone.now())
+
+
+def _report_group_progress(group_pk, progress):
+    Audit.objects.filter(group_id=group_pk).update(init_progress=progress, init_updated=timezone.now())
+
+
+def run_initialization(audit_pk):
+    """
+    Draws the shuffled sample of an audit, if no other worker is already
+    doing it, recording the progress and the outcome on the audit
+    @param audit_pk :   {int}
+                        Primary key of the audit to initialize
+    @return         :   {bool}
+                        True if this call initialized the audit, else False
+    """
+    group_pk = Audit.objects.filter(pk=audit_pk).values_list('group_id', flat=True).first()
+    if group_pk is not None:
+        return run_group_initialization(group_pk)
+
+    now = timezone.now()
+    claimed = Audit.objects.filter(_claimable(), pk=audit_pk, random_seed_time__lte=now).update(
+        init_status=utils.INIT_RUNNING,
+        init_progress=0,
+        init_error='',
+        init_updated=now
+    )
+    if not claimed:
+        return False
+
+    audit = Audit.objects.get(pk=audit_pk)
+    try:
+        seed = utils.get_random_seed(audit.random_seed_time)
+        with instrumentation.timed(audit_pk, utils.TIMING_INITIALIZATION):
+            engine.init_shuffled(AuditContext(audit), seed, progress=lambda p: _report_progress(audit_pk, p))
+
+    except Exception as e:
+        logger.exception('Initialization of audit %s failed', audit_pk)
+        Audit.objects.filter(pk=audit_pk).update(
+            init_status=utils.INIT_FAILED,
+            init_error=str(e),
+            init_updated=timezone.now()
+        )
+        return False
+
+    Audit.objects.filter(pk=audit_pk).update(
+        init_status=utils.INIT_READY,
+        init_progress=1,
+        init_updated=timezone.now()
+    )
+    return True
+
+
+def run_group_initialization(group_pk):
+    """
+    Draws the shared shuffled sample of a contest group and the sample of
+    each of its audits, claiming all the audits of the group at once
+    @param group_pk :   {int}
+                        Primary key of the group to initialize
+    @return         :   {bool}
+                        True if this call initialized the group, else False
+    """
+    now = timezone.now()
+    claimed = Audit.objects.filter(_claimable(), group_id=group_pk, random_seed_time__lte=now).update(
+        init_status=utils.INIT_RUNNING,
+        init_progress=0,
+        init_error='',
+        init_updated=now
+    )
+    if not claimed:
+        return False
+
+    group_audits = Audit.objects.filter(group_id=group_pk)
+    try:
+        group_context = GroupContext.load(group_pk)
+        seed = utils.get_random_seed(group_context.group.random_seed_time)
+        engine.init_group_shuffled(group_context, seed, progress=lambda p: _report_group_progress(group_pk, p))
+
+    except Exception as e:
+        logger.exception('Initialization of contest group %s failed', group_pk)
+        group_audits.update(init_status=utils.INIT_FAILED, init_error=str(e), init_updated=timezone.now())
+        return False
+
+    group_audits.update(init_status=utils.INIT_READY, init_progress=1, init_updated=timezone.now())
+    return True
+
+
+def run_due_initializations():
+    """
+    Initializes every audit whose random pulse has already been emitted
+    and that is waiting for (or was abandoned during) its initialization,
+    or whose initialization failed more than RETRY_AFTER seconds ago
+    @return :   {int}
+                Number of audits initialized
+    """
+    due = Audit.objects.filter(
+        _claimable(),
+        random_seed_time__lte=timezone.now()
+    ).values_list('pk', flat=True)
+    return sum(run_initialization(audit_pk) for audit_pk in list(due))
+
+
+class InitializationQueue:
+    """
+    In process worker that runs audit initializations in a background
+    thread, each one as soon as its random pulse is emitted
+    """
+
+    def __init__(self):
+        self._jobs = []
+        self._queued = set()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, audit_pk, due):
+        """
+        Schedules the initialization of an audit
+        @param audit_pk :   {int}
+                            Primary key of the audit to initialize
+        @param due      :   {float}
+                            Unix time after which the initialization can run
+        """
+        with self._condition:
+            if audit_pk in self._queued:
+                return
+
+            self._queued.add(audit_pk)
+            heapq.heappush(self._jobs, (due, audit_pk))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='audit-initialization', daemon=True)
+                self._thread.start()
+
+            self._condition.notify()
+
+    def _next(self):
+        with self._condition:
+            while not self._jobs or self._jobs[0][0] > time.time():
+                self._condition.wait(self._jobs[0][0] - time.time() if self._jobs else None)
+
+            _, audit_pk = heapq.heappop(self._jobs)
+            self._queued.discard(audit_pk)
+            return audit_pk
+
+    def _run(self):
+        while True:
+            audit_pk = self._next()
+            close_old_connections()
+            try:
+                run_initialization(audit_pk)
+
+            except Exception:
+                logger.exception('Initialization worker failed on audit %s', audit_pk)
+
+            finally:
+                close_old_connections()
+
+
+queue = InitializationQueue()
+
+
+def enqueue_initialization(audit):
+    """
+    Queues the initialization of the audit, to run when its random pulse
+    is emitted. Does nothing if initializations run synchronously
+    @param audit    :   {Audit}
+                        Audit to initialize
+    """
+    if not _config()['ASYNC']:
+        return
+
+    Audit.objects.filter(pk=audit.pk, init_status=utils.INIT_PENDING).update(init_status=utils.INIT_QUEUED)
+    queue.put(audit.pk, audit.random_seed_time.timestamp())
+
+
+def ensure_initialization(audit):
+    """
+    Makes sure the initialization of an audit whose random pulse has been
+    emitted is queued or done, running it right away if initializations
+    run synchronously. The audit is refreshed with the current status
+    @param audit    :   {Audit}
+                        Audit to initialize
+    """
+    if audit.is_initialized() or audit.random_seed_time > timezone.now():
+        return
+
+    if _config()['ASYNC']:
+        if Audit.objects.filter(_claimable(), pk=audit.pk).exists():
+            queue.put(audit.pk, time.time())
+
+    else:
+        run_initialization(audit.pk)
+
+    audit.refresh_from_db()
+
+
+def _apply_queued(context, registry):
+    """
+    Applies one queued recount to a locked audit in its own savepoint,
+    recording the outcome on its registry. A recount that fails is rolled
+    back and the context loaded again, so it leaves no partial update
+    @param context  :   {AuditContext}
+                        Locked audit and its subaudits
+    @param registry :   {RecountRegistry}
+                        Queued recount
+    @return         :   {AuditContext}
+                        Context with the recount applied, if it was
+    """
+    audit = context.audit
+    if not audit.in_progress:
+        registry.status = utils.RECOUNT_FAILED
+        registry.error = 'The audit is no longer in progress'
+        return context
+
+    try:
+        with transaction.atomic():
+            real_recount = audit.get_df(registry.recount.path)
+            sample_size = registry.sample_size or engine.get_sample_size(context)
+            registry.applied_tables = engine.apply_recount(context, real_recount, sample_size=sample_size)
+            context.save()
+
+    except Exception as e:
+        if not isinstance(e, ValueError):  # CountFileError, or a sample size out of the audit
+            logger.exception('Recount %s of audit %s failed', registry.pk, audit.pk)
+
+        registry.status = utils.RECOUNT_FAILED
+        registry.error = str(e) or type(e).__name__
+        return AuditContext.load(audit.pk, lock=True)
+
+    registry.status = utils.RECOUNT_APPLIED
+    if not registry.applied_tables:
+        registry.error = utils.RECOUNT_NOTHING_PENDING
+
+    return context
+
+
+def apply_queued_recounts(audit_pk):
+    """
+    Applies the queued recounts of an audit in upload order, in batches.
+    Each batch is one transaction that locks the audit and its subaudits,
+    so workers in other threads or processes never interleave their
+    updates of the same audit. A recount that fails is marked as such
+    without holding back the rest
+    @param audit_pk :   {int}
+                        Primary key of the audit
+    @return         :   {int}
+                        Number of recounts processed
+    """
+    batch_size = _config()['RECOUNT_BATCH_SIZE']
+    queued = RecountRegistry.objects.filter(audit_id=audit_pk, status=utils.RECOUNT_QUEUED).order_by('pk')
+    processed = 0
+    while queued.exists():
+        with instrumentation.timed(audit_pk, utils.TIMING_RECOUNT_BATCH) as timing:
+            with transaction.atomic():
+                context = AuditContext.load(audit_pk, lock=True)
+                batch = list(queued[:batch_size])  # read after the lock, another worker may have applied them
+                context.subaudits  # locks the subaudits before reading their state
+                for registry in batch:
+                    context = _apply_queued(context, registry)
+
+                engine.check_status(context)  # reads the statistics saved with each recount
+                context.audit.save()
+                RecountRegistry.objects.bulk_update(batch, ['status', 'error', 'applied_tables'])
+                timing.recount = batch[-1] if batch else None
+
+        processed += len(batch)
+
+    return processed
+
+
+def run_queued_recounts():
+    """
+    Applies the queued recounts of every audit
+    @return :   {int}
+                Number of recounts processed
+    """
+    audits = RecountRegistry.objects.filter(status=utils.RECOUNT_QUEUED).values_list('audit_id', flat=True)
+    return sum(apply_queued_recounts(audit_pk) for audit_pk in sorted(set(audits)))
+
+
+class RecountQueue:
+    """
+    In process worker that applies queued recounts in a background thread,
+    one audit at a time. Uploads for an audit already waiting are applied
+    in the same batches
+    """
+
+    def __init__(self):
+        self._audits = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def put(self, audit_pk):
+        """
+        Schedules the queued recounts of an audit
+        @param audit_pk :   {int}
+                            Primary key of the audit
+        """
+        with self._condition:
+            self._audits[audit_pk] = None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='audit-recounts', daemon=True)
+                self._thread.start()
+
+            self._condition.notify()
+
+    def _next(self):
+        with self._condition:
+            while not self._audits:
+                self._condition.wait()
+
+            audit_pk = next(iter(self._audits))
+            del self._audits[audit_pk]
+            return audit_pk
+
+    def _run(self):
+        while True:
+            audit_pk = self._next()
+            close_old_connections()
+            try:
+                apply_queued_recounts(audit_pk)
+
+            except Exception:
+                logger.exception('Recount worker failed on audit %s', audit_pk)
+
+            finally:
+                close_old_connections()
+
+
+recount_queue = RecountQueue()
+
+
+def enqueue_recounts(audit):
+    """
+    Schedules the queued recounts of an audit, applying them right away if
+    jobs run synchronously
+    @param audit    :   {Audit}
+                        Audit with queued recounts
+    """
+    if _config()['ASYNC']:
+        recount_queue.put(audit.pk)
+
+    else:
+        apply_queued_recounts(audit.pk)
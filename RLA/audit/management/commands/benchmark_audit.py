@@ -0,0 +1,84 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from RLA import benchmark, utils
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the audit hot paths over a synthetic count, optionally comparing with previous results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=list(benchmark.SCALES), default='small')
+        parser.add_argument('--tables', type=int, help='Number of tables (overrides the scale)')
+        parser.add_argument('--candidates', type=int, help='Number of candidates (overrides the scale)')
+        parser.add_argument('--parties', type=int, help='Number of parties, 0 for none (overrides the scale)')
+        parser.add_argument('--ballots-per-table', type=int, help='Average ballots per table (overrides the scale)')
+        parser.add_argument('--seats', type=int, help='D\'Hondt seats (overrides the scale)')
+        parser.add_argument(
+            '--election-type',
+            choices=[utils.SIMPLE_MAJORITY, utils.SUPER_MAJORITY, utils.DHONDT],
+            help='Election type of the audit benchmarks (default: D\'Hondt if there are parties)'
+        )
+        parser.add_argument('--sample-tables', type=int, default=1000)
+        parser.add_argument('--sample-ballots', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=3)
+        parser.add_argument('--only', nargs='+', choices=list(benchmark.BENCHMARKS), help='Benchmarks to run')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic count')
+        parser.add_argument('--output', help='Write the results to this json file')
+        parser.add_argument('--compare', help='Compare with the results in this json file')
+        parser.add_argument('--threshold', type=float, default=0.1, help='Relative slowdown reported as regression')
+
+    def handle(self, *args, **options):
+        parameters = dict(benchmark.SCALES[options['scale']])
+        for option, parameter in (('tables', 'n_tables'), ('candidates', 'n_candidates'), ('parties', 'n_parties'),
+                                  ('ballots_per_table', 'ballots_per_table'), ('seats', 'n_seats')):
+            if options[option] is not None:
+                parameters[parameter] = options[option]
+
+        if options['election_type'] == utils.DHONDT and not parameters['n_parties']:
+            raise CommandError('D\'Hondt elections need parties')
+
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    baseline = json.load(f)
+
+            except (OSError, ValueError) as e:
+                raise CommandError(str(e))
+
+        def log(name, result):
+            self.stdout.write(f'{name:<32}{result["seconds"]:>12.4f} s{result["peak_memory"] / 2 ** 20:>12.1f} MiB')
+
+        results = benchmark.run_benchmarks(
+            election_type=options['election_type'],
+            sample_tables=options['sample_tables'],
+            sample_ballots=options['sample_ballots'],
+            repeat=options['repeat'],
+            only=options['only'],
+            seed=options['seed'],
+            log=log,
+            **parameters
+        )
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if baseline is None:
+            return
+
+        if baseline['parameters'] != results['parameters']:
+            self.stderr.write('The baseline was run with other parameters')
+
+        regressions = []
+        for entry in benchmark.compare_results(baseline, results, options['threshold']):
+            self.stdout.write(
+                f'{entry["name"]:<32}{entry["time_ratio"]:>10.2f}x time{entry["memory_ratio"]:>10.2f}x memory'
+                f'{"  REGRESSION" if entry["regression"] else ""}'
+            )
+            if entry['regression']:
+                regressions.append(entry['name'])
+
+        if regressions:
+            raise CommandError(f'Regressions in: {", ".join(regressions)}')
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from audit import jobs
+
+
+class Command(BaseCommand):
+    help = 'Initializes the audits whose random pulse has been emitted and applies queued recounts, polling the database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Run the due jobs and exit')
+        parser.add_argument('--interval', type=float, default=5.0, help='Seconds between polls')
+
+    def handle(self, *args, **options):
+        while True:
+            initialized = jobs.run_due_initializations()
+            if initialized:
+                self.stdout.write(f'Initialized {initialized} audit(s)')
+
+            recounts = jobs.run_queued_recounts()
+            if recounts:
+                self.stdout.write(f'Processed {recounts} recount(s)')
+
+            if options['once']:
+                return
+
+            time.sleep(options['interval'])
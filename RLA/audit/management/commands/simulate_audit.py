@@ -0,0 +1,67 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from RLA import engine, utils
+from RLA.store import CVRStore, CountFileError, CountStore
+
+
+class Command(BaseCommand):
+    help = 'Simulates an audit over a preliminary count file, reporting quantiles of the ballots and tables to audit'
+
+    def add_arguments(self, parser):
+        parser.add_argument('count_file', help='Preliminary count csv file (cast vote records for ballot comparison)')
+        parser.add_argument(
+            '--election-type',
+            choices=[utils.SIMPLE_MAJORITY, utils.SUPER_MAJORITY, utils.DHONDT],
+            default=utils.SIMPLE_MAJORITY
+        )
+        parser.add_argument(
+            '--audit-type',
+            choices=[utils.BALLOT_POLLING, utils.COMPARISON, utils.BALLOT_COMPARISON],
+            default=utils.BALLOT_POLLING
+        )
+        parser.add_argument('--risk-limit', type=float, default=0.05)
+        parser.add_argument('--winners', type=int, default=1, help='Number of winners (seats)')
+        parser.add_argument('--max-polls', type=int, help='Maximum number of ballots to recount (default: all)')
+        parser.add_argument('--error-rate', type=float, default=0.0, help='Probability that a reported vote is wrong')
+        parser.add_argument('--trials', type=int, default=1000)
+        parser.add_argument('--workers', type=int, help='Worker processes (default: one per CPU)')
+        parser.add_argument('--seed', default='', help='Seed of the simulation, to replay it')
+        parser.add_argument('--max-rounds', type=int, default=100)
+        parser.add_argument(
+            '--quantiles',
+            type=float,
+            nargs='+',
+            default=list(engine.simulation.DEFAULT_QUANTILES)
+        )
+
+    def handle(self, *args, **options):
+        try:
+            store_class = CVRStore if options['audit_type'] == utils.BALLOT_COMPARISON else CountStore
+            store = store_class.from_csv(options['count_file'])
+
+        except (OSError, CountFileError) as e:
+            raise CommandError(str(e))
+
+        if options['election_type'] == utils.DHONDT and not store.has_parties:
+            raise CommandError('D\'Hondt elections need a party column')
+
+        if options['trials'] < 1:
+            raise CommandError('At least one trial is needed')
+
+        result = engine.simulate(
+            store,
+            options['election_type'],
+            options['audit_type'],
+            options['risk_limit'],
+            n_winners=options['winners'],
+            max_polls=options['max_polls'],
+            error_rate=options['error_rate'],
+            trials=options['trials'],
+            workers=options['workers'],
+            seed=options['seed'],
+            max_rounds=options['max_rounds'],
+            quantiles=tuple(options['quantiles'])
+        )
+        self.stdout.write(json.dumps(result, indent=2))
@@ -1,11 +1,80 @@
-import pandas as pd
-from django.db import models
+import copy
+import io
+import math
+import os
+
+import numpy as np
+from django.core.files.base import ContentFile
+from django.db import models, transaction
+from django.db.models import Max
 from picklefield import PickledObjectField
 
 from RLA import utils
+from RLA.engine import AuditMixin, ShuffledMixin, SubAuditMixin
+from RLA.store import CVRStore, CountStore, load_store
+
+
+class StoredShuffledMixin(ShuffledMixin):
+    """
+    Shuffled sample kept in a numpy file, read with a memory map so only
+    the requested slice is loaded
+    """
+    shuffled_prefix = 'shuffled'
+
+    def _discard_shuffled(self):
+        # Deleted once committed, so a rolled back transaction keeps its file
+        if self.shuffled:
+            storage, name = self.shuffled.storage, self.shuffled.name
+            transaction.on_commit(lambda: storage.delete(name))
+            self.shuffled = None
+
+    def set_shuffled(self, ordinals, save=True):
+        self._discard_shuffled()
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(ordinals, dtype=np.int64))
+        self.shuffled.save(f'{self.shuffled_prefix}_{self.pk}.npy', ContentFile(buffer.getvalue()), save=False)
+        self.shuffled_size = len(ordinals)
+        self.shuffled_offset = 0
+        if save:
+            self.save()
+
+    def clear_shuffled(self, save=True):
+        self._discard_shuffled()
+        self.shuffled_size = 0
+        self.shuffled_offset = 0
+        if save:
+            self.save()
+
+    def get_shuffled(self, size=None, start=None):
+        if not self.shuffled:
+            return np.empty(0, dtype=np.int64)
+
+        if start is None:
+            start = self.shuffled_offset
+
+        if size is None:
+            size = self.shuffled_size - start
+
+        ordinals = np.load(self.shuffled.path, mmap_mode='r')
+        return np.array(ordinals[start:start + size])
+
+
+class ContestGroup(StoredShuffledMixin, models.Model):
+    name = models.CharField(max_length=128)
+    date = models.DateTimeField(auto_now=True)
+    random_seed = models.CharField(max_length=128, blank=True, null=True)
+    random_seed_time = models.DateTimeField()
+    shuffled = models.FileField(blank=True, null=True)
+    shuffled_size = models.IntegerField(default=0)
+    shuffled_offset = models.IntegerField(default=0)
+
+    shuffled_prefix = 'group_shuffled'
+
+    def is_initialized(self):
+        return bool(self.shuffled) and not self.audits.exclude(init_status=utils.INIT_READY).exists()
 
 
-class Audit(models.Model):
+class Audit(StoredShuffledMixin, AuditMixin, models.Model):
     date = models.DateTimeField(auto_now=True)
     in_progress = models.BooleanField(default=True)
     validated = models.BooleanField(default=False)
@@ -18,76 +87,331 @@ class Audit(models.Model):
     max_polls = models.IntegerField()
     polled_ballots = models.IntegerField(default=0)
     preliminary_count = models.FileField()
-    shuffled = PickledObjectField(default=list)
+    preliminary_store = models.FileField(blank=True, null=True)
+    preliminary_checksum = models.CharField(max_length=64, blank=True, null=True)
+    preliminary_stamp = models.CharField(max_length=64, blank=True, default='')
+    shuffled = models.FileField(blank=True, null=True)
+    shuffled_size = models.IntegerField(default=0)
+    shuffled_offset = models.IntegerField(default=0)
+    round_size = models.IntegerField(default=0)
+    round_tables = PickledObjectField(default=set)
     vote_count = PickledObjectField(default=dict)
     accum_recount = PickledObjectField(default=dict)
     max_p_value = models.FloatField(default=1)
+    total_ballots = models.BigIntegerField(default=0)
+    init_status = models.CharField(max_length=16, default=utils.INIT_PENDING)
+    init_progress = models.FloatField(default=0)
+    init_error = models.TextField(blank=True, default='')
+    init_updated = models.DateTimeField(blank=True, null=True)
+    group = models.ForeignKey(ContestGroup, blank=True, null=True, on_delete=models.PROTECT, related_name='audits')
+    contest = models.CharField(max_length=64, blank=True, default='')
 
-    def _update_accum_recounted(self, recount, save=True):
-        for c in recount:
-            self.accum_recount[c] += recount[c]
+    summary_fields = [
+        'date', 'in_progress', 'validated', 'election_type', 'audit_type', 'risk_limit', 'n_winners', 'max_polls',
+        'polled_ballots', 'max_p_value', 'total_ballots', 'init_status'
+    ]
 
-        if save:
-            self.save()
-
-    def get_df(self, path):
-        df = pd.read_csv(path)
-        if self.election_type == utils.DHONDT:
-            df['party'] = df['party'].fillna('')
+    def get_max_p_value(self):
+        if self.audit_type == utils.BALLOT_POLLING:
+            contests = ContestStatistic.objects.filter(subaudit__audit=self)
+            return contests.aggregate(p_value=Max('p_value'))['p_value'] or 0
 
-        return df
+        else:  # self.audit_type == utils.COMPARISON or self.audit_type == utils.BALLOT_COMPARISON
+            return self.subaudit_set.aggregate(p_value=Max('max_p_value'))['p_value'] or 0
 
-    def get_grouped(self, df):
-        if self.election_type == utils.DHONDT:
-            group = df.groupby('party')
+    def get_progress(self):
+        if not self.max_polls:
+            return 0
 
-        else:  # self.election_type == utils.SIMPLE_MAJORITY or self.election_type == utils.SUPER_MAJORITY
-            group = df.groupby('candidate')
+        return min(1, self.polled_ballots / self.max_polls)
 
-        return group.sum()['votes'].sort_values(ascending=False).to_dict()
+    def is_validated(self):
+        T = 1 / self.risk_limit
+        if self.audit_type == utils.BALLOT_POLLING:
+            return not ContestStatistic.objects.filter(subaudit__audit=self, log_T__lt=math.log(T)).exists()
 
-    def add_polled_ballots(self, recount_df, save=True):
-        vote_recount = self.get_grouped(recount_df)
-        self._update_accum_recounted(vote_recount, save=False)
-        self.polled_ballots += sum(vote_recount.values())
+        else:  # self.audit_type == utils.COMPARISON or self.audit_type == utils.BALLOT_COMPARISON
+            return not self.subaudit_set.filter(statistic__lt=T).exists()
 
-        if self.audit_type == utils.BALLOT_POLLING:
-            self.shuffled = self.shuffled[sum(vote_recount.values()):]
+    def _preliminary_count_stamp(self):
+        stat = os.stat(self.preliminary_count.path)
+        return f'{stat.st_mtime_ns}:{stat.st_size}'
 
-        else:  # self.audit_type == utils.COMPARISON
-            table_count = len(recount_df['table'].unique())
-            self.shuffled = self.shuffled[table_count:]
+    def build_preliminary_store(self, save=True):
+        store_class = CVRStore if self.audit_type == utils.BALLOT_COMPARISON else CountStore
+        stamp = self._preliminary_count_stamp()  # before reading, so a file replaced meanwhile is read again
+        store = store_class.from_csv(self.preliminary_count.path)
+        name = f'{os.path.basename(self.preliminary_count.name)}.npz'
+        if self.preliminary_store:
+            self.preliminary_store.delete(save=False)
 
+        self.preliminary_checksum = store.checksum
+        self.preliminary_stamp = stamp
+        self.preliminary_store.save(name, ContentFile(store.dump()), save=False)
         if save:
-            self.save()
+            self.save(update_fields=['preliminary_store', 'preliminary_checksum', 'preliminary_stamp'])
+
+        return store
+
+    def get_store(self):
+        """
+        Gets the encoded preliminary count, rebuilding it if the count file
+        changed (by modification time and size) or if it was built from
+        another file or by another version of the code
+        @return :   {CountStore}
+                    Encoded preliminary count
+        """
+        fresh = self.preliminary_stamp == self._preliminary_count_stamp()
+        if fresh and self.preliminary_store and os.path.exists(self.preliminary_store.path):
+            store = load_store(self.preliminary_store.path)
+            if store.is_valid(self.preliminary_checksum):
+                return store
+
+        return self.build_preliminary_store()
+
+    def is_initialized(self):
+        return self.init_status == utils.INIT_READY
 
+    def get_df(self, path=None):
+        if path is None:
+            return self.get_store().to_df()
 
-class SubAudit(models.Model):
+        return self.get_store().read_recount(path)
+
+
+class SubAudit(SubAuditMixin, models.Model):
     identifier = models.CharField(max_length=16)
     audit = models.ForeignKey(Audit, on_delete=models.PROTECT)
-    Sw = PickledObjectField()
-    Sl = PickledObjectField()
-    T = PickledObjectField()
+    statistic = models.FloatField(blank=True, null=True)
     max_p_value = models.FloatField(default=1)
-    vote_count = PickledObjectField()
 
     class Meta:
         unique_together = ['identifier', 'audit']
 
-    def validated(self):
-        if self.audit.audit_type == utils.BALLOT_POLLING:
-            return utils.validated(self.T, self.audit.risk_limit)
+    def _get_state(self, name, load):
+        if name not in self.__dict__:
+            self.__dict__[name] = load() if self.pk else {}
+            self._saved_state()[name] = copy.deepcopy(self.__dict__[name])
+
+        return self.__dict__[name]
+
+    def _saved_state(self):
+        return self.__dict__.setdefault('_saved', {})
+
+    @property
+    def vote_count(self):
+        return self._get_state('_vote_count', lambda: {
+            count.candidate: count.votes for count in self.reported_counts.all()
+        })
+
+    @vote_count.setter
+    def vote_count(self, value):
+        self.__dict__['_vote_count'] = value
+
+    @property
+    def Sw(self):
+        return self._get_state('_Sw', lambda: {
+            seat.candidate: seat.index for seat in self.seats.all() if seat.role == utils.WINNER
+        })
+
+    @Sw.setter
+    def Sw(self, value):
+        self.__dict__['_Sw'] = value
+
+    @property
+    def Sl(self):
+        return self._get_state('_Sl', lambda: {
+            seat.candidate: seat.index for seat in self.seats.all() if seat.role == utils.LOSER
+        })
+
+    @Sl.setter
+    def Sl(self, value):
+        self.__dict__['_Sl'] = value
 
-        else:  # self.audit.audit_type == utils.COMPARISON
-            return self.T >= 1 / self.audit.risk_limit
+    @property
+    def T(self):
+        return self.statistic
 
-    def get_W_L(self):
-        W = [p for p in self.Sw]
-        L = [p for p in self.Sl if p not in W]
-        return W, L
+    @T.setter
+    def T(self, value):
+        self.statistic = value
+
+    @property
+    def log_T(self):
+        def load():
+            log_T = {}
+            for contest in self.contests.all():
+                log_T.setdefault(contest.winner, {})[contest.loser] = contest.log_T
+
+            return log_T
+
+        return self._get_state('_log_T', load)
+
+    @log_T.setter
+    def log_T(self, value):
+        if value is not None:
+            self.__dict__['_log_T'] = value
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        save_subaudit_state([self])
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        for name in ('_vote_count', '_Sw', '_Sl', '_log_T', '_saved'):
+            self.__dict__.pop(name, None)
+
+    def _pending_state(self):
+        """
+        Collects the reported counts, seat indices and test statistics that
+        changed since they were loaded
+        @return :   {tuple<list<QuerySet>,list<Model>>}
+                    Rows to delete and rows to insert or update
+        """
+        saved = self._saved_state()
+        deletes = []
+        rows = []
+
+        def changed(name, related):
+            if name not in self.__dict__ or self.__dict__[name] == saved.get(name):
+                return False
+
+            if saved.get(name, {}).keys() - self.__dict__[name].keys():
+                deletes.append(related.exclude(candidate__in=list(self.__dict__[name])))
+
+            return True
+
+        if changed('_vote_count', self.reported_counts.all()):
+            rows.extend(
+                ReportedCount(subaudit=self, candidate=candidate, position=position, votes=votes)
+                for position, (candidate, votes) in enumerate(self.vote_count.items())
+            )
+
+        for name, role in (('_Sw', utils.WINNER), ('_Sl', utils.LOSER)):
+            if changed(name, self.seats.filter(role=role)):
+                rows.extend(
+                    SeatIndex(subaudit=self, candidate=candidate, role=role, position=position, index=index)
+                    for position, (candidate, index) in enumerate(self.__dict__[name].items())
+                )
+
+        if '_log_T' in self.__dict__:
+            previous = saved.get('_log_T', {})
+            rows.extend(
+                ContestStatistic(
+                    subaudit=self, winner=winner, loser=loser, log_T=log_T, p_value=utils.log_p_value(log_T)
+                )
+                for winner in self.log_T for loser, log_T in self.log_T[winner].items()
+                if previous.get(winner, {}).get(loser) != log_T
+            )
+
+        return deletes, rows
+
+    def _mark_saved(self):
+        saved = self._saved_state()
+        for name in ('_vote_count', '_Sw', '_Sl', '_log_T'):
+            if name in self.__dict__:
+                saved[name] = copy.deepcopy(self.__dict__[name])
+
+
+def save_subaudit_state(subaudits):
+    """
+    Writes the changed reported counts, seat indices and test statistics
+    of several subaudits, with one bulk upsert per table
+    @param subaudits    :   {list<SubAudit>}
+                            Subaudits already saved
+    """
+    deletes = []
+    rows = {}
+    for subaudit in subaudits:
+        subaudit_deletes, subaudit_rows = subaudit._pending_state()
+        deletes.extend(subaudit_deletes)
+        for row in subaudit_rows:
+            rows.setdefault(type(row), []).append(row)
+
+    for queryset in deletes:
+        queryset.delete()
+
+    for model, objs in rows.items():
+        model.objects.bulk_create(
+            objs,
+            update_conflicts=True,
+            unique_fields=model.upsert_unique_fields,
+            update_fields=model.upsert_update_fields
+        )
+
+    for subaudit in subaudits:
+        subaudit._mark_saved()
+
+
+class ReportedCount(models.Model):
+    subaudit = models.ForeignKey(SubAudit, on_delete=models.CASCADE, related_name='reported_counts')
+    candidate = models.CharField(max_length=128)
+    position = models.IntegerField()
+    votes = models.BigIntegerField()
+
+    upsert_unique_fields = ['subaudit', 'candidate']
+    upsert_update_fields = ['position', 'votes']
+
+    class Meta:
+        unique_together = ['subaudit', 'candidate']
+        ordering = ['position']
+
+
+class SeatIndex(models.Model):
+    subaudit = models.ForeignKey(SubAudit, on_delete=models.CASCADE, related_name='seats')
+    candidate = models.CharField(max_length=128)
+    role = models.CharField(max_length=8)
+    position = models.IntegerField()
+    index = models.IntegerField()
+
+    upsert_unique_fields = ['subaudit', 'role', 'candidate']
+    upsert_update_fields = ['position', 'index']
+
+    class Meta:
+        unique_together = ['subaudit', 'role', 'candidate']
+        ordering = ['role', 'position']
+
+
+class ContestStatistic(models.Model):
+    subaudit = models.ForeignKey(SubAudit, on_delete=models.CASCADE, related_name='contests')
+    winner = models.CharField(max_length=128)
+    loser = models.CharField(max_length=128)
+    log_T = models.FloatField(db_index=True)
+    p_value = models.FloatField()
+
+    upsert_unique_fields = ['subaudit', 'winner', 'loser']
+    upsert_update_fields = ['log_T', 'p_value']
+
+    class Meta:
+        unique_together = ['subaudit', 'winner', 'loser']
+        ordering = ['pk']
 
 
 class RecountRegistry(models.Model):
     audit = models.ForeignKey(Audit, on_delete=models.PROTECT)
     recount = models.FileField()
+    checksum = models.CharField(max_length=64, blank=True, default='')
+    applied_tables = models.IntegerField(default=0)
     timestamp = models.DateTimeField(auto_now=True)
+    center = models.CharField(max_length=128, blank=True, default='')
+    sample_size = models.IntegerField(blank=True, null=True)
+    status = models.CharField(max_length=16, default=utils.RECOUNT_APPLIED)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['audit', 'checksum']), models.Index(fields=['audit', 'status'])]
+
+
+class RecountTiming(models.Model):
+    audit = models.ForeignKey(Audit, on_delete=models.PROTECT)
+    recount = models.ForeignKey(RecountRegistry, blank=True, null=True, on_delete=models.SET_NULL)
+    request = models.CharField(max_length=32)
+    timestamp = models.DateTimeField(auto_now_add=True)
+    seconds = models.FloatField()
+    rows = models.BigIntegerField(default=0)
+    bytes_read = models.BigIntegerField(default=0)
+    spans = PickledObjectField(default=list)
+    profile = models.FileField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-timestamp']
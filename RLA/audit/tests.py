@@ -1,3 +1,1049 @@
-from django.test import TestCase
+import bisect
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import tempfile
+from decimal import Decimal
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from clcert_chachagen import ChaChaGen
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from RLA import beacon, benchmark, engine, utils
+from RLA.store import STORE_VERSION, CVRStore, CountFileError, CountStore, load_store
+from audit import jobs
+from audit.context import AuditContext, estimates_key
+from audit.models import Audit, ContestGroup, RecountRegistry, RecountTiming
+
+
+class BatchComparisonTestCase(SimpleTestCase):
+    def setUp(self):
+        self.random = random.Random(2020)
+
+    def _random_contest(self, n_parties, n_tables, n_seats):
+        parties = [f'P{i}' for i in range(n_parties)]
+        table_reports = [{p: self.random.randint(0, 200) for p in parties} for _ in range(n_tables)]
+        table_recounts = [
+            {p: max(0, count[p] + self.random.randint(-3, 3)) for p in parties}
+            for count in table_reports
+        ]
+        reported = {p: sum(count[p] for count in table_reports) for p in parties}
+        pseudo_candidate_votes = {(p, i): utils.p(p, reported, i) for i in range(n_seats) for p in parties}
+        W, L = utils.dhondt_W_L_sets(pseudo_candidate_votes, n_seats)
+        return parties, reported, table_reports, table_recounts, W, L
+
+    def test_batch_MICRO_matches_MICRO(self):
+        for _ in range(20):
+            parties, reported, table_reports, table_recounts, W, L = self._random_contest(
+                self.random.randint(2, 6), self.random.randint(1, 30), self.random.randint(1, 5)
+            )
+            micro = utils.batch_MICRO(
+                utils.count_matrix([reported], parties)[0],
+                utils.count_matrix(table_reports, parties),
+                utils.count_matrix(table_recounts, parties),
+                utils.pair_arrays(W, parties),
+                utils.pair_arrays(L, parties)
+            )
+            expected = [
+                utils.MICRO(reported, report, recount, W, L)
+                for report, recount in zip(table_reports, table_recounts)
+            ]
+            self.assertEqual(list(micro), expected)
+
+    def test_batch_comparison_SPRT_matches_comparison_SPRT(self):
+        for _ in range(20):
+            parties, reported, table_reports, table_recounts, W, L = self._random_contest(
+                self.random.randint(2, 6), self.random.randint(1, 30), self.random.randint(1, 5)
+            )
+            Wp = list(dict.fromkeys(p for p, _ in W))
+            Lp = list(dict.fromkeys(p for p, _ in L))
+            Sw = {p: max(s for q, s in W if q == p) for p in Wp}
+            Sl = {p: min(s for q, s in L if q == p) for p in Lp}
+            u = utils.MICRO_upper_bound(reported, Wp, Lp, Sw, Sl)
+            um = u * max(sum(count.values()) for count in table_reports)
+            U = um * len(table_reports)
+            _, factor = utils.batch_comparison_SPRT(
+                utils.count_matrix([reported], parties)[0],
+                utils.count_matrix(table_reports, parties),
+                utils.count_matrix(table_recounts, parties),
+                utils.pair_arrays(W, parties),
+                utils.pair_arrays(L, parties),
+                um,
+                U
+            )
+            expected = 1.0
+            for report, recount in zip(table_reports, table_recounts):
+                expected *= utils.comparison_SPRT(reported, report, recount, W, L, um, U)
+
+            self.assertAlmostEqual(factor / expected, 1.0, places=12)
+
+    def test_dhondt_allocation_matches_sorted_pseudo_candidates(self):
+        for _ in range(50):
+            n_seats = self.random.randint(1, 12)
+            reported = {f'P{i}': self.random.choice([0, 50, 100, self.random.randint(0, 1000)]) for i in range(8)}
+            max_seats = {p: self.random.randint(1, n_seats) for p in reported}
+            pseudo_candidate_votes = {
+                (p, i): utils.p(p, reported, i) for i in range(n_seats) for p in reported if i < max_seats[p]
+            }
+            W, L = utils.dhondt_W_L_sets(pseudo_candidate_votes, n_seats)
+            Wa, La, Sw, Sl = utils.dhondt_allocation(reported, n_seats, max_seats)
+            self.assertEqual(Wa, W)
+            self.assertEqual(list(Sl), list(dict.fromkeys(p for p, _ in L)))
+            self.assertEqual(Sw, {p: max(s for q, s in W if q == p) for p, _ in W})
+            self.assertEqual(Sl, {p: min(s for q, s in L if q == p) for p, _ in L})
+            self.assertEqual(La, [(p, Sl[p]) for p in Sl])
+
+    def test_batch_MICRO_without_tables(self):
+        parties = ['A', 'B']
+        micro = utils.batch_MICRO(
+            utils.count_matrix([{'A': 10, 'B': 5}], parties)[0],
+            utils.count_matrix([], parties),
+            utils.count_matrix([], parties),
+            utils.pair_arrays([('A', 0)], parties),
+            utils.pair_arrays([('B', 0)], parties)
+        )
+        self.assertEqual(len(micro), 0)
+
+
+class BulkSamplerTestCase(SimpleTestCase):
+    seed = '3f' * 64
+
+    @staticmethod
+    def _sequential_sample(population, sample_size, weights=None, seed=None):
+        chacha = ChaChaGen(seed=seed)
+        if weights is None:
+            weights = [1] * len(population)
+
+        cum_weights = list(itertools.accumulate(weights))
+        total = cum_weights[-1]
+        hi = len(cum_weights) - 1
+        return [
+            population[bisect.bisect(cum_weights, chacha.random() * total, 0, hi)]
+            for i in range(sample_size)
+        ]
+
+    def test_random_array_matches_random(self):
+        chacha = ChaChaGen(seed=self.seed)
+        expected = [chacha.random() for _ in range(20000)]
+        bulk = utils.BulkChaChaGen(seed=self.seed)
+        values = list(bulk.random_array(777)) + list(bulk.random_array(20000 - 777))
+        self.assertEqual(values, expected)
+        self.assertEqual(bulk.random(), chacha.random())
+
+    def test_random_array_falls_back_on_long_draws(self):
+        chacha = ChaChaGen(seed=self.seed)
+        expected = [chacha.random() for _ in range(20000)]
+        bulk = utils.BulkChaChaGen(seed=self.seed)
+        bulk.max_leading_zeros = 1
+        self.assertEqual(list(bulk.random_array(20000)), expected)
+
+    def test_random_sample_matches_sequential_sampler(self):
+        population = list(range(500))
+        weights = np.random.RandomState(0).rand(500)
+        for w in (None, weights, [i % 4 for i in range(500)]):
+            self.assertEqual(
+                utils.random_sample(population, 5000, weights=w, seed=self.seed),
+                self._sequential_sample(population, 5000, weights=w, seed=self.seed)
+            )
+
+
+def cast_vote_records(df, rng):
+    """
+    Expands a vote count into one cast vote record per ballot, with
+    shuffled ballot identifiers
+    """
+    cvr = df.loc[df.index.repeat(df['votes'])].drop(columns='votes').reset_index(drop=True)
+    cvr['ballot'] = [f'B{i:06d}' for i in rng.permutation(len(cvr))]
+    return cvr
+
+
+class CountStoreTestCase(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        candidates = {f'C{i}': f'P{i % 3}' for i in range(7)}
+        self.df = pd.DataFrame([
+            {'table': table, 'candidate': candidate, 'party': party, 'votes': rng.randint(0, 100)}
+            for table in rng.permutation(50) for candidate, party in candidates.items()
+        ])
+        fd, self.path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        self.df.to_csv(self.path, index=False)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_chunked_ingestion_matches_full_read(self):
+        expected = self.df.groupby(['table', 'candidate'])['votes'].sum().unstack()
+        for chunksize in (1, 13, 10 ** 6):
+            store = CountStore.from_csv(self.path, chunksize=chunksize)
+            self.assertEqual(store.tables.tolist(), expected.index.tolist())
+            self.assertEqual(store.candidates.tolist(), expected.columns.tolist())
+            self.assertTrue((store.vote_matrix == expected.to_numpy()).all())
+            self.assertEqual(
+                store.party_totals().to_dict(),
+                self.df.groupby('party')['votes'].sum().to_dict()
+            )
+            self.assertEqual(
+                store.candidate_party_map(),
+                self.df.groupby('candidate')['party'].first().to_dict()
+            )
+
+    def test_load_store_follows_file_changes(self):
+        store = CountStore.from_csv(self.path)
+        fd, path = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        with open(path, 'wb') as f:
+            f.write(store.dump())
+
+        loaded = load_store(path)
+        self.assertIs(load_store(path), loaded)
+
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNot(load_store(path), loaded)
+
+        with open(path, 'wb') as f:
+            f.write(store.subset(np.arange(10)).dump())
+
+        self.assertEqual(len(load_store(path).tables), 10)
+
+    def test_recount_keeps_the_preliminary_table_labels(self):
+        df = pd.DataFrame([
+            {'table': table, 'candidate': candidate, 'party': 'P', 'votes': 10}
+            for table in ('1', '2', '3A') for candidate in ('A', 'B')
+        ])
+        df.to_csv(self.path, index=False)
+        store = CountStore.from_csv(self.path)
+        df[df['table'] != '3A'].to_csv(self.path, index=False)
+        recount = store.read_recount(self.path)
+        self.assertEqual(sorted(recount['table'].unique().tolist()), ['1', '2'])
+        self.assertTrue(all(table in store.table_index for table in recount['table']))
+
+    def test_party_votes(self):
+        store = CountStore.from_csv(self.path)
+        expected = self.df.groupby(['table', 'party'])['votes'].sum().unstack()
+        self.assertEqual(store.party_votes(store.vote_matrix).tolist(), expected.to_numpy().tolist())
+        self.assertEqual(store.party_votes(store.vote_matrix[3]).tolist(), expected.iloc[3].tolist())
+
+    def test_missing_headers(self):
+        self.df.drop(columns='votes').to_csv(self.path, index=False)
+        with self.assertRaises(CountFileError):
+            CountStore.from_csv(self.path)
+
+    def test_cvr_store(self):
+        cvr = cast_vote_records(self.df, np.random.RandomState(1))
+        cvr.to_csv(self.path, index=False)
+        count = self.df.groupby(['table', 'candidate'])['votes'].sum().unstack()
+        for chunksize in (7, 10 ** 6):
+            store = CVRStore.from_csv(self.path, chunksize=chunksize)
+            self.assertTrue((store.vote_matrix == count.to_numpy()).all())
+            ordinals = store.ballot_ordinals(cvr['table'].astype(str).to_numpy(), cvr['ballot'].to_numpy())
+            self.assertEqual(sorted(ordinals.tolist()), list(range(len(cvr))))
+            self.assertEqual(store.candidates[store.ballot_candidates[ordinals]].tolist(), cvr['candidate'].tolist())
+            self.assertEqual(store.tables[store.ballot_tables[ordinals]].tolist(), cvr['table'].tolist())
+
+        self.assertEqual(store.ballot_ordinals(np.array(['3', '999', 'x']), np.array(['missing'] * 3)).tolist(), [-1] * 3)
+        with tempfile.NamedTemporaryFile(suffix='.npz') as f:
+            f.write(store.dump())
+            f.flush()
+            loaded = CountStore.load(f.name)
+
+        self.assertIsInstance(loaded, CVRStore)
+        self.assertTrue((loaded.ballot_ids == store.ballot_ids).all())
+        pd.concat([cvr, cvr.iloc[:1]]).to_csv(self.path, index=False)
+        with self.assertRaises(CountFileError):
+            CVRStore.from_csv(self.path)
+
+
+class BeaconTestCase(SimpleTestCase):
+    timestamp = timezone.make_aware(datetime.datetime(2020, 1, 1))
+
+    class CountingSource(beacon.FileBeaconSource):
+        def __init__(self, path):
+            super().__init__(path)
+            self.calls = 0
+
+        def get_pulse(self, time):
+            self.calls += 1
+            return super().get_pulse(time)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.time = beacon.pulse_time(self.timestamp)
+        self.pulses = os.path.join(self.tmp.name, 'pulses.json')
+        with open(self.pulses, 'w') as f:
+            json.dump({str(self.time): {'localRandomValue': 'ab' * 64}}, f)
+
+    def test_pulses_are_cached_in_memory_and_on_disk(self):
+        cache_dir = os.path.join(self.tmp.name, 'cache')
+        source = self.CountingSource(self.pulses)
+        client = beacon.BeaconClient(source, cache_dir=cache_dir)
+        self.assertEqual(client.get_random_seed(self.timestamp), 'ab' * 64)
+        self.assertEqual(client.get_random_seed(self.timestamp), 'ab' * 64)
+        self.assertEqual(source.calls, 1)
+        self.assertEqual(os.listdir(cache_dir), [f'{self.time}.json'])  # no temporary file left
+
+        os.remove(self.pulses)
+        source = self.CountingSource(self.pulses)
+        self.assertEqual(beacon.BeaconClient(source, cache_dir=cache_dir).get_random_seed(self.timestamp), 'ab' * 64)
+        self.assertEqual(source.calls, 0)
+        with self.assertRaises(beacon.BeaconError):
+            beacon.BeaconClient(source).get_pulse(self.timestamp)
+
+    def test_file_source_reads_a_pulse_directory(self):
+        client = beacon.BeaconClient(beacon.FileBeaconSource(self.pulses), cache_dir=os.path.join(self.tmp.name, 'cache'))
+        client.get_pulse(self.timestamp)
+        source = beacon.FileBeaconSource(os.path.join(self.tmp.name, 'cache'))
+        self.assertEqual(source.get_pulse(self.time), {'localRandomValue': 'ab' * 64})
+        with self.assertRaises(beacon.BeaconError):
+            source.get_pulse(self.time + 1)
+
+    def test_remote_source_configuration(self):
+        source = beacon.RemoteBeaconSource(url='https://beacon.test/pulse/', timeout=2, retries=5)
+        retry = source.session.get_adapter('https://beacon.test/').max_retries
+        self.assertEqual((source.timeout, retry.total), (2, 5))
+        self.assertIn(503, retry.status_forcelist)
+
+    def test_client_follows_the_settings(self):
+        with override_settings(RANDOM_BEACON={'SOURCE': 'RLA.beacon.FileBeaconSource', 'OPTIONS': {'path': self.pulses}}):
+            client = beacon.get_client()
+            self.assertIs(beacon.get_client(), client)
+            self.assertEqual(client.source.path, self.pulses)
+
+        self.assertIsNot(beacon.get_client(), client)
+
+
+@override_settings(AUDIT_JOBS={'ASYNC': False})
+class RecountQueriesTestCase(TestCase):
+    seed = 'ab' * 64
+    seed_time = '2020-01-01 00:00:00'
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        pulses = os.path.join(self.tmp.name, 'pulses.json')
+        time = beacon.pulse_time(timezone.make_aware(datetime.datetime.fromisoformat(self.seed_time)))
+        with open(pulses, 'w') as f:
+            json.dump({str(time): {'localRandomValue': self.seed}}, f)
+
+        settings = override_settings(
+            MEDIA_ROOT=self.tmp.name,
+            RANDOM_BEACON={'SOURCE': 'RLA.beacon.FileBeaconSource', 'OPTIONS': {'path': pulses}}
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(self.tmp.cleanup)
+        self.addCleanup(cache.clear)  # audit primary keys are reused between tests
+        rng = random.Random(0)
+        candidates = {'A': ('P1', 30), 'B': ('P1', 10), 'C': ('P2', 20), 'D': ('P2', 12), 'E': ('P3', 8), 'F': ('P3', 3)}
+        self.df = pd.DataFrame([
+            {'table': table, 'candidate': candidate, 'party': party, 'votes': votes + rng.randint(0, 5)}
+            for table in range(1, 31) for candidate, (party, votes) in candidates.items()
+        ])
+
+    def _create_audit(self, audit_type, seed_time=None):
+        response = self.client.post('/new/', {
+            'election_type': utils.DHONDT,
+            'audit_type': audit_type,
+            'random_seed_time': seed_time or self.seed_time,
+            'risk_limit': 0.05,
+            'n_winners': 3,
+            'max_polls': 10000,
+            'preliminary_count_file': SimpleUploadedFile('count.csv', self.df.to_csv(index=False).encode())
+        })
+        self.assertEqual(response.status_code, 302)
+        audit = Audit.objects.latest('pk')
+        self.client.get(f'/dhondt/recount/{audit.pk}/')
+        return audit
+
+    def _recount(self, audit, tables):
+        recount = self.df[self.df['table'].isin([int(table) for table in tables])].copy()
+        recount.loc[(recount['candidate'] == 'A') & (recount['table'] % 3 == 0), 'votes'] -= 1
+        return SimpleUploadedFile('recount.csv', recount.to_csv(index=False).encode())
+
+    def _get_round(self, audit):
+        context = self.client.get(f'/dhondt/recount/{audit.pk}/').context
+        return context['tables'], context['form'].initial['recounted_ballots']
+
+    def _assert_round_queries(self, audit_type, recount_queries, validation_queries):
+        audit = self._create_audit(audit_type)
+        for _ in range(2):
+            tables, sample_size = self._get_round(audit)
+            if not tables:
+                break
+
+            with self.assertNumQueries(recount_queries):
+                response = self.client.post(
+                    f'/dhondt/recount/{audit.pk}/',
+                    {'recount': self._recount(audit, tables), 'recounted_ballots': sample_size}
+                )
+                self.assertEqual(response.status_code, 302)
+
+            with self.assertNumQueries(validation_queries):
+                self.assertEqual(self.client.get(f'/dhondt/validated/{audit.pk}/').status_code, 200)
+
+            if Audit.objects.get(pk=audit.pk).validated:
+                break
+
+    def test_initialization_retries(self):
+        audit = self._create_audit(utils.BALLOT_POLLING, seed_time='2999-01-01 00:00:00')
+        self.assertContains(self.client.get(f'/dhondt/recount/{audit.pk}/'), 'The random pulse will be emitted')
+
+        seed_time = '2021-01-01 00:00:00'
+        audit = self._create_audit(utils.BALLOT_POLLING, seed_time=seed_time)
+        audit.refresh_from_db()
+        self.assertEqual(audit.init_status, utils.INIT_FAILED)
+        failed_at = audit.init_updated
+        self.assertContains(self.client.get(f'/dhondt/recount/{audit.pk}/'), 'The sample could not be drawn')
+        audit.refresh_from_db()
+        self.assertEqual((audit.init_status, audit.init_updated), (utils.INIT_FAILED, failed_at))
+
+        pulses = os.path.join(self.tmp.name, 'pulses.json')
+        with open(pulses) as f:
+            time = beacon.pulse_time(timezone.make_aware(datetime.datetime.fromisoformat(seed_time)))
+            emitted = {**json.load(f), str(time): {'localRandomValue': self.seed}}
+
+        with open(pulses, 'w') as f:
+            json.dump(emitted, f)
+
+        call_command('run_audit_jobs', '--once', stdout=io.StringIO())
+        self.assertEqual(Audit.objects.get(pk=audit.pk).init_updated, failed_at)
+
+        Audit.objects.filter(pk=audit.pk).update(init_updated=failed_at - datetime.timedelta(hours=1))
+        call_command('run_audit_jobs', '--once', stdout=io.StringIO())
+        audit.refresh_from_db()
+        self.assertEqual(audit.init_status, utils.INIT_READY)
+
+        Audit.objects.filter(pk=audit.pk).update(init_status=utils.INIT_RUNNING, init_updated=timezone.now())
+        self.assertFalse(jobs.run_initialization(audit.pk))
+        self.assertEqual(Audit.objects.get(pk=audit.pk).init_status, utils.INIT_RUNNING)
+
+    def test_ballot_polling_round_queries(self):
+        self._assert_round_queries(utils.BALLOT_POLLING, 15, 3)
+
+    def test_comparison_round_queries(self):
+        self._assert_round_queries(utils.COMPARISON, 14, 3)
+
+    def test_stale_store_is_rebuilt(self):
+        audit = self._create_audit(utils.BALLOT_POLLING)
+        store = audit.get_store()
+        stale_stores = [
+            CountStore(store.tables, store.candidates, store.vote_matrix, 'stale', store.parties, store.candidate_parties),
+            CountStore(store.tables, store.candidates, store.vote_matrix, store.checksum, store.parties,
+                       store.candidate_parties, version=STORE_VERSION - 1),
+        ]
+        for stale in stale_stores:
+            with open(audit.preliminary_store.path, 'wb') as f:
+                f.write(stale.dump())
+
+            self.assertFalse(load_store(audit.preliminary_store.path).is_valid(audit.preliminary_checksum))
+            rebuilt = audit.get_store()
+            self.assertTrue(rebuilt.is_valid(audit.preliminary_checksum))
+            self.assertTrue((rebuilt.vote_matrix == store.vote_matrix).all())
+            self.assertTrue(load_store(audit.preliminary_store.path).is_valid(audit.preliminary_checksum))
+
+        replaced = self.df.assign(votes=self.df['votes'] + 1)
+        with open(audit.preliminary_count.path, 'w') as f:
+            replaced.to_csv(f, index=False)
+
+        audit = Audit.objects.get(pk=audit.pk)
+        self.assertEqual(int(audit.get_store().vote_matrix.sum()), replaced['votes'].sum())
+        self.assertEqual(Audit.objects.get(pk=audit.pk).preliminary_checksum, audit.preliminary_checksum)
+
+    def test_relational_state_round_trip(self):
+        for audit_type in (utils.BALLOT_POLLING, utils.COMPARISON):
+            audit = self._create_audit(audit_type)
+            tables, sample_size = self._get_round(audit)
+            self.client.post(
+                f'/dhondt/recount/{audit.pk}/',
+                {'recount': self._recount(audit, tables), 'recounted_ballots': sample_size}
+            )
+            context = AuditContext.load(audit.pk)
+            subaudit = context.secondaries[0]
+            dropped = list(subaudit.vote_count)[-1]
+            subaudit.vote_count = {c: votes + 1 for c, votes in subaudit.vote_count.items() if c != dropped}
+            subaudit.Sw = {c: index + 1 for c, index in subaudit.Sw.items()}
+            subaudit.log_T = {w: {l: value + 10 for l, value in losers.items()} for w, losers in subaudit.log_T.items()}
+            context.save()
+
+            expected = [(s.vote_count, s.Sw, s.Sl, s.log_T, s.T) for s in context.subaudits]
+            loaded = AuditContext.load(audit.pk)
+            self.assertEqual([(s.vote_count, s.Sw, s.Sl, s.log_T, s.T) for s in loaded.subaudits], expected)
+            self.assertNotIn(dropped, loaded.secondaries[0].vote_count)
+
+            if audit_type == utils.BALLOT_POLLING:
+                p_values = [utils.max_log_p_value(s.log_T) for s in loaded.subaudits]
+
+            else:
+                p_values = [s.max_p_value for s in loaded.subaudits]
+
+            self.assertAlmostEqual(audit.get_max_p_value(), max(p_values))
+            self.assertEqual(audit.is_validated(), all(s.validated() for s in loaded.subaudits))
+
+            for s in loaded.subaudits:
+                s.log_T = {w: {l: 100.0 for l in losers} for w, losers in s.log_T.items()}
+                s.T = 1e6
+
+            loaded.save()
+            self.assertTrue(all(s.validated() for s in AuditContext.load(audit.pk).subaudits))
+            self.assertTrue(audit.is_validated())
+
+    def test_audit_lists_load_only_summaries(self):
+        audit = self._create_audit(utils.BALLOT_POLLING)
+        for url in ('/', '/summary/'):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(queries), 2)
+            self.assertNotIn('vote_count', queries[-1]['sql'])
+
+        summary = self.client.get('/summary/').json()
+        self.assertEqual(summary['count'], 1)
+        self.assertEqual(summary['audits'][0]['id'], audit.pk)
+        self.assertEqual(summary['audits'][0]['total_ballots'], self.df['votes'].sum())
+        self.assertEqual(summary['audits'][0]['progress'], 0)
+
+    def test_recount_timings(self):
+        audit = self._create_audit(utils.COMPARISON)
+        tables, sample_size = self._get_round(audit)
+        with override_settings(AUDIT_INSTRUMENTATION={'PROFILE': True}):
+            self.client.post(
+                f'/dhondt/recount/{audit.pk}/',
+                {'recount': self._recount(audit, tables), 'recounted_ballots': sample_size}
+            )
+
+        timing = RecountTiming.objects.filter(audit=audit, request=utils.TIMING_RECOUNT_POST).get()
+        spans = {span['name']: span for span in timing.spans}
+        self.assertEqual(timing.recount, audit.recountregistry_set.get())
+        self.assertEqual(spans['parse_recount']['rows'], 6 * len(tables))
+        self.assertEqual(spans['sprt']['depth'], 1)
+        self.assertEqual(timing.bytes_read, timing.recount.recount.size)
+        self.assertTrue(timing.profile)
+        self.assertTrue(RecountTiming.objects.filter(audit=audit, request=utils.TIMING_INITIALIZATION, profile='').exists())
+        self.assertContains(self.client.get(f'/audit/view/{audit.pk}/'), 'parse_recount')
+
+        page_views = RecountTiming.objects.filter(audit=audit, request=utils.TIMING_RECOUNT_GET)
+        for rate, stored in ((0, 0), (1, 1)):
+            with override_settings(AUDIT_INSTRUMENTATION={'PAGE_VIEW_RATE': rate}):
+                page_views.delete()
+                self._get_round(audit)
+                self.assertEqual(page_views.count(), stored)
+
+    def test_contest_group_recount(self):
+        response = self.client.post('/audit/group/new/', {'name': 'Municipal', 'random_seed_time': self.seed_time})
+        self.assertEqual(response.status_code, 302)
+        group_url = response['Location']
+        group = ContestGroup.objects.get()
+
+        def create(contest, election_type, audit_type):
+            return self.client.post('/new/', {
+                'election_type': election_type,
+                'audit_type': audit_type,
+                'risk_limit': 0.05,
+                'n_winners': 3,
+                'max_polls': 10000,
+                'preliminary_count_file': SimpleUploadedFile('count.csv', self.df.to_csv(index=False).encode()),
+                'group': group.pk,
+                'contest': contest
+            })
+
+        self.assertEqual(create('mayor', utils.SIMPLE_MAJORITY, utils.BALLOT_POLLING).status_code, 302)
+        self.assertEqual(create('council', utils.DHONDT, utils.BALLOT_POLLING).status_code, 302)
+        self.assertEqual(create('mayor', utils.DHONDT, utils.BALLOT_POLLING).status_code, 200)
+        self.assertEqual(create('board', utils.DHONDT, utils.COMPARISON).status_code, 200)
+        mayor = Audit.objects.get(contest='mayor')
+        self.assertRedirects(self.client.get(f'/simplemajority/recount/{mayor.pk}/'), group_url, target_status_code=200)
+
+        response = self.client.get(group_url)
+        tables = [int(table) for table in response.context['tables']]
+        recount = self.df[self.df['table'].isin(tables)]
+        recount = pd.concat([recount.assign(contest='mayor'), recount.assign(contest='council')])
+        upload = {'sample_size': response.context['sample_size']}
+        response = self.client.post(group_url, {
+            **upload, 'recount': SimpleUploadedFile('recount.csv', recount[recount['contest'] == 'mayor'].to_csv(index=False).encode())
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(RecountRegistry.objects.exists())
+        self.assertFalse([name for name in os.listdir(self.tmp.name) if name.startswith('recount_')])
+
+        response = self.client.post(group_url, {
+            **upload, 'recount': SimpleUploadedFile('recount.csv', recount.to_csv(index=False).encode())
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(RecountRegistry.objects.count(), 2)
+        group.refresh_from_db()
+        self.assertEqual(group.shuffled_offset, upload['sample_size'])
+        for audit in group.audits.all():
+            self.assertEqual(audit.polled_ballots, recount[recount['contest'] == audit.contest]['votes'].sum())
+
+    def test_ballot_comparison_recount(self):
+        cvr = cast_vote_records(self.df, np.random.RandomState(0))
+        response = self.client.post('/new/', {
+            'election_type': utils.DHONDT,
+            'audit_type': utils.BALLOT_COMPARISON,
+            'random_seed_time': self.seed_time,
+            'risk_limit': 0.05,
+            'n_winners': 3,
+            'max_polls': 10000,
+            'preliminary_count_file': SimpleUploadedFile('cvr.csv', cvr.to_csv(index=False).encode())
+        })
+        self.assertEqual(response.status_code, 302)
+        audit = Audit.objects.latest('pk')
+        url = f'/dhondt/recount/{audit.pk}/'
+        self.client.get(url)
+
+        unknown = SimpleUploadedFile('recount.csv', b'table,ballot,candidate\n1,X,A\n')
+        response = self.client.post(url, {'recount': unknown, 'recounted_ballots': 1})
+        self.assertIn('recount', response.context['form'].errors)
+
+        for _ in range(5):
+            tables, sample_size = self._get_round(audit)
+            sampled = {(str(table), ballot) for table, ballots in tables.items() for ballot in ballots.split(', ')}
+            recount = cvr[[(str(table), ballot) in sampled for table, ballot in zip(cvr['table'], cvr['ballot'])]]
+            recount = SimpleUploadedFile('recount.csv', recount[['table', 'ballot', 'candidate']].to_csv(index=False).encode())
+            self.client.post(url, {'recount': recount, 'recounted_ballots': sample_size})
+            self.client.get(f'/dhondt/validated/{audit.pk}/')
+            audit.refresh_from_db()
+            if audit.validated:
+                break
+
+        self.assertTrue(audit.validated)
+        self.assertLess(audit.polled_ballots, len(cvr) // 10)
+
+    def test_repeated_and_overlapping_uploads_apply_once(self):
+        audit = self._create_audit(utils.COMPARISON)
+        sample, sample_size = self._get_round(audit)
+        tables = list(sample)
+        url = f'/dhondt/recount/{audit.pk}/'
+
+        def upload(round_tables):
+            return {'recount': self._recount(audit, round_tables), 'recounted_ballots': sample_size}
+
+        self.client.post(url, upload(tables[:2]))
+        audit.refresh_from_db()
+        self.assertEqual(audit.shuffled_offset, 0)
+        self.assertEqual(audit.round_tables, {int(table) for table in tables[:2]})
+        self.assertEqual(self._get_round(audit)[0], sample)
+
+        polled = audit.polled_ballots
+        self.assertContains(self.client.post(url, upload(tables[:2])), utils.RECOUNT_NOTHING_PENDING)
+        self.assertEqual(Audit.objects.get(pk=audit.pk).polled_ballots, polled)
+
+        self.client.post(url, upload(tables))
+        audit.refresh_from_db()
+        self.assertEqual(audit.polled_ballots, self.df[self.df['table'].isin([int(table) for table in tables])]['votes'].sum() - len(
+            [table for table in tables if int(table) % 3 == 0]
+        ))
+        self.assertEqual(list(audit.recountregistry_set.order_by('pk').values_list('applied_tables', flat=True)), [2, 0, len(tables) - 2])
+        self.assertEqual((audit.shuffled_offset, audit.round_size, audit.round_tables), (len(tables), 0, set()))
+
+    def test_redrawn_tables_are_recounted_again(self):
+        audit = self._create_audit(utils.COMPARISON)
+        url = f'/dhondt/recount/{audit.pk}/'
+        rounds = []
+        for _ in range(2):
+            sample, sample_size = self._get_round(audit)
+            rounds.append(set(sample))
+            for table in sample:
+                response = self.client.post(url, {'recount': self._recount(audit, [table]), 'recounted_ballots': sample_size})
+                self.assertEqual(response.status_code, 302)
+
+            audit.refresh_from_db()
+            self.assertEqual((audit.round_size, audit.round_tables), (0, set()))
+
+        self.assertTrue(rounds[0] & rounds[1])  # identical uploads of the redrawn tables
+
+    def test_sample_size_estimates_are_cached(self):
+        audit = self._create_audit(utils.BALLOT_POLLING)
+        tables, sample_size = self._get_round(audit)
+        fingerprint, estimates = cache.get(estimates_key(audit.pk))
+        self.assertEqual(estimates['sample_size'], sample_size)
+        self.assertIn('round_schedule', estimates)
+
+        cache.set(estimates_key(audit.pk), (fingerprint, {**estimates, 'sample_size': sample_size + 1}))
+        self.assertEqual(self._get_round(audit)[1], sample_size + 1)
+        audit_context = AuditContext(Audit.objects.get(pk=audit.pk))
+        with self.assertNumQueries(0):  # a cache hit loads no subaudit
+            self.assertEqual(engine.get_sample_size(audit_context), sample_size + 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f'/dhondt/recount/{audit.pk}/',
+                {'recount': self._recount(audit, tables), 'recounted_ballots': sample_size}
+            )
+
+        self.assertIsNone(cache.get(estimates_key(audit.pk)))
+        self.assertNotEqual(self._get_round(audit)[0], tables)
+
+    def test_bulk_recount_api(self):
+        audit = self._create_audit(utils.COMPARISON)
+        sample, sample_size = self._get_round(audit)
+        tables = list(sample)
+        url = f'/audit/view/{audit.pk}/recounts/'
+        response = self.client.post(url, {
+            'recount': [
+                self._recount(audit, tables[:2]),
+                self._recount(audit, tables[:2]),
+                SimpleUploadedFile('recount.csv', b'table,votes\n1,3\n')
+            ],
+            'center': ['north', 'north again', 'south'],
+            'sample_size': sample_size,
+        })
+        self.assertEqual(response.status_code, 202)
+        body = response.json()
+        self.assertEqual([(r['center'], r['status'], r['applied_tables']) for r in body['recounts']], [('north', 'applied', 2)])
+        self.assertEqual([r['error'] for r in body['rejected']], ['Repeated in this request', 'Headers not valid'])
+
+        rows = pd.read_csv(self._recount(audit, tables)).to_dict('records')
+        response = self.client.post(
+            url,
+            json.dumps({'recounts': [{'center': 'east', 'rows': rows}], 'sample_size': sample_size}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['recounts'][0]['applied_tables'], len(tables) - 2)
+        audit.refresh_from_db()
+        self.assertEqual((audit.shuffled_offset, audit.round_size, audit.round_tables), (len(tables), 0, set()))
+        self.assertEqual(
+            [r['center'] for r in self.client.get(url).json()['recounts']], ['north', 'east']
+        )
+        self.assertEqual(self.client.post(url, '{', content_type='application/json').status_code, 400)
+
+        client = Client(enforce_csrf_checks=True)
+        self.assertEqual(client.post(url, '{', content_type='application/json').status_code, 403)
+        token = client.get(url).cookies['csrftoken'].value
+        self.assertEqual(client.post(url, '{', content_type='application/json', headers={'X-CSRFToken': token}).status_code, 400)
+
+    def test_failed_recount_does_not_block_the_queue(self):
+        audit = self._create_audit(utils.BALLOT_POLLING)
+        sample, sample_size = self._get_round(audit)
+        tables = list(sample)
+        unknown_candidate = self.df[self.df['table'] == int(tables[0])].copy()
+        unknown_candidate.loc[unknown_candidate['candidate'] == 'F', 'candidate'] = 'Z'
+        unknown_table = self.df[self.df['table'] == int(tables[0])].assign(table=99)
+        response = self.client.post(f'/audit/view/{audit.pk}/recounts/', {
+            'recount': [
+                SimpleUploadedFile('z.csv', unknown_candidate.to_csv(index=False).encode()),
+                SimpleUploadedFile('t.csv', unknown_table.to_csv(index=False).encode()),
+                self._recount(audit, tables),
+            ],
+            'center': ['north', 'south', 'east'],
+            'sample_size': sample_size,
+        })
+        self.assertEqual(
+            [(r['center'], r['status'], r['error']) for r in response.json()['recounts']],
+            [('north', 'failed', 'Unknown candidate Z'), ('south', 'failed', 'Unknown table 99'), ('east', 'applied', '')]
+        )
+        audit.refresh_from_db()
+        self.assertEqual((audit.round_size, audit.round_tables), (0, set()))
+
+
+class EngineTestCase(SimpleTestCase):
+    seed = 'cd' * 64
+
+    def _count(self, winner_votes):
+        rng = random.Random(0)
+        candidates = {
+            'A': ('P1', winner_votes), 'B': ('P1', 10), 'C': ('P2', 20), 'D': ('P2', 12), 'E': ('P3', 8), 'F': ('P3', 3)
+        }
+        df = pd.DataFrame([
+            {'table': table, 'candidate': candidate, 'party': party, 'votes': votes + rng.randint(0, 5)}
+            for table in range(1, 401) for candidate, (party, votes) in candidates.items()
+        ])
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        df.to_csv(path, index=False)
+        store = CountStore.from_csv(path)
+        os.remove(path)
+        return df, store
+
+    def test_exact_comparison_recounts_validate_the_audit(self):
+        elections = ((utils.SIMPLE_MAJORITY, 1, 30), (utils.SUPER_MAJORITY, 1, 120), (utils.DHONDT, 3, 30))
+        for election_type, n_winners, winner_votes in elections:
+            df, store = self._count(winner_votes)
+            context = engine.create_audit(store, election_type, utils.COMPARISON, 0.05, n_winners=n_winners)
+            engine.init_shuffled(context, self.seed)
+            for _ in range(10):
+                tables, _ = engine.draw_sample(context, engine.get_sample_size(context))
+                engine.apply_recount(context, df[df['table'].isin(list(tables))])
+                if engine.check_status(context):
+                    break
+
+            self.assertTrue(context.audit.validated, election_type)
+            self.assertLessEqual(context.audit.max_p_value, 0.05)
+            self.assertLess(context.audit.polled_ballots, df['votes'].sum())
+
+    def test_ballot_comparison_audit(self):
+        df, count_store = self._count(30)
+        cvr = cast_vote_records(df, np.random.RandomState(0))
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        cvr.to_csv(path, index=False)
+        store = CVRStore.from_csv(path)
+        os.remove(path)
+        polled = {}
+        for audit_type, audit_store in ((utils.BALLOT_COMPARISON, store), (utils.COMPARISON, count_store)):
+            context = engine.create_audit(audit_store, utils.DHONDT, audit_type, 0.05, n_winners=3)
+            engine.init_shuffled(context, self.seed)
+            for _ in range(10):
+                sample_size = engine.get_sample_size(context)
+                if audit_type == utils.BALLOT_COMPARISON:
+                    ordinals = context.audit.get_shuffled(sample_size)
+                    recount = engine.simulation._cvr_recount_df(store, ordinals, store.ballot_candidates[ordinals])
+
+                else:
+                    tables, _ = engine.draw_sample(context, sample_size)
+                    recount = df[df['table'].isin(list(tables))]
+
+                engine.apply_recount(context, recount)
+                if engine.check_status(context):
+                    break
+
+            self.assertTrue(context.audit.validated, audit_type)
+            polled[audit_type] = context.audit.polled_ballots
+
+        self.assertLess(10 * polled[utils.BALLOT_COMPARISON], polled[utils.COMPARISON])
+
+        # A round recounted with a misrecorded ballot and a missing one
+        context = engine.create_audit(store, utils.DHONDT, utils.BALLOT_COMPARISON, 0.05, n_winners=3)
+        engine.init_shuffled(context, self.seed)
+        sample_size = engine.get_sample_size(context)
+        ordinals = context.audit.get_shuffled(sample_size)
+        candidates = store.ballot_candidates[ordinals].copy()
+        candidates[0] = (candidates[0] + 1) % len(store.candidates)
+        recount = engine.simulation._cvr_recount_df(store, ordinals, candidates)
+        tables, counts = np.unique(store.ballot_tables[ordinals], return_counts=True)
+        missing = np.flatnonzero(np.isin(store.ballot_tables[ordinals], tables[counts > 1]))[-1]
+        recount = recount[recount['ballot'] != store.ballot_ids[ordinals[missing]]]
+        self.assertEqual(engine.apply_recount(context, recount, sample_size=sample_size), recount['table'].nunique())
+        self.assertEqual(context.audit.shuffled_offset, sample_size)
+        self.assertFalse(engine.check_status(context))
+        self.assertGreater(context.audit.max_p_value, 0.05)
+
+    def _strata_recounts(self, stratified, sample_sizes, swap=None):
+        recounts = {}
+        for name, sample_size in sample_sizes.items():
+            if not sample_size:
+                continue
+
+            stratum = stratified.strata[name]
+            store = stratum.get_store()
+            sample = stratum.get_shuffled(sample_size)
+            if stratum.audit_type == utils.BALLOT_COMPARISON:
+                recounts[name] = engine.simulation._cvr_recount_df(store, sample, store.ballot_candidates[sample])
+                continue
+
+            if stratum.audit_type == utils.BALLOT_POLLING:
+                table_codes, _ = utils.ballot_positions(sample, store.table_totals)
+                ballots = np.bincount(table_codes, minlength=len(store.tables))
+                table_codes = np.flatnonzero(ballots)
+                tables = store.vote_matrix[table_codes]
+                recount = np.random.default_rng(0).multinomial(
+                    ballots[table_codes], tables / tables.sum(axis=1, keepdims=True)
+                )
+
+            else:  # stratum.audit_type == utils.COMPARISON
+                table_codes = np.unique(sample)
+                recount = store.vote_matrix[table_codes].copy()
+
+            if swap is not None:
+                recount[:, list(swap)] = recount[:, list(reversed(swap))]
+
+            recounts[name] = engine.simulation._recount_df(store, table_codes, recount)
+
+        return recounts
+
+    def test_stratified_audit(self):
+        df, count_store = self._count(30)
+        tables = count_store.tables.tolist()
+        cvr = cast_vote_records(df[df['table'].isin(tables[:100])], np.random.RandomState(0))
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        cvr.to_csv(path, index=False)
+        cvr_store = CVRStore.from_csv(path)
+        os.remove(path)
+        strata = {
+            'cvr': (utils.BALLOT_COMPARISON, cvr_store),
+            'polling': (utils.BALLOT_POLLING, tables[100:250]),
+            'comparison': (utils.COMPARISON, tables[250:]),
+        }
+        with self.assertRaises(ValueError):
+            engine.create_stratified_audit(count_store, utils.DHONDT, 0.05, {'polling': strata['polling']})
+
+        p_values = {}
+        for workers in (1, 2):
+            stratified = engine.create_stratified_audit(count_store, utils.DHONDT, 0.05, strata, n_winners=3)
+            engine.init_strata_shuffled(stratified, self.seed)
+            p_values[workers] = []
+            for _ in range(10):
+                sample_sizes = engine.get_strata_sample_sizes(stratified)
+                samples = engine.draw_strata_sample(stratified, sample_sizes)
+                self.assertEqual(set(samples), {name for name, size in sample_sizes.items() if size})
+                recounts = self._strata_recounts(stratified, sample_sizes)
+                p_values[workers].append(
+                    engine.apply_strata_recount(stratified, recounts, sample_sizes, workers=workers)
+                )
+                if engine.check_strata_status(stratified):
+                    break
+
+            self.assertTrue(stratified.audit.validated)
+            self.assertLess(stratified.audit.polled_ballots, df['votes'].sum() / 4)
+
+        self.assertEqual(p_values[1], p_values[2])
+
+        # Recounts of the table strata that swap the two most voted candidates
+        stratified = engine.create_stratified_audit(count_store, utils.DHONDT, 0.05, strata, n_winners=3)
+        engine.init_strata_shuffled(stratified, self.seed)
+        swap = (count_store.candidates.tolist().index('A'), count_store.candidates.tolist().index('C'))
+        for _ in range(5):
+            sample_sizes = engine.get_strata_sample_sizes(stratified)
+            recounts = self._strata_recounts(stratified, sample_sizes, swap=swap)
+            engine.apply_strata_recount(stratified, recounts, sample_sizes, workers=1)
+            engine.check_strata_status(stratified)
+
+        self.assertFalse(stratified.audit.validated)
+        self.assertGreater(stratified.audit.max_p_value, 0.05)
+
+    def test_simulation_does_not_depend_on_workers(self):
+        _, store = self._count(30)
+        results = [
+            engine.simulate(
+                store, utils.DHONDT, utils.BALLOT_POLLING, 0.05, n_winners=3, max_polls=2000, error_rate=0.01,
+                trials=8, workers=workers, seed='simulation'
+            )
+            for workers in (1, 2)
+        ]
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0]['trials'], 8)
+        self.assertEqual(set(results[0]['ballots']), set(engine.simulation.DEFAULT_QUANTILES))
+        with self.assertRaises(ValueError):
+            engine.simulate(store, utils.DHONDT, utils.BALLOT_POLLING, 0.05, n_winners=3, trials=0)
+
+    def test_contest_group_recounts_one_shared_sample(self):
+        counts = {'mayor': self._count(30), 'council': self._count(45)}
+        contexts = {
+            'mayor': engine.create_audit(counts['mayor'][1], utils.SIMPLE_MAJORITY, utils.BALLOT_POLLING, 0.05),
+            'council': engine.create_audit(counts['council'][1], utils.DHONDT, utils.BALLOT_POLLING, 0.05, n_winners=3),
+        }
+        group_context = engine.GroupContext(engine.ContestGroup(), contexts)
+        engine.init_group_shuffled(group_context, self.seed)
+        tables, table_sizes = engine.union_tables([store for _, store in counts.values()])
+        for _ in range(10):
+            sample_size = engine.get_group_sample_size(group_context)
+            sample = group_context.group.get_shuffled(sample_size)
+            table_codes, ballots = utils.ballot_positions(sample, table_sizes)
+            self.assertEqual(set(engine.draw_group_sample(group_context, sample_size)), set(tables[table_codes].tolist()))
+            recounts = {}
+            for name, (df, store) in counts.items():
+                if contexts[name].audit.in_progress:
+                    # Tables of this contest with fewer ballots skip the
+                    # last ones, and ballots are stacked candidate by candidate
+                    codes = np.searchsorted(store.tables, tables[table_codes])
+                    kept = ballots < store.table_totals[codes]
+                    codes = codes[kept]
+                    ends = np.cumsum(store.vote_matrix[codes], axis=1)
+                    candidates = (ends <= ballots[kept][:, None]).sum(axis=1)
+                    recount = pd.DataFrame({'table': store.tables[codes], 'candidate': store.candidates[candidates]})
+                    recount = recount.merge(df[['candidate', 'party']].drop_duplicates(), on='candidate')
+                    recounts[name] = recount.groupby(['table', 'candidate', 'party']).size().rename('votes').reset_index()
+
+            polled = {name: contexts[name].audit.polled_ballots for name in recounts}
+            engine.apply_group_recount(group_context, recounts, sample_size)
+            for name, recount in recounts.items():
+                self.assertEqual(contexts[name].audit.polled_ballots - polled[name], recount['votes'].sum())
+
+            if engine.check_group_status(group_context):
+                break
+
+        self.assertTrue(all(context.audit.validated for context in contexts.values()))
+        with self.assertRaises(ValueError):
+            engine.apply_group_recount(group_context, {'mayor': recounts.get('mayor')}, 1)
+
+    def test_round_size_reaches_target_stopping_probability(self):
+        p_w, p_l = 0.4, 0.3
+        s = p_w / (p_w + p_l)
+        pair = (0.0, p_w, p_l, np.log(2 * s), np.log(2 * (1 - s)))
+        threshold = np.log(20)
+        size = utils.round_size((pair,), threshold, 0.9, 10 ** 6)
+        self.assertGreaterEqual(utils.stopping_probability(size, [pair], threshold), 0.9)
+        self.assertLess(utils.stopping_probability(size - 1, [pair], threshold), 0.9)
+
+        rng = np.random.default_rng(0)
+        votes = rng.multinomial(size, [p_w, p_l, 1 - p_w - p_l], 20000)
+        simulated = np.mean(votes[:, 0] * pair[3] + votes[:, 1] * pair[4] >= threshold)
+        self.assertAlmostEqual(simulated, utils.stopping_probability(size, [pair], threshold), delta=0.01)
+
+        _, store = self._count(30)
+        context = engine.create_audit(store, utils.DHONDT, utils.BALLOT_POLLING, 0.05, n_winners=3)
+        engine.init_shuffled(context, self.seed)
+        schedule = engine.get_round_schedule(context)
+        self.assertEqual([target for target, _ in schedule], list(utils.ROUND_SCHEDULE_PROBABILITIES))
+        self.assertEqual([size for _, size in schedule], sorted(size for _, size in schedule))
+        self.assertEqual(engine.get_sample_size(context), dict(schedule)[utils.ROUND_STOPPING_PROBABILITY])
+
+    def test_log_SPRT_matches_exact_SPRT(self):
+        df, store = self._count(30)
+        context = engine.create_audit(store, utils.DHONDT, utils.BALLOT_POLLING, 0.05, n_winners=3)
+        context.verify_exact = True
+        engine.init_shuffled(context, self.seed)
+        election = engine.get_election(utils.DHONDT)
+        audit = context.audit
+        exact = {
+            subaudit.identifier: {w: {l: Decimal(1) for l in losers} for w, losers in subaudit.log_T.items()}
+            for subaudit in context.subaudits
+        }
+        validated = []
+        tables = df['table'].unique()
+        for _ in range(5):
+            recount = df[df['table'].isin(tables[:2])]
+            engine.apply_recount(context, recount)
+            tables = tables[2:]
+            votes = recount.groupby('candidate')['votes'].sum().to_dict()
+            for subaudit in context.subaudits:
+                if subaudit.identifier == utils.PRIMARY:
+                    vote_count = election.transform_primary_count(audit, subaudit.vote_count)
+                    vote_recount = election.transform_primary_recount(audit, votes)
+
+                else:
+                    vote_count = election.transform_secondary_count(audit, subaudit.vote_count)
+                    vote_recount = election.transform_secondary_recount(audit, votes)
+
+                vote_recount = {c: vote_recount.get(c, 0) for c in vote_count}
+                T = utils.ballot_polling_SPRT(vote_count, vote_recount, exact[subaudit.identifier], 0.05, subaudit.Sw, subaudit.Sl)
+                validated.append(all(value >= 1 / 0.05 for losers in T.values() for value in losers.values()))
+                self.assertEqual(subaudit.validated(), validated[-1])
+
+        self.assertEqual(set(validated), {False, True})
+
+        subaudit = context.primary
+        recount = {c: 0 for c in subaudit.vote_count}
+        recount[next(iter(subaudit.Sw))] = 10
+        updated = utils.ballot_polling_log_SPRT(subaudit.vote_count, recount, subaudit.log_T, 0.05, subaudit.Sw, subaudit.Sl)
+        wrong = {w: {l: value + 1e-6 for l, value in losers.items()} for w, losers in updated.items()}
+        with self.assertRaises(utils.SPRTVerificationError):
+            utils.verify_log_SPRT(subaudit.vote_count, recount, subaudit.log_T, wrong, 0.05, subaudit.Sw, subaudit.Sl)
+
+
+class BenchmarkTestCase(SimpleTestCase):
+    def test_results_can_be_compared(self):
+        results = benchmark.run_benchmarks(50, 6, n_parties=3, ballots_per_table=40, n_seats=2, sample_tables=10,
+                                           sample_ballots=100, repeat=1)
+        self.assertEqual(set(results['results']), set(benchmark.BENCHMARKS))
+        self.assertEqual(json.loads(json.dumps(results)), results)
+
+        slower = json.loads(json.dumps(results))
+        slower['results']['get_sample']['seconds'] *= 2
+        comparison = {entry['name']: entry for entry in benchmark.compare_results(results, slower)}
+        self.assertTrue(comparison['get_sample']['regression'])
+        self.assertFalse(comparison['random_sample']['regression'])
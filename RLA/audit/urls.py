@@ -5,5 +5,9 @@ from audit import views
 urlpatterns = [
     path('', views.LandingPageView.as_view()),
     path('new/', views.CreateAuditView.as_view()),
-    path('view/<int:audit_pk>/', views.AuditView.as_view())
+    path('view/<int:audit_pk>/', views.AuditView.as_view()),
+    path('view/<int:audit_pk>/recounts/', views.BulkRecountView.as_view()),
+    path('summary/', views.AuditSummaryView.as_view()),
+    path('group/new/', views.CreateContestGroupView.as_view()),
+    path('group/<int:group_pk>/', views.GroupRecountView.as_view())
 ]
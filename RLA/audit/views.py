@@ -1,116 +1,226 @@
-import math
-from decimal import Decimal
+import json
 
-import numpy as np
 import pandas as pd
-from django.http import Http404, HttpResponseServerError
+from django.core.files.base import ContentFile
+from django.core.paginator import Paginator
+from django.db import transaction
+from django.http import Http404, JsonResponse
 from django.shortcuts import render, redirect
 from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.generic import TemplateView
 
-from RLA import utils
-from audit.forms import CreateAuditForm, RecountForm
-from audit.models import Audit, RecountRegistry, SubAudit
+from RLA import engine, utils
+from RLA.instrumentation import span
+from RLA.store import CountFileError, check_headers, read_headers, split_contests, upload_checksum
+from audit import instrumentation, jobs
+from audit.context import AuditContext, GroupContext
+from audit.forms import CreateAuditForm, CreateContestGroupForm, GroupRecountForm, RecountForm
+from audit.models import Audit, ContestGroup, RecountRegistry, SubAudit
+
+
+def get_audit_page(request):
+    """
+    Gets a page of the audits, newest first, loading only their summary
+    columns
+    @param request  :   {HttpRequest}
+                        Request, with the page number in the page parameter
+    @return         :   {Page}
+                        Page of audits
+    """
+    audits = Audit.objects.only(*Audit.summary_fields).order_by('-date', '-pk')
+    return Paginator(audits, utils.AUDITS_PER_PAGE).get_page(request.GET.get('page'))
+
+
+def get_audit_summary(audit):
+    """
+    Gets the summary of an audit shown in the audit lists
+    @param audit    :   {Audit}
+                        Audit, with at least its summary columns loaded
+    @return         :   {dict}
+                        Summary of the audit, serializable as json
+    """
+    return {
+        'id': audit.pk,
+        'url': f'/audit/view/{audit.pk}/',
+        'date': audit.date.isoformat(),
+        'election_type': audit.election_type,
+        'audit_type': audit.audit_type,
+        'risk_limit': audit.risk_limit,
+        'n_winners': audit.n_winners,
+        'in_progress': audit.in_progress,
+        'validated': audit.validated,
+        'init_status': audit.init_status,
+        'total_ballots': audit.total_ballots,
+        'polled_ballots': audit.polled_ballots,
+        'max_polls': audit.max_polls,
+        'progress': audit.get_progress(),
+        'max_p_value': audit.max_p_value,
+    }
 
 
 class LandingPageView(TemplateView):
     template = 'audit/list_audits.html'
 
     def get(self, *args, **kwargs):
-        audits = Audit.objects.all().order_by('-date')
-        context = {'audits': audits}
+        page = get_audit_page(self.request)
+        context = {'audits': page, 'page': page}
         return render(self.request, self.template, context)
 
 
-class CreateAuditView(TemplateView):
-    template = 'audit/form_template.html'
-    action = '/new/'
+class AuditSummaryView(TemplateView):
 
-    @staticmethod
-    def __create_subaudit(audit, W, L, vote_count, identifier):
-        subaudit = SubAudit(
-            identifier=identifier,
-            audit=audit,
-            vote_count=vote_count,
-        )
-        if audit.audit_type == utils.BALLOT_POLLING:
-            subaudit.T = {w: {l: Decimal(1.0) for l in L if w != l} for w in W}
-
-        else:  # audit.audit_type == utils.COMPARISON
-            subaudit.T = 1.0
-
-        subaudit.Sw = {w: 0 for w in W}
-        subaudit.Sl = {l: 0 for l in L}
-        return subaudit
+    def get(self, *args, **kwargs):
+        page = get_audit_page(self.request)
+        return JsonResponse({
+            'count': page.paginator.count,
+            'page': page.number,
+            'num_pages': page.paginator.num_pages,
+            'audits': [get_audit_summary(audit) for audit in page],
+        })
+
+
+def get_recount_status(registry):
+    """
+    Gets the status of an uploaded recount, shown by the bulk recount API
+    @param registry :   {RecountRegistry}
+                        Uploaded recount
+    @return         :   {dict}
+                        Status of the recount, serializable as json
+    """
+    return {
+        'id': registry.pk,
+        'center': registry.center,
+        'status': registry.status,
+        'applied_tables': registry.applied_tables,
+        'error': registry.error,
+        'timestamp': registry.timestamp.isoformat(),
+    }
+
+
+@method_decorator(ensure_csrf_cookie, name='get')
+class BulkRecountView(TemplateView):
+    """
+    Recounts of many recount centers at once, as multipart files (a
+    recount field per file, with an optional center field for each) or as
+    json ({"recounts": [{"center": ..., "rows": [...]}], "sample_size": ...}).
+    Uploads are queued and applied in upload order by the recount worker.
+    Uploads are protected against cross-site requests: clients send back
+    the csrftoken cookie set by a GET in the X-CSRFToken header
+    """
 
     @staticmethod
-    def __create_plurality_audit(audit):
-        df = pd.read_csv(audit.preliminary_count.path)
-        vote_count = df.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
-        audit.vote_count = vote_count
-        audit.accum_recount = {c: 0 for c in vote_count}
-        audit.save()
-        W = list(vote_count.keys())[:audit.n_winners]
-        L = list(vote_count.keys())[audit.n_winners:]
-        subaudit = CreateAuditView.__create_subaudit(audit, W, L, vote_count, utils.PRIMARY)
-        subaudit.save()
-        return redirect(f'/simplemajority/preliminary/{audit.pk}')
+    def _uploads(request):
+        """
+        Gets the recounts of a request
+        @param request  :   {HttpRequest}
+                            Multipart or json request
+        @return         :   {tuple<list<tuple<str,File>>,str>}
+                            Center and file of each recount, and the sample
+                            size of the round, if given
+        """
+        if request.content_type == 'application/json':
+            data = json.loads(request.body)
+            uploads = [
+                (str(recount.get('center', '')), ContentFile(
+                    pd.DataFrame(recount.get('rows', [])).to_csv(index=False).encode(), name=f'recount_{i}.csv'
+                ))
+                for i, recount in enumerate(data.get('recounts', []))
+            ]
+            return uploads, data.get('sample_size')
+
+        centers = request.POST.getlist('center')
+        files = request.FILES.getlist('recount')
+        uploads = [(centers[i] if i < len(centers) else '', f) for i, f in enumerate(files)]
+        return uploads, request.POST.get('sample_size')
 
-    @staticmethod
-    def __create_super_majority_audit(audit):
-        df = pd.read_csv(audit.preliminary_count.path)
-        vote_count = df.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
-        audit.vote_count = vote_count
-        audit.accum_recount = {c: 0 for c in vote_count}
-        audit.n_winners = 1
-        audit.save()
-        subaudit = CreateAuditView.__create_subaudit(audit, ['Winner'], ['Losers'], vote_count, utils.PRIMARY)
-        subaudit.save()
-        return redirect(f'/supermajority/preliminary/{audit.pk}')
+    def get(self, *args, **kwargs):
+        try:
+            audit = Audit.objects.get(pk=kwargs.get('audit_pk'))
+
+        except Audit.DoesNotExist:
+            raise Http404('Audit does not exist')
+
+        return JsonResponse({
+            'audit': get_audit_summary(audit),
+            'recounts': [get_recount_status(registry) for registry in audit.recountregistry_set.order_by('pk')],
+        })
+
+    def post(self, *args, **kwargs):
+        try:
+            audit = Audit.objects.get(pk=kwargs.get('audit_pk'))
+
+        except Audit.DoesNotExist:
+            raise Http404('Audit does not exist')
+
+        if audit.group_id is not None:
+            return JsonResponse({'error': f'Contests of a group are recounted at /audit/group/{audit.group_id}/'}, status=400)
+
+        if not audit.is_initialized() or not audit.in_progress:
+            return JsonResponse({'error': 'The audit is not taking recounts'}, status=409)
+
+        try:
+            uploads, sample_size = self._uploads(self.request)
+            sample_size = int(sample_size) if sample_size not in (None, '') else None
+
+        except (ValueError, TypeError, AttributeError):
+            return JsonResponse({'error': 'Malformed request'}, status=400)
+
+        cvr = audit.audit_type == utils.BALLOT_COMPARISON
+        results = []
+        registries = []
+        for center, f in uploads:
+            if check_headers(read_headers(f), cvr=cvr):
+                results.append({'center': center, 'error': 'Headers not valid'})
+                continue
+
+            checksum = upload_checksum(f)
+            if checksum in {registry.checksum for registry in registries}:
+                results.append({'center': center, 'error': 'Repeated in this request'})
+                continue
+
+            registry = RecountRegistry(
+                audit=audit, checksum=checksum, center=center, sample_size=sample_size, status=utils.RECOUNT_QUEUED
+            )
+            registry.recount.save(f.name or 'recount.csv', f, save=False)
+            registries.append(registry)
+
+        registries = RecountRegistry.objects.bulk_create(registries)
+        if registries:
+            jobs.enqueue_recounts(audit)
+            audit.refresh_from_db()
+
+        statuses = RecountRegistry.objects.in_bulk([registry.pk for registry in registries])
+        return JsonResponse({
+            'audit': get_audit_summary(audit),
+            'recounts': [get_recount_status(statuses[registry.pk]) for registry in registries],
+            'rejected': results,
+        }, status=202 if registries or not results else 400)
+
+
+class CreateAuditView(TemplateView):
+    template = 'audit/form_template.html'
+    action = '/new/'
 
     @staticmethod
-    def __create_dhondt_audit(audit):
-        df = pd.read_csv(audit.preliminary_count.path)
-        df['party'] = df['party'].fillna('')
-        vote_count = df.groupby('party').sum()['votes'].sort_values(ascending=False).to_dict()
-        audit.vote_count = vote_count
-        audit.accum_recount = {p: 0 for p in vote_count}
+    def __create_audit(audit):
+        store = audit.build_preliminary_store(save=False)
+        subaudits = engine.create_subaudits(audit, store)
+        audit.total_ballots = sum(audit.vote_count.values())
         audit.save()
-        pseudo_candidate_votes = {
-            (p, i): utils.p(p, vote_count, i) for i in range(audit.n_winners) for p in vote_count.keys() if p
-        }
-        W, L = utils.dhondt_W_L_sets(pseudo_candidate_votes, audit.n_winners)
-        Wp = []
-        for winner, _ in W:
-            if winner not in Wp:
-                Wp.append(winner)
-
-        Lp = []
-        for loser, _ in L:
-            if loser not in Lp:
-                Lp.append(loser)
-
-        primary_subaudit = CreateAuditView.__create_subaudit(audit, Wp, Lp, vote_count, utils.PRIMARY)
-        for party in primary_subaudit.vote_count.keys():
-            wp = list(filter(lambda x: x[0] == party, W))
-            lp = list(filter(lambda x: x[0] == party, L))
-            if wp:
-                primary_subaudit.Sw[party] = max(wp, key=lambda x: x[1])[1]
-
-            if lp:
-                primary_subaudit.Sl[party] = min(lp, key=lambda x: x[1])[1]
-
-        primary_subaudit.save()
-        for party in Wp:
-            party_df = df[df['party'] == party]
-            party_count = party_df.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
-            candidates = list(party_count.keys())
-            W = candidates[:primary_subaudit.Sw[party] - 1]
-            L = candidates[primary_subaudit.Sw[party] - 1:]
-            subaudit = CreateAuditView.__create_subaudit(audit, W, L, party_count, party)
-            subaudit.save()
-
-        return redirect(f'/dhondt/preliminary/{audit.pk}')
+        for subaudit in subaudits:
+            SubAudit(
+                identifier=subaudit.identifier,
+                audit=audit,
+                vote_count=subaudit.vote_count,
+                T=subaudit.T,
+                log_T=subaudit.log_T,
+                Sw=subaudit.Sw,
+                Sl=subaudit.Sl
+            ).save()
+
+        return redirect(f'/{audit.election_type}/preliminary/{audit.pk}')
 
     def get(self, *args, **kwargs):
         form = CreateAuditForm()
@@ -124,14 +234,33 @@ class CreateAuditView(TemplateView):
         form = CreateAuditForm(self.request.POST, self.request.FILES)
         if form.is_valid():
             audit = form.save()
-            if form.cleaned_data['election_type'] == utils.SIMPLE_MAJORITY:
-                return CreateAuditView.__create_plurality_audit(audit)
+            response = CreateAuditView.__create_audit(audit)
+            jobs.enqueue_initialization(audit)
+            return response
+
+        context = {
+            'form': form,
+            'action': self.action
+        }
+        return render(self.request, self.template, context)
+
 
-            elif form.cleaned_data['election_type'] == utils.SUPER_MAJORITY:
-                return CreateAuditView.__create_super_majority_audit(audit)
+class CreateContestGroupView(TemplateView):
+    template = 'audit/form_template.html'
+    action = '/audit/group/new/'
+
+    def get(self, *args, **kwargs):
+        context = {
+            'form': CreateContestGroupForm(),
+            'action': self.action
+        }
+        return render(self.request, self.template, context)
 
-            else:  # form.cleaned_data['election_type'] == utils.DHONDT:
-                return CreateAuditView.__create_dhondt_audit(audit)
+    def post(self, *args, **kwargs):
+        form = CreateContestGroupForm(self.request.POST)
+        if form.is_valid():
+            group = form.save()
+            return redirect(f'/audit/group/{group.pk}/')
 
         context = {
             'form': form,
@@ -140,6 +269,108 @@ class CreateAuditView(TemplateView):
         return render(self.request, self.template, context)
 
 
+class GroupRecountView(TemplateView):
+    """
+    Recount of the contests of a group, all of them from one shared
+    sample of ballots
+    """
+    template = 'audit/group_recount.html'
+    waiting_template = 'audit/waiting_hall.html'
+
+    def _render(self, group_context, form):
+        sample_size = 0
+        tables = {}
+        if group_context.in_progress():
+            sample_size = engine.get_group_sample_size(group_context)
+            tables = engine.draw_group_sample(group_context, sample_size)
+
+        if form is None:
+            form = GroupRecountForm(initial={'sample_size': sample_size})
+
+        context = {
+            'group': group_context.group,
+            'audits': [context.audit for context in group_context.contexts.values()],
+            'form': form,
+            'tables': tables,
+            'sample_size': sample_size
+        }
+        return render(self.request, self.template, context)
+
+    @staticmethod
+    def _save_recounts(group_context, recount, registries):
+        """
+        Stores the recount of each contest in a new registry of its audit,
+        without saving it, and parses it
+        @param group_context    :   {GroupContext}
+                                    Group and the contexts of its contests
+        @param recount          :   {File}
+                                    Uploaded recount, with a contest column
+        @param registries       :   {list<RecountRegistry>}
+                                    Registries created, filled as their
+                                    files are written
+        @return                 :   {dict<str->DataFrame>}
+                                    Recount of each contest
+        """
+        recounts = {}
+        for contest, content in split_contests(recount).items():
+            if contest not in group_context.contexts:
+                raise ValueError(f'Unknown contest: {contest}')
+
+            audit = group_context.contexts[contest].audit
+            recount_registry = RecountRegistry(audit=audit)
+            recount_registry.recount.save(f'recount_{audit.pk}.csv', ContentFile(content), save=False)
+            registries.append(recount_registry)
+            recounts[contest] = audit.get_df(recount_registry.recount.path)
+
+        return recounts
+
+    def get(self, *args, **kwargs):
+        group = ContestGroup.objects.get(pk=kwargs.get('group_pk'))
+        audit = group.audits.order_by('pk').first()
+        if audit is not None:
+            jobs.ensure_initialization(audit)
+
+        if audit is None or not audit.is_initialized():
+            failed = audit is not None and audit.init_status == utils.INIT_FAILED
+            context = {
+                'audit': audit or group,
+                'pulse_emitted': group.random_seed_time <= timezone.now(),
+                'failed': failed,
+                'retry_time': jobs.retry_time(audit) if failed else None,
+                'progress': round(100 * audit.init_progress) if audit is not None else 0
+            }
+            return render(self.request, self.waiting_template, context)
+
+        return self._render(GroupContext.load(group.pk), None)
+
+    def post(self, *args, **kwargs):
+        group_context = GroupContext.load(kwargs.get('group_pk'))
+        if not group_context.group.is_initialized():
+            return redirect(self.request.path)
+
+        form = GroupRecountForm(self.request.POST, self.request.FILES)
+        if form.is_valid():
+            registries = []
+            try:
+                with transaction.atomic():
+                    recounts = self._save_recounts(group_context, form.cleaned_data['recount'], registries)
+                    engine.apply_group_recount(group_context, recounts, form.cleaned_data['sample_size'])
+                    RecountRegistry.objects.bulk_create(registries)
+
+            except ValueError as e:
+                for recount_registry in registries:
+                    recount_registry.recount.delete(save=False)
+
+                form.add_error('recount', str(e))
+
+            else:
+                engine.check_group_status(group_context)
+                group_context.save()
+                return redirect(self.request.path)
+
+        return self._render(group_context, form)
+
+
 class AuditView(TemplateView):
     template = 'audit/view_audit.html'
 
@@ -149,14 +380,15 @@ class AuditView(TemplateView):
             audit = Audit.objects.get(pk=audit_pk)
             context = {
                 'audit': audit,
+                'timings': audit.recounttiming_set.select_related('recount')[:utils.TIMINGS_SHOWN],
                 'votes': {
                     c: {
                         'preliminary': audit.vote_count[c],
                         'recount': audit.accum_recount[c]
                     } for c in audit.vote_count
                 },
-                'total_count': sum(audit.vote_count.values()),
-                'total_recount': sum(audit.accum_recount.values())
+                'total_count': audit.total_ballots,
+                'total_recount': audit.polled_ballots
             }
             return render(self.request, self.template, context)
 
@@ -180,261 +412,132 @@ class PluralityPreliminaryView(TemplateView):
 
 class PluralityRecountView(TemplateView):
     recount_template = ''
+    waiting_template = 'audit/waiting_hall.html'
     validate_url = ''
 
-    def _transform_primary_count(self, audit, vote_count):
-        return vote_count
-
-    def _transform_primary_recount(self, audit, vote_recount):
-        return vote_recount
-
-    def _transform_secondary_count(self, audit, vote_count):
-        return vote_count
-
-    def _transform_secondary_recount(self, audit, vote_recount):
-        return vote_recount
-
-    def _comparison_table_transform(self, audit, vote_count):
-        return vote_count
-
-    def _get_sample_size(self, audit):
-        primary_subaudit = audit.subaudit_set.get(identifier=utils.PRIMARY)
-        if audit.audit_type == utils.BALLOT_POLLING:
-            votes = list(primary_subaudit.vote_count.values())
-            votes.sort(reverse=True)
-            candidates = list(primary_subaudit.vote_count.keys())
-            candidates = sorted(candidates, key=lambda c: primary_subaudit.vote_count[c], reverse=True)
-            W = candidates[:audit.n_winners]
-            L = candidates[audit.n_winners:]
-            sample_size = utils.ASN(
-                audit.risk_limit / audit.max_p_value,
-                primary_subaudit.vote_count,
-                W,
-                L
-            )
-
-        else:
-            Wp, Lp = primary_subaudit.get_W_L()
-            reported = self._transform_primary_count(audit, primary_subaudit.vote_count)
-            u = utils.MICRO_upper_bound(reported, Wp, Lp, primary_subaudit.Sw, primary_subaudit.Sl)
-            df = pd.read_csv(audit.preliminary_count.path)
-            V = df.groupby('table').sum()['votes'].max()
-            um = u * V
-            U = um * len(df['table'].unique())
-            sample_size = utils.comparison_sample_size(
-                U,
-                audit.risk_limit / primary_subaudit.max_p_value
-            )
-
-        sample_size = min(sample_size, len(audit.shuffled))
-        return sample_size
-
-    def _get_party_seat_pairs(self, audit):
-        primary_subaudit = audit.subaudit_set.get(identifier=utils.PRIMARY)
-        Wp, Lp = primary_subaudit.get_W_L()
-        W = [(c, 0) for c in Wp]
-        L = [(c, 0) for c in Lp]
-        return W, L
-
-    def _init_shuffled(self, audit):
-        seed = utils.get_random_seed(audit.random_seed_time)
-        preliminary = pd.read_csv(audit.preliminary_count.path)
-        if audit.audit_type == utils.BALLOT_POLLING:
-            shuffled = []
-            table_count = preliminary.groupby('table').sum()['votes'].to_dict()
-            for table in sorted(table_count):
-                shuffled.extend(zip([table] * table_count[table], range(table_count[table])))
-
-            primary_subaudit = audit.subaudit_set.get(identifier=utils.PRIMARY)
-            sample_size = min(audit.max_polls, sum(primary_subaudit.vote_count.values()))
-            weights = None
-
-        else:  # audit.audit_type == utils.COMPARISON
-            primary_subaudit = audit.subaudit_set.get(identifier=utils.PRIMARY)
-            Wp, Lp = primary_subaudit.get_W_L()
-            reported_vote_count = audit.get_grouped(preliminary)
-            reported = self._transform_primary_count(audit, reported_vote_count)
-            margin = {w: {l: reported[w] - reported[l] for l in Lp if l != w} for w in Wp}
-            N = len(preliminary['table'].unique())
-            shuffled = np.empty(N, dtype=tuple)
-            weights = np.empty(N, dtype=float)
-            i = 0
-            for table, group in preliminary.groupby('table'):
-                vote_count = group.groupby('candidate').sum()['votes'].to_dict()
-                shuffled[i] = (table, 'All')
-                recount = self._transform_primary_recount(audit, vote_count)
-                u = utils.batch_error_upper_bound(recount, margin, Wp, Lp)
-                weights[i] = u
-                i += 1
-
-            shuffled = sorted(shuffled, key=lambda pair: pair[0])
-            sample_size = len(shuffled)
-
-        shuffled = utils.random_sample(
-            population=shuffled,
-            sample_size=sample_size,
-            weights=weights,
-            seed=seed
-        )
-        audit.random_seed = seed
-        audit.shuffled = shuffled
-        audit.save()
+    def _render_recount(self, audit_context, form, sample_size):
+        with span('draw_sample'):
+            tables, sample_size = engine.draw_sample(audit_context, sample_size)
 
-    def _samplesize2tables(self, audit, sample_size):
-        df = pd.read_csv(audit.preliminary_count.path)
-        mean_ballots_per_table = df.groupby('table').sum()['votes'].mean()
-        return math.ceil(sample_size / mean_ballots_per_table)
-
-    def _process_ballot_polling_subaudit(self, audit, subaudit, vote_count, vote_recount):
-        subaudit.T = utils.ballot_polling_SPRT(vote_count, vote_recount, subaudit.T, audit.risk_limit, subaudit.Sw, subaudit.Sl)
-        subaudit.max_p_value = utils.max_p_value(subaudit.T)
-        subaudit.save()
-        audit.max_p_value = max(audit.max_p_value, subaudit.max_p_value)
-        audit.save()
-
-    def _process_comparison_subaudit(self, audit, subaudit, table_count, table_recount, W, L, um, U):
-        reported_count = self._transform_primary_count(audit, subaudit.vote_count)
-        subaudit.T *= utils.comparison_SPRT(
-            reported_count,
-            table_count,
-            table_recount,
-            W,
-            L,
-            um,
-            U
-        )
-        subaudit.save()
-
-    def _process_primary_subaudit(self, audit, subaudit, real_vote_recount):
-        vote_count = self._transform_primary_count(audit, subaudit.vote_count)
-        vote_recount = self._transform_primary_recount(audit, real_vote_recount)
-        self._process_ballot_polling_subaudit(audit, subaudit, vote_count, vote_recount)
-
-    def _process_secondary_subaudit(self, audit, subaudit, real_vote_recount):
-        vote_count = self._transform_secondary_count(audit, subaudit.vote_count)
-        vote_recount = self._transform_secondary_recount(audit, real_vote_recount)
-        self._process_ballot_polling_subaudit(audit, subaudit, vote_count, vote_recount)
-
-    def _ballot_polling_recount(self, audit, real_recount):
-        real_vote_recount = real_recount.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
-        subaudit_set = audit.subaudit_set.all()
-
-        # Primary subaudit
-        primary_subaudit = subaudit_set.get(identifier=utils.PRIMARY)
-        self._process_primary_subaudit(audit, primary_subaudit, real_vote_recount)
-
-        # Secondary subaudits
-        for subaudit in subaudit_set.exclude(identifier=utils.PRIMARY):
-            self._process_secondary_subaudit(audit, subaudit, real_vote_recount)
-
-    def _comparison_recount(self, audit, real_recount):
-        subaudit_set = audit.subaudit_set.all()
-
-        primary_subaudit = subaudit_set.get(identifier=utils.PRIMARY)
-        df = audit.get_df(audit.preliminary_count.path)
-        Wp, Lp = primary_subaudit.get_W_L()
-        reported = self._transform_primary_count(audit, primary_subaudit.vote_count)
-        u = utils.MICRO_upper_bound(reported, Wp, Lp, primary_subaudit.Sw, primary_subaudit.Sl)
-        V = max(df.groupby('table').sum()['votes'])
-        um = u * V
-        U = um * len(df['table'].unique())
-        for table, group in real_recount.groupby('table'):
-            W, L = self._get_party_seat_pairs(audit)
-            reported_table = df[df['table'] == table]
-            table_count = reported_table.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
-            table_recount = group.groupby('candidate').sum()['votes'].sort_values(ascending=False).to_dict()
-
-            primary_vote_count = self._comparison_table_transform(audit, table_count)
-            primary_vote_recount = self._transform_primary_recount(audit, table_recount)
-
-            self._process_comparison_subaudit(audit, primary_subaudit, primary_vote_count, primary_vote_recount, W, L, um, U)
-
-            secondary_vote_count = self._transform_secondary_count(audit, table_count)
-            secondary_vote_recount = self._transform_secondary_recount(audit, table_recount)
-            for subaudit in subaudit_set.exclude(identifier=utils.PRIMARY):
-                Wp, Lp = subaudit.get_W_L()
-                W = [(c, 0) for c in Wp]
-                L = [(c, 0) for c in Lp]
-                self._process_comparison_subaudit(audit, subaudit, secondary_vote_count, secondary_vote_recount, W, L, um, U)
-
-        primary_subaudit.max_p_value = 1 / primary_subaudit.T
-        primary_subaudit.save()
-        max_p_value = primary_subaudit.max_p_value
-        for subaudit in subaudit_set.exclude(identifier=utils.PRIMARY):
-            subaudit.max_p_value = 1 / subaudit.T
-            subaudit.save()
-            max_p_value = max(max_p_value, subaudit.max_p_value)
-
-        audit.max_p_value = max_p_value
-        audit.save()
-
-    def get(self, *args, **kwargs):
-        audit_pk = kwargs.get('audit_pk')
-        audit = Audit.objects.get(pk=audit_pk)
-        if audit.random_seed_time > timezone.now():
-            return HttpResponseServerError('Random pulse has not yet been emitted')
-
-        if not audit.random_seed:
-            self._init_shuffled(audit)
-
-        sample_size = self._get_sample_size(audit)
-        draw_size = sample_size
-
-        form = RecountForm(initial={'recounted_ballots': sample_size})
-
-        tables = utils.get_sample(audit, draw_size)
-        df = audit.get_df(audit.preliminary_count.path)
-        df = df[df['table'].isin(tables.keys())]
-        if audit.audit_type == utils.COMPARISON:
-            sample_size = df['votes'].sum()
+        with span('round_schedule'):
+            schedule = engine.get_round_schedule(audit_context)
 
         context = {
             'form': form,
             'tables': tables,
             'sample_size': sample_size,
-            'audit_pk': audit_pk
+            'schedule': [(round(100 * probability), size) for probability, size in schedule],
+            'received': sorted(audit_context.audit.round_tables),
+            'audit_pk': audit_context.audit.pk
         }
-        return render(self.request, self.recount_template, context)
+        with span('render'):
+            return render(self.request, self.recount_template, context)
 
-    def post(self, *args, **kwargs):
+    def get(self, *args, **kwargs):
         audit_pk = kwargs.get('audit_pk')
-        audit = Audit.objects.get(pk=audit_pk)
-        if audit.random_seed_time > timezone.now():
-            return HttpResponseServerError('Random pulse has not yet been emitted')
-
-        form = RecountForm(self.request.POST, self.request.FILES)
-        if form.is_valid():
-            recount_registry = RecountRegistry(
-                audit=audit,
-                recount=form.cleaned_data['recount']
+        with instrumentation.timed(audit_pk, utils.TIMING_RECOUNT_GET, page_view=True):
+            audit = Audit.objects.get(pk=audit_pk)
+            if audit.group_id is not None:
+                return redirect(f'/audit/group/{audit.group_id}/')
+
+            with span('ensure_initialization'):
+                jobs.ensure_initialization(audit)
+
+            if not audit.is_initialized():
+                failed = audit.init_status == utils.INIT_FAILED
+                context = {
+                    'audit': audit,
+                    'pulse_emitted': audit.random_seed_time <= timezone.now(),
+                    'failed': failed,
+                    'retry_time': jobs.retry_time(audit) if failed else None,
+                    'progress': round(100 * audit.init_progress)
+                }
+                return render(self.request, self.waiting_template, context)
+
+            audit_context = AuditContext(audit)
+            with span('sample_size'):
+                sample_size = engine.get_sample_size(audit_context)
+
+            form = RecountForm(
+                initial={'recounted_ballots': sample_size},
+                cvr=audit.audit_type == utils.BALLOT_COMPARISON
             )
-            recount_registry.save()
-
-            real_recount = audit.get_df(recount_registry.recount.path)
-
-            audit.add_polled_ballots(real_recount, save=False)
-            audit.max_p_value = 0
-            audit.save()
-
-            if audit.audit_type == utils.BALLOT_POLLING:
-                self._ballot_polling_recount(audit, real_recount)
-
-            else:  # audit.audit_type == utils.COMPARISON
-                self._comparison_recount(audit, real_recount)
+            return self._render_recount(audit_context, form, sample_size)
 
-            return redirect(f'{self.validate_url}/{audit_pk}/')
-
-        sample_size = self._get_sample_size(audit)
-        draw_size = sample_size
-
-        tables = utils.get_sample(audit, draw_size)
-        context = {
-            'form': form,
-            'tables': tables,
-            'sample_size': sample_size,
-            'audit_pk': audit_pk
-        }
-        return render(self.request, self.recount_template, context)
+    def post(self, *args, **kwargs):
+        audit_pk = kwargs.get('audit_pk')
+        with instrumentation.timed(audit_pk, utils.TIMING_RECOUNT_POST) as timing:
+            audit_context = AuditContext.load(audit_pk)
+            audit = audit_context.audit
+            if audit.group_id is not None:
+                return redirect(f'/audit/group/{audit.group_id}/')
+
+            if not audit.is_initialized():
+                return redirect(self.request.path)
+
+            with span('validate_form'):
+                form = RecountForm(
+                    self.request.POST,
+                    self.request.FILES,
+                    cvr=audit.audit_type == utils.BALLOT_COMPARISON
+                )
+                is_valid = form.is_valid()
+
+            real_recount = None
+            if is_valid:
+                with span('save_recount'):
+                    checksum = upload_checksum(form.cleaned_data['recount'])
+                    recount = form.cleaned_data['recount']
+                    recount_registry = RecountRegistry(audit=audit, checksum=checksum)
+                    recount_registry.recount.save(recount.name, recount, save=False)
+
+                with span('parse_recount', bytes_read=recount_registry.recount.size) as parse_span:
+                    try:
+                        real_recount = audit.get_df(recount_registry.recount.path)
+
+                    except CountFileError as e:
+                        recount_registry.recount.delete(save=False)
+                        form.add_error('recount', str(e))
+
+                    else:
+                        parse_span['rows'] = len(real_recount)
+
+            if real_recount is not None:
+                with transaction.atomic():
+                    with span('load_state'):
+                        # Locked, so uploads of other recount centers apply one after the other
+                        audit_context = AuditContext.load(audit_pk, lock=True)
+                        audit = audit_context.audit
+                        audit_context.subaudits  # prefetches the subaudits with their state
+
+                    with span('apply_recount'):
+                        applied = engine.apply_recount(
+                            audit_context,
+                            real_recount,
+                            sample_size=form.cleaned_data['recounted_ballots']
+                        )
+
+                    with span('save_state'):
+                        recount_registry.audit = audit
+                        recount_registry.applied_tables = applied
+                        recount_registry.save()
+                        timing.recount = recount_registry
+                        if applied:
+                            audit_context.save()
+
+                        else:
+                            audit.save()
+
+                if applied:
+                    return redirect(f'{self.validate_url}/{audit_pk}/')
+
+                # Uploaded again, or outside the round: tables already applied are skipped
+                form.add_error('recount', utils.RECOUNT_NOTHING_PENDING)
+
+            with span('sample_size'):
+                sample_size = engine.get_sample_size(audit_context)
+
+            return self._render_recount(audit_context, form, sample_size)
 
 
 class PluralityValidationView(TemplateView):
@@ -443,17 +546,10 @@ class PluralityValidationView(TemplateView):
 
     def get(self, *args, **kwargs):
         audit_pk = kwargs.get('audit_pk')
-        audit = Audit.objects.get(pk=audit_pk)
-
-        validated = all([subaudit.validated() for subaudit in audit.subaudit_set.all()])
-        if validated:
-            audit.validated = True
-            audit.shuffled = []  # to save space in database
-
-        if audit.validated or audit.max_polls <= audit.polled_ballots:
-            audit.in_progress = False
-
-        audit.save()
+        audit_context = AuditContext.load(audit_pk)
+        audit = audit_context.audit
+        engine.check_status(audit_context)
+        audit_context.save()
 
         votes = {}
         for c in audit.vote_count:
@@ -464,7 +560,7 @@ class PluralityValidationView(TemplateView):
 
         context = {
             'votes': votes,
-            'total_count': sum(audit.vote_count.values()),
+            'total_count': audit.total_ballots,
             'total_recount': audit.polled_ballots,
             'ballot_cap': audit.max_polls,
             'is_validated': audit.validated,